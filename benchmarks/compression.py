@@ -0,0 +1,79 @@
+"""
+benchmarks/compression.py
+
+Measures output file size and write time of the csv compression options (see `studies.studydataset.save_output`)
+on the outputs of `run_functions.py`.
+
+Execution:
+    python benchmarks/compression.py [--out data/out] [--threads 4] [--report compression.csv]
+
+For each history file found in the output folder (any format), the history is written once per codec and the
+median write time of `--repeat` runs and the file size are reported.
+"""
+import os
+import sys
+import glob
+import time
+import argparse
+import tempfile
+import pandas as pd
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from studies.studydataset import save_output, output_path
+
+def codecs(threads):
+    """Returns the benchmarked `(name, output_format, compression)` combinations."""
+    return [('csv', 'csv', None),
+            ('gzip-1', 'csv.gz', {'level': 1}),
+            ('gzip-6', 'csv.gz', {'level': 6}),
+            ('gzip-9 (default)', 'csv.gz', None),
+            (f'block-gzip-6 x{threads}', 'csv.gz', {'level': 6, 'threads': threads}),
+            (f'block-gzip-9 x{threads}', 'csv.gz', {'level': 9, 'threads': threads}),
+            ('zstd-3', 'csv.zst', {'level': 3}),
+            (f'zstd-3 x{threads}', 'csv.zst', {'level': 3, 'threads': threads}),
+            ('zstd-19', 'csv.zst', {'level': 19})]
+
+def read_history(file_path):
+    if file_path.endswith('.parquet'):
+        return pd.read_parquet(file_path)
+    if file_path.endswith('.feather'):
+        return pd.read_feather(file_path)
+    return pd.read_csv(file_path, dtype={'patient_id': str})
+
+def find_histories(out_path):
+    """Returns one file per study and history (the first format found)."""
+    files = {}
+    for file_path in sorted(glob.glob(os.path.join(out_path, '*', '*_history.*'))):
+        files.setdefault(file_path[:file_path.index('_history.')], file_path)
+    return list(files.values())
+
+def benchmark(out_path, threads, repeat):
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for file_path in find_histories(out_path):
+            df = read_history(file_path)
+            name = os.path.basename(file_path[:file_path.index('_history.') + len('_history')])
+            for codec, output_format, compression in codecs(threads):
+                target = os.path.join(tmp_dir, name)
+                seconds = []
+                for _ in range(repeat):
+                    start = time.perf_counter()
+                    save_output(df, target, output_format, compression)
+                    seconds.append(time.perf_counter() - start)
+                size = os.path.getsize(output_path(target, output_format))
+                os.remove(output_path(target, output_format))
+                results.append({'history': name, 'rows': len(df), 'codec': codec,
+                                'seconds': sorted(seconds)[len(seconds) // 2], 'size_mb': size / 2**20})
+                print(f"{name:45} {codec:22} {results[-1]['seconds']:8.3f}s {results[-1]['size_mb']:9.2f} MB")
+    return pd.DataFrame(results)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark size and write time of the csv compression options.")
+    parser.add_argument('--out', default='data/out', help="Output folder of run_functions.py.")
+    parser.add_argument('--threads', type=int, default=os.cpu_count(), help="Threads of the multi-threaded codecs.")
+    parser.add_argument('--repeat', type=int, default=3, help="Number of writes per codec (the median is reported).")
+    parser.add_argument('--report', help="Optional csv file to save the results to.")
+    args = parser.parse_args()
+    results = benchmark(args.out, args.threads, args.repeat)
+    if args.report:
+        results.to_csv(args.report, index=False)
@@ -0,0 +1,62 @@
+"""
+benchmarks/imports.py
+
+Measures the cold-start import time of the package entry points and reports which heavy optional dependencies they load.
+
+Execution:
+    python benchmarks/imports.py [--repeat 5] [--report imports.csv]
+
+Each import runs in a fresh interpreter (`--repeat` times, the median is reported). Heavy dependencies (dask, matplotlib and
+isodate) should only be imported by the studies and functions that use them. Use `python -X importtime -c "import studies"`
+to see the import time of each module.
+"""
+import os
+import sys
+import json
+import argparse
+import subprocess
+import pandas as pd
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+#pandas is the baseline every entry point pays for
+TARGETS = ['import pandas',
+           'import studies',
+           'from studies import DCLP3',
+           'from studies import Loop',
+           'from studies import T1DEXI',
+           'import run_functions',
+           'import src.drawing, src.cdf']
+HEAVY_MODULES = ['dask', 'matplotlib', 'isodate']
+
+def measure_import(statement):
+    """Runs an import statement in a fresh interpreter.
+
+    Returns:
+        seconds (float): The time spent in the statement (without interpreter startup).
+        loaded (list): The heavy modules (see `HEAVY_MODULES`) loaded by the statement.
+    """
+    code = (f"import sys, time, json\nstart = time.perf_counter()\n{statement}\nseconds = time.perf_counter() - start\n"
+            f"print(json.dumps([seconds, [m for m in {HEAVY_MODULES!r} if m in sys.modules]]))")
+    output = subprocess.run([sys.executable, '-c', code], cwd=ROOT, capture_output=True, text=True, check=True).stdout
+    seconds, loaded = json.loads(output.strip().splitlines()[-1])
+    return seconds, loaded
+
+def benchmark(targets, repeat):
+    results = []
+    for statement in targets:
+        runs = [measure_import(statement) for _ in range(repeat)]
+        seconds = sorted(seconds for seconds, _ in runs)[len(runs) // 2]
+        loaded = runs[-1][1]
+        results.append({'import': statement, 'milliseconds': seconds * 1000, 'heavy_modules': ','.join(loaded)})
+        print(f"{statement:35} {seconds * 1000:8.1f} ms   {', '.join(loaded) or '-'}")
+    return pd.DataFrame(results)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure the cold-start import time of the package entry points.")
+    parser.add_argument('--targets', nargs='+', default=TARGETS, help="The import statements to measure.")
+    parser.add_argument('--repeat', type=int, default=5, help="Number of fresh interpreters per import (the median is reported).")
+    parser.add_argument('--report', help="Optional csv file to save the results to.")
+    args = parser.parse_args()
+    results = benchmark(args.targets, args.repeat)
+    if args.report:
+        results.to_csv(args.report, index=False)
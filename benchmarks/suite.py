@@ -0,0 +1,368 @@
+"""
+benchmarks/suite.py
+
+Benchmarks of the study loaders (load and extract step of each `StudyDataset` subclass), the `src.postprocessing`
+transforms, the `src.tdd` functions, `src.find_periods` and the `src.pandas_helper` utilities on synthetic raw data
+(see `src/synthetic.py`) at several scales.
+
+Execution:
+    python benchmarks/suite.py [--scales small medium] [--filter extract] [--repeat 3] [--thresholds benchmarks/thresholds.json] [--report results.csv]
+
+Each benchmark has a setup (not measured, e.g. loading the tables the benchmark needs) that runs before every repetition.
+The median wall time of `--repeat` runs and the peak python memory allocated by the benchmark (an additional run traced
+with `tracemalloc`) are reported. The synthetic data of a scale is generated on first use and kept in `--data`.
+
+The run fails (exit code 1) if a benchmark raises or exceeds its time or memory threshold. Thresholds are configured as
+`{"<benchmark>": {"<scale>": {"seconds": 1.5, "memory_mb": 100}}}`, benchmark and scale keys are `fnmatch` patterns
+(e.g. `"extract.*"` or `"*"`), the first matching entry is used. Benchmarks without a matching entry are only reported.
+"""
+import os
+import re
+import sys
+import gc
+import json
+import time
+import shutil
+import fnmatch
+import argparse
+import warnings
+import tracemalloc
+from collections import namedtuple
+import pandas as pd
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import studies
+from studies.studydataset import StudyDataset
+from src import postprocessing, tdd, pandas_helper
+from src.find_periods import find_periods
+from src.surrounding_rows import SurroundingRows
+from src.manifest import code_version, write_json_atomic
+from src.synthetic import generate, STUDY_FOLDERS
+
+#patients and days of the synthetic data
+SCALES = {'tiny': {'patients': 2, 'days': 1},
+          'small': {'patients': 5, 'days': 7},
+          'medium': {'patients': 20, 'days': 30},
+          'large': {'patients': 50, 'days': 90}}
+#the study used by the benchmarks of the processing functions
+REFERENCE_STUDY = 'DCLP3'
+DCLP3_TABLES = {'bolus': 'Pump_BolusDelivered.txt', 'basal': 'Pump_BasalRateChange.txt', 'cgm': 'Pump_CGMGlucoseValue.txt'}
+SYNTHETIC_CODE = [os.path.join(os.path.dirname(__file__), '..', 'src', name) for name in ['synthetic.py', 'xport.py']]
+
+def _read_json(file_path):
+    with open(file_path) as f:
+        return json.load(f)
+
+Benchmark = namedtuple('Benchmark', ['name', 'setup', 'run'])
+BENCHMARKS = {}
+
+def benchmark(name, setup=None):
+    """Registers the decorated function as benchmark.
+
+    Args:
+        name (str): The benchmark name (`<group>.<name>`).
+        setup (callable, optional): Called with the `Context` before each repetition (not measured), returns the
+            arguments of the benchmark as tuple.
+    """
+    def register(run):
+        BENCHMARKS[name] = Benchmark(name, setup, run)
+        return run
+    return register
+
+class Context:
+    """The synthetic data of a scale, generated on first use (cached on disk) and the extracted histories (cached in memory)."""
+    def __init__(self, data_path, scale, seed=0):
+        self.scale = scale
+        self.params = {**SCALES[scale], 'seed': seed}
+        self.root = os.path.join(data_path, scale, 'data')
+        self.raw_path = os.path.join(self.root, 'raw')
+        #loop converts its raw tables to parquet files in data/temp
+        self.temp_path = os.path.join(self.root, 'temp')
+        self._cache = {}
+
+    def study_path(self, study):
+        """Returns the raw folder of a study, the data is generated if missing or outdated."""
+        path = os.path.join(self.raw_path, STUDY_FOLDERS[study])
+        marker = os.path.join(self.root, f"{study}.json")
+        version = {**self.params, 'code': code_version(SYNTHETIC_CODE)}
+        if not os.path.exists(marker) or _read_json(marker) != version:
+            shutil.rmtree(path, ignore_errors=True)
+            if study == 'Loop':
+                shutil.rmtree(self.temp_path, ignore_errors=True)
+            generate(self.raw_path, [study], patients=self.params['patients'], days=self.params['days'], seed=self.params['seed'])
+            write_json_atomic(version, marker)
+        return path
+
+    def dataset(self, study):
+        """Returns a new instance of a study (no data loaded)."""
+        return getattr(studies, study)(study_path=self.study_path(study))
+
+    def history(self, study, stream):
+        """Returns an extracted history (see `StudyDataset.HISTORIES`)."""
+        return self._cached(('history', study, stream), lambda: getattr(self.dataset(study), f"extract_{stream}")())
+
+    def raw_table(self, name):
+        """Returns a raw table of the reference study with parsed datetimes."""
+        def read():
+            df = pd.read_csv(os.path.join(self.study_path(REFERENCE_STUDY), 'Data Files', DCLP3_TABLES[name]), sep='|')
+            return df.assign(DataDtTm=pd.to_datetime(df.DataDtTm))
+        return self._cached(('raw', name), read)
+
+    def _cached(self, key, fun):
+        if key not in self._cache:
+            self._cache[key] = fun()
+        return self._cache[key]
+
+#loaders
+
+def load_setup(study):
+    def setup(context):
+        #loop converts the raw tables only once, remove the parquet files to include the conversion
+        if study == 'Loop':
+            shutil.rmtree(context.temp_path, ignore_errors=True)
+        return (context.dataset(study),)
+    return setup
+
+def extract_setup(study, stream):
+    def setup(context):
+        dataset = context.dataset(study)
+        dataset.load_data(streams=[stream])
+        return (dataset,)
+    return setup
+
+for _study in STUDY_FOLDERS:
+    benchmark(f"load.{_study}", load_setup(_study))(lambda dataset: dataset.load_data())
+    for _stream in StudyDataset.HISTORIES:
+        benchmark(f"extract.{_study}.{_stream}", extract_setup(_study, _stream))(
+            lambda dataset, stream=_stream: getattr(dataset, f"extract_{stream}")())
+
+#processing functions
+
+def patients(stream, columns):
+    """Setup returning the per patient frames (sorted by time) of a history of the reference study."""
+    def setup(context):
+        df = context.history(REFERENCE_STUDY, stream)
+        return ([group[columns].sort_values('datetime', kind='stable', ignore_index=True)
+                 for _, group in df.groupby('patient_id', observed=True)],)
+    return setup
+
+def histories(*streams):
+    def setup(context):
+        return tuple(context.history(REFERENCE_STUDY, stream) for stream in streams)
+    return setup
+
+def raw_tables(*names):
+    def setup(context):
+        return tuple(context.raw_table(name) for name in names)
+    return setup
+
+@benchmark('postprocessing.bolus_transform', patients('bolus_event_history', ['datetime', 'bolus', 'delivery_duration']))
+def bolus_transform(dfs):
+    for df in dfs:
+        postprocessing.bolus_transform(df)
+
+@benchmark('postprocessing.cgm_transform', patients('cgm_history', ['datetime', 'cgm']))
+def cgm_transform(dfs):
+    for df in dfs:
+        postprocessing.cgm_transform(df)
+
+@benchmark('postprocessing.basal_transform', patients('basal_event_history', ['datetime', 'basal_rate']))
+def basal_transform(dfs):
+    for df in dfs:
+        postprocessing.basal_transform(df)
+
+@benchmark('tdd.calculate_daily_basal_dose', patients('basal_event_history', ['datetime', 'basal_rate']))
+def calculate_daily_basal_dose(dfs):
+    for df in dfs:
+        tdd.calculate_daily_basal_dose(df)
+
+@benchmark('tdd.calculate_daily_bolus_dose', patients('bolus_event_history', ['datetime', 'bolus']))
+def calculate_daily_bolus_dose(dfs):
+    for df in dfs:
+        tdd.calculate_daily_bolus_dose(df)
+
+@benchmark('tdd.calculate_tdd', histories('bolus_event_history', 'basal_event_history'))
+def calculate_tdd(df_bolus, df_basal):
+    tdd.calculate_tdd(df_bolus, df_basal)
+
+@benchmark('find_periods.extended_boluses', raw_tables('bolus'))
+def find_extended_boluses(df):
+    #as used by the DCLP loaders to match standard and extended boluses
+    for _, group in df.groupby('PtID'):
+        find_periods(group, 'BolusType', 'DataDtTm', lambda x: x == 'Standard', lambda x: x == 'Extended', use_last_start_occurence=True)
+
+@benchmark('pandas_helper.get_duplicated_max_indexes', raw_tables('cgm'))
+def get_duplicated_max_indexes(df):
+    pandas_helper.get_duplicated_max_indexes(df, ['PtID', 'DataDtTm'], 'CGMValue')
+
+@benchmark('pandas_helper.deduplicate', raw_tables('basal'))
+def deduplicate(df):
+    pandas_helper.deduplicate(df, [pandas_helper.DuplicatePolicy(['PtID', 'DataDtTm', 'CommandedBasalRate']),
+                                   pandas_helper.DuplicatePolicy(['PtID', 'DataDtTm'], 'max', 'RecID')])
+
+@benchmark('pandas_helper.count_differences_in_duplicates', raw_tables('basal'))
+def count_differences_in_duplicates(df):
+    pandas_helper.count_differences_in_duplicates(df, ['PtID', 'DataDtTm'])
+
+@benchmark('pandas_helper.get_min_max_duplicates', raw_tables('cgm'))
+def get_min_max_duplicates(df):
+    pandas_helper.get_min_max_duplicates(df, ['PtID', 'DataDtTm'], 'CGMValue')
+
+@benchmark('pandas_helper.duplicate_report', raw_tables('basal'))
+def duplicate_report(df):
+    pandas_helper.duplicate_report(df, ['PtID', 'DataDtTm'])
+
+@benchmark('pandas_helper.grouped_value_counts', raw_tables('basal'))
+def grouped_value_counts(df):
+    pandas_helper.grouped_value_counts(df, 'PtID', 'CommandedBasalRate')
+
+@benchmark('pandas_helper.extract_surrounding_rows', raw_tables('cgm'))
+def extract_surrounding_rows(df):
+    #the neighborhoods of the first 20 duplicated readings
+    for index in df.index[df.duplicated(['PtID', 'DataDtTm'], keep=False)][:20]:
+        pandas_helper.extract_surrounding_rows(df, index, 3, ['PtID', 'DataDtTm'])
+
+@benchmark('surrounding_rows.SurroundingRows', raw_tables('cgm'))
+def surrounding_rows(df):
+    #the same neighborhoods, sorting once
+    rows = SurroundingRows(df, ['PtID', 'DataDtTm'])
+    for index in df.index[df.duplicated(['PtID', 'DataDtTm'], keep=False)][:20]:
+        rows.get(index, 3)
+    rows.get_many(df.index[df.duplicated(['PtID', 'DataDtTm'], keep=False)], 3)
+
+@benchmark('pandas_helper.sort_by_patient', raw_tables('cgm'))
+def sort_by_patient(df):
+    pandas_helper.sort_by_patient(df, 'PtID')
+
+@benchmark('pandas_helper.filter_shared_patients', raw_tables('bolus', 'basal', 'cgm'))
+def filter_shared_patients(df_bolus, df_basal, df_cgm):
+    pandas_helper.filter_shared_patients([df_bolus, df_basal, df_cgm], 'PtID')
+
+@benchmark('pandas_helper.split_sequences', raw_tables('bolus'))
+def split_sequences(df):
+    pandas_helper.split_sequences(df, 'BolusType')
+
+@benchmark('pandas_helper.overlaps', patients('bolus_event_history', ['datetime', 'delivery_duration']))
+def overlaps(dfs):
+    for df in dfs:
+        pandas_helper.overlaps(df, 'datetime', 'delivery_duration')
+
+#runner
+
+def select(pattern=None):
+    """Returns the benchmarks whose name matches the regular expression (all if None)."""
+    return [bench for name, bench in BENCHMARKS.items() if pattern is None or re.search(pattern, name)]
+
+def measure(bench, context, repeat=3):
+    """Runs a benchmark `repeat` times and once more with memory tracing.
+
+    Returns:
+        seconds (float): The median wall time.
+        memory_mb (float): The peak python memory allocated by the benchmark (without its setup).
+    """
+    seconds = []
+    for _ in range(repeat):
+        args = bench.setup(context) if bench.setup else ()
+        start = time.perf_counter()
+        bench.run(*args)
+        seconds.append(time.perf_counter() - start)
+        del args
+    #tracing slows down the benchmark, the memory is measured in a separate run
+    args = bench.setup(context) if bench.setup else ()
+    gc.collect()
+    tracemalloc.start()
+    try:
+        bench.run(*args)
+        memory = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return sorted(seconds)[len(seconds) // 2], memory / 2**20
+
+def find_threshold(thresholds, name, scale):
+    """Returns the first threshold (dict with optional `seconds` and `memory_mb`) matching a benchmark and scale or None."""
+    for name_pattern, scales in thresholds.items():
+        if fnmatch.fnmatchcase(name, name_pattern):
+            for scale_pattern, threshold in scales.items():
+                if fnmatch.fnmatchcase(scale, scale_pattern):
+                    return threshold
+    return None
+
+def check_thresholds(results, thresholds):
+    """Compares results with the thresholds.
+
+    Args:
+        results (pd.DataFrame): The results with columns `benchmark`, `scale`, `seconds`, `memory_mb` and `error`.
+        thresholds (dict): The thresholds (see the module documentation).
+
+    Returns:
+        results (pd.DataFrame): The results with the columns `max_seconds`, `max_memory_mb` and `status`
+            ('ok', 'slow', 'memory', 'slow+memory', 'error').
+    """
+    rows = []
+    for row in results.to_dict('records'):
+        threshold = find_threshold(thresholds, row['benchmark'], row['scale']) or {}
+        row['max_seconds'], row['max_memory_mb'] = threshold.get('seconds'), threshold.get('memory_mb')
+        exceeded = [label for label, value, limit in [('slow', row['seconds'], row['max_seconds']), ('memory', row['memory_mb'], row['max_memory_mb'])]
+                    if limit is not None and pd.notna(value) and value > limit]
+        row['status'] = 'error' if pd.notna(row.get('error')) else '+'.join(exceeded) or 'ok'
+        rows.append(row)
+    return pd.DataFrame(rows, columns=[*results.columns, 'max_seconds', 'max_memory_mb', 'status'])
+
+def run(scales, pattern=None, repeat=3, data_path='data/benchmarks', thresholds=None, seed=0, verbose=False):
+    """Runs the selected benchmarks at the given scales.
+
+    Args:
+        scales (list): Names of the scales (see `SCALES`).
+        pattern (str, optional): Regular expression selecting the benchmarks. Defaults to all.
+        repeat (int): Number of measured runs of each benchmark (the median is reported).
+        data_path (str): Folder of the synthetic data.
+        thresholds (dict, optional): The thresholds to check (see the module documentation).
+        seed (int): Seed of the synthetic data.
+        verbose (bool): Print each result.
+
+    Returns:
+        results (pd.DataFrame): One row per benchmark and scale (see `check_thresholds`).
+    """
+    unknown = set(scales).difference(SCALES)
+    if unknown:
+        raise ValueError(f"Unknown scales {sorted(unknown)}, must be in {list(SCALES)}")
+    results = []
+    for scale in scales:
+        context = Context(data_path, scale, seed)
+        for bench in select(pattern):
+            try:
+                seconds, memory = measure(bench, context, repeat)
+                error = None
+            except Exception as e:
+                seconds, memory, error = None, None, f"{type(e).__name__}: {e}"
+            results.append({'benchmark': bench.name, 'scale': scale, 'seconds': seconds, 'memory_mb': memory, 'error': error})
+            if verbose:
+                print(f"{bench.name:55} {scale:7} " + (f"{seconds:8.3f}s {memory:9.1f} MB" if error is None else error))
+    results = pd.DataFrame(results, columns=['benchmark', 'scale', 'seconds', 'memory_mb', 'error'])
+    return check_thresholds(results, thresholds or {})
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the loaders and processing functions on synthetic data.")
+    parser.add_argument('--scales', nargs='+', default=['small'], choices=list(SCALES), help="Scales of the synthetic data.")
+    parser.add_argument('--filter', help="Regular expression selecting the benchmarks by name.")
+    parser.add_argument('--repeat', type=int, default=3, help="Number of runs per benchmark (the median is reported).")
+    parser.add_argument('--thresholds', default=os.path.join(os.path.dirname(__file__), 'thresholds.json'),
+                        help="Json file with the time and memory thresholds.")
+    parser.add_argument('--data', default='data/benchmarks', help="Folder of the synthetic data.")
+    parser.add_argument('--seed', type=int, default=0, help="Seed of the synthetic data.")
+    parser.add_argument('--list', action='store_true', help="List the benchmarks and exit.")
+    parser.add_argument('--report', help="Optional csv file to save the results to.")
+    args = parser.parse_args()
+    #deprecation warnings of the loaders clutter the results
+    warnings.simplefilter('ignore')
+    if args.list:
+        print('\n'.join(bench.name for bench in select(args.filter)))
+        sys.exit(0)
+    thresholds = _read_json(args.thresholds) if args.thresholds and os.path.exists(args.thresholds) else {}
+    results = run(args.scales, args.filter, args.repeat, args.data, thresholds, args.seed, verbose=True)
+    if args.report:
+        results.to_csv(args.report, index=False)
+    failed = results[results.status != 'ok']
+    for row in failed.itertuples():
+        print(f"FAILED {row.benchmark} ({row.scale}): {row.error if row.status == 'error' else f'{row.seconds:.3f}s (max {row.max_seconds}), {row.memory_mb:.1f} MB (max {row.max_memory_mb})'}")
+    sys.exit(1 if len(failed) else 0)
@@ -51,16 +51,24 @@ The outptut format is standardized across all studies and follows the definition
 ### Output Files:
 For each study, the dataframes are saved in the `data/out/<study-name>/` folder:
  - To reduce file size, the data is saved in a compressed format using the `gzip`
+ - Alternatively, `--output-format` writes csv, parquet or feather files with the same columns (parquet and feather are sorted by patient)
  - datetimes and timedeltas are saved as unix timestamps (seconds) and integers (seconds) respectively.
  - boluses and basals are rounded to 4 decimal places
  - cgm values are converted to integers
 
 """
 import os
+import functools
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from multiprocessing import Manager
 from studies import IOBP2,Flair,PEDAP,DCLP3,DCLP5,Loop,StudyDataset,T1DEXI,T1DEXIP, ReplaceBG
+from studies.studydataset import set_validation_mode, VALIDATION_MODES, BackgroundWriter, OUTPUT_FORMATS
 
 import src.postprocessing as pp
 from src.logger import Logger
+from src.manifest import Manifest, fingerprint_files, code_version
+from src import instrumentation
 from datetime import datetime
 from tqdm import tqdm
 import argparse
@@ -68,16 +76,47 @@ from time import time
 
 logger = Logger.get_logger(__file__)
 
+#studies that need a lot of memory, the scheduler never runs two of them at the same time
+LARGE_STUDIES = (Loop, T1DEXI)
+
+#a study folder processed by a worker (streams=None processes all streams)
+StudyTask = namedtuple('StudyTask', ['folder', 'study_class', 'streams'])
+
+#progress messages and labels of the streams
+STREAM_STEPS = {'bolus_event_history': ('Extracting boluses', 'Boluses extracted'),
+                'basal_event_history': ('Extracting basals', 'Basal extracted'),
+                'cgm_history': ('Extracting glucose', 'CGM extracted')}
+
 def current_time():
   return datetime.now().strftime("%H:%M:%S")
 
+#the code that determines the output (used to detect changes since the last run)
+CODE_PATHS = [os.path.join(os.path.dirname(os.path.abspath(__file__)), 'studies'), os.path.join(os.path.dirname(os.path.abspath(__file__)), 'src')]
+
+def task_name(task):
+  return task.folder if task.streams is None else f"{task.folder} ({', '.join(task.streams)})"
+
+def num_task_steps(task):
+  return 1 + len(StudyDataset.HISTORIES if task.streams is None else task.streams)
 
-def main(load_subset=False):
+
+def main(load_subset=False, max_load_workers=None, validation_mode='strict', workers=1, parallel_streams=False, force=False, output_format='csv.gz', compression=None, 
+         trace_memory=False, profile=None):
   """
   Main function to process study data folders.
 
   Args:
     load_subset (bool): If True, runs the script on a limited amount of data (e.g. skipping rows)
+    max_load_workers (int): Maximum number of raw tables read concurrently per study. Defaults to None (thread pool default).
+    validation_mode (str): How extracted data is validated: 'strict', 'sampled' or 'off' (see `studies.studydataset.set_validation_mode`).
+    workers (int): Number of worker processes. With 1 (default), studies are processed one after another in this process.
+    parallel_streams (bool): With more than one worker, process the streams of a study as separate tasks (each loads only the tables it needs).
+    force (bool): Reprocess all studies, even if their output is up to date (see `src.manifest.Manifest`).
+    output_format (str): The output file format: 'csv', 'csv.gz' (default), 'csv.zst', 'parquet' or 'feather' (see `studies.studydataset.save_output`).
+    compression (dict, optional): Compression `level`, `threads` and `index` of the csv formats (see `studies.studydataset.csv_compression`).
+    trace_memory (bool): Record the peak python memory of each stage in the stage report (slow, see `src.instrumentation`).
+    profile (dict, optional): Profile stages with cProfile and tracemalloc, `studies`, `stages` and `top` select what is profiled 
+      (see `src.instrumentation.enable_profiling`). The results are written to `data/profiles/<run time>`. Defaults to None (no profiling).
   
   Logs:
     - Information about the current working directory and paths being used.
@@ -90,15 +129,22 @@ def main(load_subset=False):
     2. Identifies study folders in the input path.
     3. Matches study folders to predefined patterns and logs unmatched folders.
     4. Processes each matched study folder and logs the progress using `tqdm`.
+    5. Writes a report with the time and memory of each stage (load, extract, validate, save) to `data/reports`.
   """
 
-  #run_time = datetime.now().strftime("%Y-%m-%d_%H:%M:%S")
+  run_time = datetime.now()
   current_dir = os.getcwd()
   in_path = os.path.join(current_dir, 'data/raw')
   out_path = os.path.join(current_dir, 'data/out')
 
   if load_subset:
      logger.warning(f"ATTENTION: --test was provided: Running in test mode using a subset of the data.")
+  set_validation_mode(validation_mode)
+  instrumentation.enable(trace_memory)
+  if profile is not None:
+    profile = {**profile, 'out_path': os.path.join(current_dir, 'data', 'profiles', run_time.strftime("%Y-%m-%d_%H-%M-%S"))}
+    instrumentation.enable_profiling(**profile)
+    logger.info(f"Profiling {profile.get('studies') or 'all studies'} ({profile.get('stages') or 'all stages'}), results are written to {profile['out_path']}")
 
   logger.info(f"Looking for study folders in {in_path} and saving results to {out_path}")
 
@@ -140,62 +186,256 @@ def main(load_subset=False):
       logger.info(f'\'{folder}\' using {study_class.__name__} class')
   logger.info("")
 
-  num_steps_per_folder = 4
-  with tqdm(total=len(matched_folders)*num_steps_per_folder, desc=f"Processing studies", bar_format='Step {n_fmt}/{total_fmt} [{desc}]:|{bar}', unit="step", leave=False) as progress:
-    for folder, study_class in matched_folders:
-      tqdm.write(f"[{current_time()}] Processing {folder} ...")
+  # Skip streams that are up to date (same raw data, code and options as in the manifest of the last run)
+  code = code_version(CODE_PATHS)
+  options = {'load_subset': load_subset, 'output_format': output_format, 'compression': compression}
+  manifests = {}
+  pending = []
+  for folder, study_class in matched_folders:
+      manifest = Manifest.load(os.path.join(out_path, folder), study_class.__name__, fingerprint_files(os.path.join(in_path, folder)), code, options)
+      streams = list(StudyDataset.HISTORIES) if force else manifest.pending_streams(StudyDataset.HISTORIES)
+      if not streams:
+          logger.info(f"Skipping '{folder}', the output is up to date (use --force to reprocess)")
+          continue
+      if len(streams) < len(StudyDataset.HISTORIES):
+          logger.info(f"Resuming '{folder}' with {streams}")
+      manifests[folder] = manifest
+      pending.append(StudyTask(folder, study_class, None if len(streams) == len(StudyDataset.HISTORIES) else streams))
+
+  if workers > 1:
+    tasks = [StudyTask(task.folder, task.study_class, [stream]) for task in pending for stream in (task.streams or StudyDataset.HISTORIES)] if parallel_streams else pending
+    run_parallel(tasks, in_path, out_path, workers, manifests, load_subset=load_subset, max_load_workers=max_load_workers, 
+                 validation_mode=validation_mode, output_format=output_format, compression=compression, trace_memory=trace_memory, 
+                 profile=profile)
+  else:
+    process_sequential(pending, in_path, out_path, manifests, load_subset=load_subset, max_load_workers=max_load_workers, 
+                       output_format=output_format, compression=compression)
+
+  instrumentation.disable_profiling()
+  stages = instrumentation.disable()
+  if stages:
+    report_path = os.path.join(current_dir, 'data', 'reports', run_time.strftime("%Y-%m-%d_%H-%M-%S"))
+    instrumentation.write_report(report_path, stages, started=run_time.isoformat(timespec='seconds'), workers=workers, 
+                                 options={'load_subset': load_subset, 'validation_mode': validation_mode, 'output_format': output_format, 
+                                          'compression': compression, 'parallel_streams': parallel_streams})
+    logger.info(f"Stage report written to {report_path}.json and {report_path}.csv")
+
+def process_sequential(pending, in_path, out_path, manifests, load_subset, max_load_workers, output_format, compression):
+  """Processes study tasks one after another in this process (see `main`)."""
+  with tqdm(total=sum(num_task_steps(task) for task in pending), desc=f"Processing studies", bar_format='Step {n_fmt}/{total_fmt} [{desc}]:|{bar}', unit="step", leave=False) as progress:
+    for task in pending:
+      tqdm.write(f"[{current_time()}] Processing {task_name(task)} ...")
       
-      study_output_path = os.path.join(out_path, folder)
+      study_output_path = os.path.join(out_path, task.folder)
       if not os.path.exists(study_output_path):
           os.makedirs(study_output_path)
       
       start_time = time()
-      study = study_class(study_path=os.path.join(in_path, folder))
-      process_folder(study, study_output_path, progress, load_subset=load_subset)
-      tqdm.write(f"[{current_time()}] {folder} completed in {time() - start_time:.2f} seconds.")
+      study = task.study_class(study_path=os.path.join(in_path, task.folder), max_load_workers=max_load_workers, auto_release=True)
+      process_folder(study, study_output_path, progress, load_subset=load_subset, streams=task.streams, 
+                     on_saved=manifests[task.folder].complete_stream, output_format=output_format, compression=compression)
+      tqdm.write(f"[{current_time()}] {task.folder} completed in {time() - start_time:.2f} seconds.")
 
     tqdm.write("Processing complete.")
 
-def process_folder(study: StudyDataset, out_path_study, progress, load_subset):
+def schedule(tasks, executor, run, max_workers, is_large, poll=lambda: None, poll_interval=0.2):
+  """Runs tasks on an executor, never running two large tasks at the same time.
+
+  Large tasks are started first, the remaining slots are filled with small tasks.
+
+  Args:
+    tasks (list): The tasks to run.
+    executor (concurrent.futures.Executor): The executor (e.g. a process pool).
+    run (callable): Called with a task in the executor, must be picklable for process pools.
+    max_workers (int): Maximum number of tasks running at the same time.
+    is_large (callable): Returns True if a task needs a lot of memory.
+    poll (callable): Called regularly while waiting for tasks (e.g. to update the progress).
+    poll_interval (float): Seconds between calls to `poll`.
+
+  Yields:
+    result (tuple): `(task, result)` for each task as it completes. Exceptions of tasks are raised.
+  """
+  pending = sorted(tasks, key=lambda task: not is_large(task))
+  running = {}
+  while pending or running:
+    large_running = any(is_large(task) for task in running.values())
+    for task in list(pending):
+      if len(running) >= max_workers:
+        break
+      if is_large(task) and large_running:
+        continue
+      running[executor.submit(run, task)] = task
+      pending.remove(task)
+      large_running = large_running or is_large(task)
+    done, _ = wait(running, timeout=poll_interval, return_when=FIRST_COMPLETED)
+    poll()
+    for future in done:
+      yield running.pop(future), future.result()
+
+def run_parallel(tasks, in_path, out_path, workers, manifests, **options):
+  """Processes study tasks in a process pool with a combined progress bar.
+
+  Each task logs to its own file in `data/logs` (next to the output folder), Loop and T1DEXI are never processed 
+  at the same time (see `LARGE_STUDIES`).
+
+  Args:
+    tasks (list of StudyTask): The tasks to process.
+    in_path (str): Folder containing the raw study folders.
+    out_path (str): Folder to write the output to.
+    workers (int): Number of worker processes.
+    manifests (dict): Maps study folders to their `Manifest`, updated by this process as tasks complete.
+    **options: `load_subset`, `max_load_workers`, `validation_mode`, `output_format`, `compression`, `trace_memory` and `profile` (see `main`).
+  """
+  log_path = os.path.join(os.path.dirname(out_path), 'logs')
+  os.makedirs(log_path, exist_ok=True)
+  logger.info(f"Processing {len(tasks)} tasks using {workers} workers, logs are written to {log_path}")
+
+  with Manager() as manager, ProcessPoolExecutor(max_workers=workers) as executor, \
+       tqdm(total=sum(num_task_steps(task) for task in tasks), desc=f"Processing studies", bar_format='Step {n_fmt}/{total_fmt} [{desc}]:|{bar}', unit="step", leave=False) as progress:
+    queue = manager.Queue()
+    poll = functools.partial(apply_progress_messages, queue, progress)
+    run = functools.partial(process_task, in_path=in_path, out_path=out_path, log_path=log_path, progress_queue=queue, **options)
+    try:
+      for task, (elapsed, records, stages) in schedule(tasks, executor, run, workers, lambda task: task.study_class in LARGE_STUDIES, poll=poll):
+        for record in records:
+          manifests[task.folder].complete_stream(*record)
+        instrumentation.add_records(stages)
+        tqdm.write(f"[{current_time()}] {task_name(task)} completed in {elapsed:.2f} seconds.")
+    except Exception:
+      executor.shutdown(wait=False, cancel_futures=True)
+      raise
+    poll()
+    tqdm.write("Processing complete.")
+
+def process_task(task, in_path, out_path, log_path, progress_queue, load_subset=False, max_load_workers=None, validation_mode='strict', output_format='csv.gz', 
+                 compression=None, trace_memory=False, profile=None):
+  """Processes a study task in a worker process (see `run_parallel`).
+
+  Returns:
+    result (tuple): `(elapsed, records, stages)`, the processing time in seconds, the completed streams 
+      `(stream, file_path, rows, seconds)` to be recorded in the manifest by the main process and the stage records 
+      of the task (see `src.instrumentation`).
+  """
+  start_time = time()
+  set_validation_mode(validation_mode)
+  instrumentation.enable(trace_memory)
+  if profile is not None:
+    instrumentation.enable_profiling(**profile)
+  log_name = task.folder if task.streams is None else f"{task.folder}_{'_'.join(task.streams)}"
+  Logger.redirect_to_file(os.path.join(log_path, f"{log_name}.log"))
+
+  study_output_path = os.path.join(out_path, task.folder)
+  os.makedirs(study_output_path, exist_ok=True)
+  progress = QueueProgress(progress_queue)
+  progress.write(f"[{current_time()}] Processing {task_name(task)} ...")
+  study = task.study_class(study_path=os.path.join(in_path, task.folder), max_load_workers=max_load_workers, auto_release=True)
+  records = []
+  process_folder(study, study_output_path, progress, load_subset=load_subset, streams=task.streams, 
+                 on_saved=lambda *record: records.append(record), output_format=output_format, compression=compression)
+  instrumentation.disable_profiling()
+  return time() - start_time, records, instrumentation.disable()
+
+class QueueProgress:
+  """Stands in for the tqdm progress bar in worker processes, forwards the progress to the main process (see `apply_progress_messages`)."""
+  def __init__(self, queue):
+    self.queue = queue
+  def set_description_str(self, desc):
+    self.queue.put(('set_description_str', desc))
+  def update(self, n=1):
+    self.queue.put(('update', n))
+  def write(self, message):
+    self.queue.put(('write', message))
+
+def apply_progress_messages(queue, progress):
+  """Applies the progress messages sent by `QueueProgress` instances to the progress bar."""
+  while not queue.empty():
+    method, arg = queue.get()
+    if method == 'write':
+      tqdm.write(arg)
+    else:
+      getattr(progress, method)(arg)
+
+def process_folder(study: StudyDataset, out_path_study, progress, load_subset, streams=None, on_saved=None, output_format='csv.gz', compression=None):
       """Processes the data for a given study by loading, extracting, and resampling bolus, basal, and glucose events.
 
         Args:
           study (object): An instance of a study class that contains methods to load and extract data.
           out_path_study (str): The output directory path where the processed data will be saved.
-          progress (tqdm): A tqdm progress bar object to display the progress of the processing steps.
+          progress (tqdm): A tqdm progress bar object (or `QueueProgress` in worker processes) to display the progress of the processing steps.
+          load_subset (bool): If True, only a subset of the data is loaded.
+          streams (list, optional): The streams to process (see `StudyDataset.HISTORIES`). Defaults to all.
+          on_saved (callable, optional): Called with `(stream, file_path, rows, seconds)` after the file of a stream was written 
+            (e.g. `Manifest.complete_stream`).
+          output_format (str, optional): The output file format (see `studies.studydataset.OUTPUT_FORMATS`). Defaults to 'csv.gz'.
+          compression (dict, optional): Compression `level` and `threads` of the csv formats. Defaults to None.
         
         Steps:
-          1. Loads the study data.
+          1. Loads the study data (only the tables needed for the streams).
           2. Extracts bolus event history and saves it as a CSV file.
           3. Extracts basal event history and saves it as a CSV file.
           4. Extracts continuous glucose monitoring (CGM) history and saves it as a CSV file.
-          Each step updates the progress bar and logs the current status.
+          Each step updates the progress bar and logs the current status. The files are written by a `BackgroundWriter`, 
+          so compressing one stream overlaps with extracting the next one.
         """
-      progress.set_description_str(f"{study.__class__.__name__}: (Loading data)")
-      study.load_data(subset=load_subset)
-      progress.update(1)
-      tqdm.write(f"[{current_time()}] [x] Data loaded"); 
-
-      #boluses
-      progress.set_description_str(f"{study.__class__.__name__}: Extracting boluses")
-      study.save_bolus_event_history_to_file(out_path_study,True)
-      progress.update(1)
-      tqdm.write(f"[{current_time()}] [x] Boluses extracted"); 
-
-      #basals
-      progress.set_description_str(f"{study.__class__.__name__}: Extracting basals")
-      study.save_basal_event_history_to_file(out_path_study, True)
-      progress.update(1)
-      tqdm.write(f"[{current_time()}] [x] Basal extracted"); 
-
-      #cgm
-      progress.set_description_str(f"{study.__class__.__name__}: Extracting glucose")
-      study.save_cgm_to_file(out_path_study, True)
-      progress.update(1); tqdm.write(f"[{current_time()}] [x] CGM extracted"); 
+      streams = StudyDataset.HISTORIES if streams is None else streams
+      save_functions = {'bolus_event_history': study.save_bolus_event_history_to_file,
+                        'basal_event_history': study.save_basal_event_history_to_file,
+                        'cgm_history': study.save_cgm_to_file}
+
+      with instrumentation.stage('study', study=study.study_name, stream=','.join(streams)):
+        progress.set_description_str(f"{study.__class__.__name__}: (Loading data)")
+        study.load_data(subset=load_subset, streams=streams)
+        progress.update(1)
+        progress.write(f"[{current_time()}] [x] Data loaded"); 
+
+        def saved(stream, file_path, rows, start_time):
+          on_saved(stream, file_path, rows, time() - start_time)
+
+        #files are compressed and written in the background while the next stream is extracted
+        with BackgroundWriter(max_pending=1) as writer:
+          for stream in StudyDataset.HISTORIES:
+            if stream not in streams:
+              continue
+            description, done = STREAM_STEPS[stream]
+            progress.set_description_str(f"{study.__class__.__name__}: {description}")
+            start_time = time()
+            file_path = save_functions[stream](out_path_study, writer=writer, output_format=output_format, compression=compression)
+            if on_saved is not None:
+              #runs in the writer after the file was written
+              writer.submit(saved, stream, file_path, len(getattr(study, stream)), start_time)
+            progress.update(1)
+            progress.write(f"[{current_time()}] [x] {done}")
+          study.release(histories=True)
+          progress.set_description_str(f"{study.__class__.__name__}: (Writing files)")
       
 
 if __name__ == "__main__":
   parser = argparse.ArgumentParser(description="Run data normalization on raw study data.")
   parser.add_argument('--test', action='store_true', help="Run the script in test mode using test data.")
+  parser.add_argument('--load-workers', type=int, default=None, help="Maximum number of raw tables read concurrently per study (1 reads them sequentially).")
+  parser.add_argument('--validation', choices=VALIDATION_MODES, default='strict', help="How to validate the extracted data: check all values (strict), a sample (sampled) or nothing (off).")
+  parser.add_argument('--workers', type=int, default=1, help="Number of worker processes used to process studies in parallel (Loop and T1DEXI are never processed at the same time).")
+  parser.add_argument('--parallel-streams', action='store_true', help="With --workers > 1, also process the bolus, basal and cgm streams of a study in parallel.")
+  parser.add_argument('--force', action='store_true', help="Reprocess all studies, even if their output is up to date.")
+  parser.add_argument('--output-format', choices=OUTPUT_FORMATS, default='csv.gz', help="The output file format (parquet and feather files are sorted by patient).")
+  parser.add_argument('--compression-level', type=int, help="Compression level of csv.gz (1-9, default 9) and csv.zst (1-22, default 3) outputs.")
+  parser.add_argument('--compression-threads', type=int, default=1, help="Number of threads used to compress csv.gz (as block gzip) and csv.zst outputs.")
+  parser.add_argument('--trace-memory', action='store_true', help="Record the peak python memory of each stage in the stage report (slow).")
+  parser.add_argument('--profile', action='store_true', help="Profile the stages with cProfile and tracemalloc (pstats files and allocation summaries in data/profiles).")
+  parser.add_argument('--profile-studies', nargs='+', help="Only profile these studies (e.g. Flair Loop). Defaults to all.")
+  parser.add_argument('--profile-stages', nargs='+', choices=['study', 'load', 'extract', 'validate', 'save'], default=['load', 'extract', 'validate', 'save'],
+                      help="The stages to profile ('study' profiles the whole processing of a study in one file).")
+  parser.add_argument('--profile-top', type=int, default=20, help="Number of source lines in the allocation summaries.")
+  parser.add_argument('--index-patients', action='store_true', help="Compress csv.gz outputs per patient and write an index for random access by patient (see src.indexed_csv).")
   args = parser.parse_args()
-  main(load_subset=args.test)
\ No newline at end of file
+  compression = {}
+  if args.compression_level is not None:
+    compression['level'] = args.compression_level
+  if args.compression_threads > 1:
+    compression['threads'] = args.compression_threads
+  if args.index_patients:
+    compression['index'] = True
+  main(load_subset=args.test, max_load_workers=args.load_workers, validation_mode=args.validation, workers=args.workers, 
+       parallel_streams=args.parallel_streams, force=args.force, output_format=args.output_format, 
+       compression=compression or None, trace_memory=args.trace_memory, 
+       profile={'studies': args.profile_studies, 'stages': args.profile_stages, 'top': args.profile_top} if args.profile else None)
\ No newline at end of file
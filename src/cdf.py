@@ -1,7 +1,5 @@
 import numpy as np
 
-import matplotlib.pyplot as plt
-
 def get_cdf(data):
     """
     Get the Cumulative Distribution Function (CDF) of a data array.
@@ -37,6 +35,8 @@ def plot_cdf(data, title='CDF', xlabel='Value', ylabel='CDF', ax=None, **kwargs)
     
     # Plot the CDF
     if ax is None:
+        #matplotlib is only imported to create a new figure
+        import matplotlib.pyplot as plt
         plt.figure(figsize=(8, 2))
         ax = plt.gca()
 
@@ -59,4 +59,5 @@ def plot_cdf(data, title='CDF', xlabel='Value', ylabel='CDF', ax=None, **kwargs)
 if __name__ == '__main__':
     data = np.random.randn(1000)  # Generate some random data
     plot_cdf(data, title='CDF of Random Data', xlabel='Data Value', ylabel='CDF')
+    import matplotlib.pyplot as plt
     plt.show()
\ No newline at end of file
@@ -1,10 +1,7 @@
 from datetime import timedelta
-import matplotlib.pyplot as plt
 import numpy as np
-import importlib 
-from src import pandas_helper
-importlib.reload(pandas_helper)   
 from src.pandas_helper import get_hour_of_day
+#matplotlib is imported by the functions that need it, importing this module does not require it
     
 colors = {'Bolus': 'red', 'Basal': 'blue', 'CGM': 'darkgray'}
 
@@ -16,6 +13,7 @@ def create_axis():
         axes (matplotlib.axes.Axes): The created axis.
 
     """
+    import matplotlib.pyplot as plt
     fig, ax = plt.figure(figsize=(10, 2)), plt.gca()
     return fig, ax
 
@@ -172,5 +170,6 @@ def drawMovingAverage(ax, df, datetime_col, value_col, aggregator='mean', **kwar
     ax.scatter(ma['hod'], ma[value_col], **args)
     ax.set_xlabel('Hour of Day')
     ax.set_xticks(np.arange(0,24,4))
-    ax.xaxis.set_major_formatter(plt.FuncFormatter(lambda x, _: f'{int(x):02d}:00'))
+    from matplotlib.ticker import FuncFormatter
+    ax.xaxis.set_major_formatter(FuncFormatter(lambda x, _: f'{int(x):02d}:00'))
     ax.legend()
\ No newline at end of file
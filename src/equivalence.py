@@ -0,0 +1,266 @@
+import os
+import argparse
+import importlib
+import tempfile
+from collections import namedtuple
+import numpy as np
+import pandas as pd
+
+from src import reference
+from src.find_periods import Period
+from src.synthetic import generate, STUDY_FOLDERS
+
+SOURCES = ['fixtures', 'synthetic']
+
+#reference: the frozen original implementation (see src/reference.py), candidate: the implementation in use ('module:function')
+#to_frame(result, *args): converts the result to a dataframe, key: the column identifying a row in reports
+Function = namedtuple('Function', ['reference', 'candidate', 'to_frame', 'key'])
+Case = namedtuple('Case', ['function', 'source', 'patient_id', 'args', 'kwargs'])
+Difference = namedtuple('Difference', ['function', 'source', 'patient_id', 'row', 'key', 'column', 'expected', 'actual', 'message'])
+Result = namedtuple('Result', ['function', 'candidate', 'cases', 'difference'])
+
+def _frame(result, *args):
+    return result
+
+def _reset_index(result, *args):
+    return result.reset_index()
+
+def _basal_frame(result, df):
+    return pd.DataFrame({'datetime': df.DateTime.to_numpy(), 'basal_rate': result.reindex(df.index).to_numpy()})
+
+def _periods_frame(result, *args):
+    return pd.DataFrame(result, columns=list(Period._fields))
+
+FUNCTIONS = {'bolus_transform': Function(reference.bolus_transform, 'src.postprocessing:bolus_transform', _frame, 'datetime'),
+             'calculate_daily_basal_dose': Function(reference.calculate_daily_basal_dose, 'src.tdd:calculate_daily_basal_dose', _reset_index, 'date'),
+             'merge_basal_and_temp_basal': Function(reference.merge_basal_and_temp_basal, 'studies.flair:merge_basal_and_temp_basal', _basal_frame, 'datetime'),
+             'find_periods': Function(reference.find_periods, 'src.find_periods:find_periods', _periods_frame, 'time_start')}
+
+def resolve(candidate):
+    """Returns the function of a 'module:function' string (callables are returned as they are)."""
+    if callable(candidate):
+        return candidate
+    module, name = candidate.split(':')
+    return getattr(importlib.import_module(module), name)
+
+#triggers of the find_periods calls in the loaders
+
+def is_standard(value):
+    return value == 'Standard'
+
+def is_extended(value):
+    return value == 'Extended'
+
+def is_suspended(value):
+    return value != 'NORMAL_PUMPING'
+
+def is_normal_pumping(value):
+    return value == 'NORMAL_PUMPING'
+
+def fixture_cases():
+    """Returns small hand made cases covering the edge cases of each function (the patient id names the case)."""
+    minutes = lambda values: pd.to_timedelta(values, unit='min')
+    times = lambda values: pd.to_datetime(values, format='ISO8601')
+    boluses = {'standard_and_extended': pd.DataFrame({'datetime': times(['2020-01-01 08:02', '2020-01-01 08:04', '2020-01-01 23:50']),
+                                                      'bolus': [2.0, 1.0, 3.0], 'delivery_duration': minutes([0, 0, 30])}),
+               'bolus_at_midnight': pd.DataFrame({'datetime': times(['2020-01-02 00:00']), 'bolus': [1.0],
+                                                  'delivery_duration': minutes([0])}),
+               'odd_extended_duration': pd.DataFrame({'datetime': times(['2020-01-01 10:01:30', '2020-01-01 10:03']),
+                                                      'bolus': [0.9, 0.05], 'delivery_duration': minutes([12, 7])})}
+    basals = {'midnight_events': pd.DataFrame({'datetime': times(['2020-01-01 00:00', '2020-01-01 06:00', '2020-01-02 00:00', '2020-01-02 12:30']),
+                                               'basal_rate': [1.0, 0.5, 0.8, 1.2]}),
+              'missing_day': pd.DataFrame({'datetime': times(['2020-01-01 08:00', '2020-01-03 08:00']), 'basal_rate': [1.0, 0.5]}),
+              'single_event': pd.DataFrame({'datetime': times(['2020-01-01 12:00']), 'basal_rate': [0.7]})}
+    pump = pd.DataFrame({'DateTime': times(['2020-01-01 00:00', '2020-01-01 01:00', '2020-01-01 01:00', '2020-01-01 02:00',
+                                                     '2020-01-01 03:00:01', '2020-01-01 05:00', '2020-01-01 05:30', '2020-01-01 06:30']),
+                         'BasalRt': [1.0, np.nan, 1.0, 1.0, 0.8, np.nan, 0.8, 0.8],
+                         'TempBasalAmt': [np.nan, 50, np.nan, np.nan, np.nan, 0.3, np.nan, np.nan],
+                         'TempBasalType': [None, 'Percent', None, None, None, 'Rate', None, None],
+                         'TempBasalDur': [None, '02:00:00', None, None, None, '01:00:00', None, None]})
+    modes = pd.DataFrame({'AutoModeStatus': ['off', 'on', 'on', 'off', 'off', 'on', 'off', 'on', 'on', 'off'],
+                          'Time': np.arange(10.0)}, index=np.arange(10) + 1000)
+    with_nans = pd.DataFrame({'Suspend': ['NORMAL_PUMPING', 'SUSPEND', None, 'SUSPEND', 'NORMAL_PUMPING', 'SUSPEND'],
+                              'DateTime': times(['2020-01-01 00:00', '2020-01-01 01:00', '2020-01-01 01:30', None,
+                                                          '2020-01-01 03:00', '2020-01-01 04:00'])})
+    return ([Case('bolus_transform', 'fixtures', name, (df,), {}) for name, df in boluses.items()] +
+            [Case('calculate_daily_basal_dose', 'fixtures', name, (df,), {}) for name, df in basals.items()] +
+            [Case('merge_basal_and_temp_basal', 'fixtures', 'percent_and_rate', (pump,), {})] +
+            [Case('find_periods', 'fixtures', 'last_start_occurence', (modes, 'AutoModeStatus', 'Time', lambda x: x == 'on', lambda x: x == 'off'),
+                  {'use_last_start_occurence': True}),
+             Case('find_periods', 'fixtures', 'missing_values', (with_nans, 'Suspend', 'DateTime', is_suspended, is_normal_pumping), {})])
+
+def _patients(df, patient_col):
+    return [(str(patient_id), group.drop(columns=patient_col)) for patient_id, group in df.groupby(patient_col, observed=True)]
+
+def synthetic_cases(patients=3, days=7, seed=0):
+    """Returns per patient cases from synthetic DCLP3 and Flair data (see `src.synthetic`) as the loaders call the functions."""
+    #studies import src modules, import them only when needed
+    from studies import DCLP3, Flair
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        generate(tmp_dir, ['DCLP3', 'Flair'], patients=patients, days=days, seed=seed)
+        dclp3 = DCLP3(study_path=os.path.join(tmp_dir, STUDY_FOLDERS['DCLP3']))
+        flair = Flair(study_path=os.path.join(tmp_dir, STUDY_FOLDERS['Flair']))
+        histories = {'synthetic DCLP3': (dclp3.extract_bolus_event_history(), dclp3.extract_basal_event_history()),
+                     'synthetic Flair': (flair.extract_bolus_event_history(), flair.extract_basal_event_history())}
+    cases = []
+    for source, (bolus, basal) in histories.items():
+        bolus = bolus.sort_values(['patient_id', 'datetime'], kind='stable')
+        basal = basal.sort_values(['patient_id', 'datetime'], kind='stable')
+        cases += [Case('bolus_transform', source, patient_id, (df.reset_index(drop=True),), {}) for patient_id, df in _patients(bolus, 'patient_id')]
+        cases += [Case('calculate_daily_basal_dose', source, patient_id, (df.reset_index(drop=True),), {}) for patient_id, df in _patients(basal, 'patient_id')]
+    pump = flair.df_pump[['PtID', 'DateTime', 'BasalRt', 'TempBasalAmt', 'TempBasalType', 'TempBasalDur', 'Suspend']]
+    cases += [Case('merge_basal_and_temp_basal', 'synthetic Flair', patient_id, (df.drop(columns='Suspend'),), {}) for patient_id, df in _patients(pump, 'PtID')]
+    cases += [Case('find_periods', 'synthetic Flair', patient_id, (df.dropna(subset='Suspend'), 'Suspend', 'DateTime', is_suspended, is_normal_pumping), {})
+              for patient_id, df in _patients(pump, 'PtID')]
+    cases += [Case('find_periods', 'synthetic DCLP3', patient_id, (df, 'BolusType', dclp3.datetime_col, is_standard, is_extended), {'use_last_start_occurence': True})
+              for patient_id, df in _patients(dclp3.df_bolus, 'PtID')]
+    return cases
+
+def _equal(expected, actual, rtol, atol):
+    if expected.dtype.kind in 'iuf' and actual.dtype.kind in 'iuf':
+        return np.isclose(expected.astype(float), actual.astype(float), rtol=rtol, atol=atol, equal_nan=True)
+    equal = np.asarray(expected == actual, dtype=bool)
+    if equal.shape != expected.shape:
+        equal = np.zeros(len(expected), dtype=bool)
+    return equal | (pd.isna(expected) & pd.isna(actual))
+
+def _value(df, row, column):
+    if row is None or column is None or row >= len(df):
+        return None
+    return df[column].iloc[row]
+
+def compare_frames(expected, actual, key=None, rtol=1e-9, atol=1e-12):
+    """
+    Compares two dataframes column by column, ignoring the index.
+
+    Numbers are compared with tolerances (`np.isclose`), all other values exactly. Missing values are equal to each other.
+
+    Args:
+        expected (pd.DataFrame): The expected frame (e.g. the output of the reference implementation).
+        actual (pd.DataFrame): The actual frame.
+        key (str, optional): Column reported as key of the differing row (e.g. 'datetime').
+        rtol (float): Relative tolerance of numbers.
+        atol (float): Absolute tolerance of numbers.
+
+    Returns:
+        difference (Difference): The first differing row (without function, source and patient) or None if the frames are equal.
+    """
+    def difference(row, column, message):
+        keys = expected if row is not None and row < len(expected) else actual
+        return Difference(None, None, None, row, _value(keys, row, key if key in keys.columns else None), column,
+                          _value(expected, row, column), _value(actual, row, column), message)
+
+    if list(expected.columns) != list(actual.columns):
+        return difference(None, None, f"columns differ: {list(expected.columns)} != {list(actual.columns)}")
+    rows = min(len(expected), len(actual))
+    first = None
+    for column in expected.columns:
+        mismatch = ~_equal(expected[column].iloc[:rows].to_numpy(), actual[column].iloc[:rows].to_numpy(), rtol, atol)
+        if mismatch.any() and (first is None or np.argmax(mismatch) < first[0]):
+            first = (int(np.argmax(mismatch)), column)
+    if first is not None:
+        return difference(*first, 'values differ')
+    if len(expected) != len(actual):
+        return difference(rows, None, f"row counts differ: {len(expected)} != {len(actual)}")
+    return None
+
+def _call(function, case):
+    args = [arg.copy() if isinstance(arg, pd.DataFrame) else arg for arg in case.args]
+    try:
+        return function(*args, **case.kwargs), None
+    except Exception as e:
+        return None, e
+
+def compare_case(case, candidate=None, rtol=1e-9, atol=1e-12):
+    """Runs the reference and the candidate implementation on a case.
+
+    Args:
+        case (Case): The case.
+        candidate (callable or str, optional): The candidate implementation. Defaults to the one in `FUNCTIONS`.
+        rtol (float): Relative tolerance of numbers.
+        atol (float): Absolute tolerance of numbers.
+
+    Returns:
+        difference (Difference): The first difference or None. Cases where both implementations raise the same exception type are equal.
+    """
+    function = FUNCTIONS[case.function]
+    expected, expected_error = _call(function.reference, case)
+    actual, actual_error = _call(resolve(candidate or function.candidate), case)
+    if expected_error is not None or actual_error is not None:
+        if type(expected_error) is type(actual_error):
+            return None
+        difference = Difference(None, None, None, None, None, None, None, None, f"reference raised {expected_error!r}, candidate raised {actual_error!r}")
+    else:
+        difference = compare_frames(function.to_frame(expected, *case.args), function.to_frame(actual, *case.args), function.key, rtol, atol)
+    return difference and difference._replace(function=case.function, source=case.source, patient_id=case.patient_id)
+
+def check(functions=None, candidates=None, sources=None, patients=3, days=7, seed=0, rtol=1e-9, atol=1e-12):
+    """
+    Compares the reference and candidate implementations of functions on fixture and synthetic data.
+
+    Args:
+        functions (list, optional): Names of the functions (see `FUNCTIONS`). Defaults to all.
+        candidates (dict, optional): Candidate implementations by function name (callables or 'module:function' strings).
+            Defaults to the implementations in `FUNCTIONS`.
+        sources (list, optional): The input data, 'fixtures' and/or 'synthetic'. Defaults to both.
+        patients (int): Number of synthetic patients per study.
+        days (int): Days of synthetic data per patient.
+        seed (int): Seed of the synthetic data.
+        rtol (float): Relative tolerance of numbers.
+        atol (float): Absolute tolerance of numbers.
+
+    Returns:
+        results (list of Result): One result per function with the number of compared cases and the first difference (or None).
+    """
+    functions = list(FUNCTIONS) if functions is None else functions
+    unknown = set(functions).difference(FUNCTIONS)
+    if unknown:
+        raise ValueError(f"Unknown functions {sorted(unknown)}, must be in {list(FUNCTIONS)}")
+    sources = SOURCES if sources is None else sources
+    candidates = candidates or {}
+    cases = (fixture_cases() if 'fixtures' in sources else []) + (synthetic_cases(patients, days, seed) if 'synthetic' in sources else [])
+    results = []
+    for name in functions:
+        candidate = candidates.get(name, FUNCTIONS[name].candidate)
+        selected = [case for case in cases if case.function == name]
+        difference = next((d for d in (compare_case(case, candidate, rtol, atol) for case in selected) if d is not None), None)
+        results.append(Result(name, candidate if isinstance(candidate, str) else getattr(candidate, '__name__', repr(candidate)),
+                              len(selected), difference))
+    return results
+
+def format_difference(difference):
+    """Returns a one line description of a difference."""
+    d = difference
+    location = f"{d.function} ({d.source}), patient {d.patient_id}"
+    if d.row is not None:
+        location += f", row {d.row}" + (f" at {d.key}" if d.key is not None else '')
+    if d.column is not None:
+        location += f", column '{d.column}': expected {d.expected!r}, got {d.actual!r}"
+    return f"{location}: {d.message}"
+
+def assert_equivalent(function, candidate=None, **kwargs):
+    """Raises an AssertionError describing the first difference between the reference and candidate implementation (see `check`)."""
+    result, = check([function], {function: candidate} if candidate is not None else None, **kwargs)
+    if result.difference is not None:
+        raise AssertionError(format_difference(result.difference))
+    return result
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare optimized implementations with the frozen reference implementations.")
+    parser.add_argument('--functions', nargs='+', choices=list(FUNCTIONS), help="The functions to compare. Defaults to all.")
+    parser.add_argument('--candidate', action='append', default=[], metavar='FUNCTION=MODULE:NAME',
+                        help="Alternative candidate implementation, e.g. bolus_transform=src.postprocessing:bolus_transform.")
+    parser.add_argument('--sources', nargs='+', choices=SOURCES, default=SOURCES, help="The input data.")
+    parser.add_argument('--patients', type=int, default=3, help="Number of synthetic patients per study.")
+    parser.add_argument('--days', type=int, default=7, help="Days of synthetic data per patient.")
+    parser.add_argument('--seed', type=int, default=0, help="Seed of the synthetic data.")
+    parser.add_argument('--rtol', type=float, default=1e-9, help="Relative tolerance of numbers.")
+    parser.add_argument('--atol', type=float, default=1e-12, help="Absolute tolerance of numbers.")
+    args = parser.parse_args()
+    candidates = dict(candidate.split('=', 1) for candidate in args.candidate)
+    results = check(args.functions, candidates, args.sources, args.patients, args.days, args.seed, args.rtol, args.atol)
+    for result in results:
+        status = 'OK  ' if result.difference is None else 'DIFF'
+        print(f"{status} {result.function} ({result.candidate}, {result.cases} cases)" +
+              ('' if result.difference is None else f"\n     {format_difference(result.difference)}"))
+    raise SystemExit(int(any(result.difference is not None for result in results)))
@@ -0,0 +1,137 @@
+import io
+import os
+import gzip
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+from src.pandas_helper import sort_by_patient
+
+#the index of `file.csv.gz` is stored next to it in `file.csv.gz.index.csv`
+INDEX_SUFFIX = '.index.csv'
+
+def index_path(file_path):
+    """Returns the path of the sidecar index of an indexed csv file."""
+    return file_path + INDEX_SUFFIX
+
+def compress_blocks(blocks, level=9, threads=1):
+    """
+    Compresses blocks of bytes into independent gzip members.
+
+    Concatenated gzip members are a valid gzip file, it is read by gunzip, python's gzip module and pandas like a
+    single member file. Each member can also be decompressed on its own.
+
+    Args:
+        blocks (iterable of bytes): The uncompressed blocks.
+        level (int): The gzip compression level (1-9).
+        threads (int): Number of blocks compressed in parallel (zlib releases the GIL).
+
+    Yields:
+        member (bytes): The compressed blocks in the order of `blocks`.
+    """
+    if threads <= 1:
+        for block in blocks:
+            yield gzip.compress(block, level, mtime=0)
+        return
+    pending = deque()
+    with ThreadPoolExecutor(threads) as executor:
+        for block in blocks:
+            pending.append(executor.submit(gzip.compress, block, level, mtime=0))
+            if len(pending) >= threads:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+def save_indexed_csv(df, file_path, level=9, threads=1, patient_col='patient_id', datetime_col='datetime', convert=None):
+    """
+    Saves a history as gzip compressed csv with one gzip member per patient and a sidecar index.
+
+    The file is a regular `.csv.gz` file (decompressing it returns the csv sorted by patient). The index
+    (see `index_path`) lists for each patient the byte offset and size of its gzip member, the number of rows and the
+    first and last datetime, so that `IndexedCsvReader` can read a single patient without decompressing the whole file.
+
+    Args:
+        df (pd.DataFrame): The history (see the save methods of `StudyDataset`).
+        file_path (str): The output file.
+        level (int): The gzip compression level (1-9).
+        threads (int): Number of compression threads.
+        patient_col (str): The patient id column.
+        datetime_col (str): The datetime column (used for the time ranges of the index).
+        convert (callable, optional): Converts the rows of a patient to the output format (e.g. to integer timestamps).
+    """
+    convert = convert or (lambda rows: rows)
+    df, offsets = sort_by_patient(df, patient_col)
+    first_datetimes, last_datetimes = [], []
+    def blocks():
+        #the header is a separate member, it is prepended to the block of a patient when reading
+        yield convert(df.iloc[:0]).to_csv(index=False).encode()
+        for start, end in zip(offsets[:-1], offsets[1:]):
+            rows = convert(df.iloc[start:end])
+            first_datetimes.append(rows[datetime_col].min())
+            last_datetimes.append(rows[datetime_col].max())
+            yield rows.to_csv(index=False, header=False).encode()
+
+    sizes = []
+    with open(file_path, 'wb') as f:
+        for member in compress_blocks(blocks(), level, threads):
+            f.write(member)
+            sizes.append(len(member))
+
+    positions = np.cumsum(sizes)
+    index = pd.DataFrame({patient_col: df[patient_col].to_numpy()[offsets[:-1]],
+                          'offset': positions[:-1],
+                          'size': sizes[1:],
+                          'rows': np.diff(offsets),
+                          'first_datetime': first_datetimes,
+                          'last_datetime': last_datetimes})
+    index.to_csv(index_path(file_path), index=False)
+
+class IndexedCsvReader:
+    """
+    Reads single patients from a csv file written by `save_indexed_csv`.
+
+    Only the index, the header and the gzip member of the requested patient are read from disk.
+
+    Attributes:
+        index (pd.DataFrame): The sidecar index (indexed by patient id) with the columns
+            `offset`, `size`, `rows`, `first_datetime` and `last_datetime`.
+
+    Example:
+        reader = IndexedCsvReader('data/out/Loop/Loop_cgm_history.csv.gz')
+        cgm = reader.read('123')
+    """
+
+    def __init__(self, file_path, patient_col='patient_id'):
+        self.file_path = file_path
+        self.patient_col = patient_col
+        self.index = pd.read_csv(index_path(file_path), dtype={patient_col: str}).set_index(patient_col)
+        header_size = int(self.index['offset'].min()) if len(self.index) else os.path.getsize(file_path)
+        with open(file_path, 'rb') as f:
+            self.header = gzip.decompress(f.read(header_size))
+
+    @property
+    def patients(self):
+        """The patient ids in the file."""
+        return self.index.index
+
+    def read(self, patient_id):
+        """Returns the rows of a patient (empty if the patient is not in the file).
+
+        Args:
+            patient_id (str): The patient id.
+
+        Returns:
+            df (pd.DataFrame): The rows of the patient (same columns and dtypes as reading the whole file with a
+                string patient id).
+        """
+        data = b''
+        if patient_id in self.index.index:
+            entry = self.index.loc[patient_id]
+            with open(self.file_path, 'rb') as f:
+                f.seek(int(entry['offset']))
+                data = gzip.decompress(f.read(int(entry['size'])))
+        return pd.read_csv(io.BytesIO(self.header + data), dtype={self.patient_col: str})
+
+def read_patient(file_path, patient_id, patient_col='patient_id'):
+    """Reads the rows of a single patient from a csv file written by `save_indexed_csv` (see `IndexedCsvReader`)."""
+    return IndexedCsvReader(file_path, patient_col).read(patient_id)
@@ -0,0 +1,233 @@
+import os
+import sys
+import json
+import time
+import threading
+import tracemalloc
+import cProfile
+from contextlib import contextmanager
+import pandas as pd
+
+try:
+    import resource
+except ImportError:  # not available on windows
+    resource = None
+
+#leading columns of the csv report
+REPORT_COLUMNS = ['stage', 'study', 'stream', 'rows', 'wall_seconds', 'cpu_seconds', 'process_max_rss_mb', 'traced_peak_mb']
+
+_records = None
+_trace_memory = False
+_profiling = None
+_local = threading.local()
+_tracing_lock = threading.Lock()
+_tracing_users = 0
+_started_tracing = False
+
+def enable(trace_memory=False):
+    """Starts recording stages (previous records are discarded).
+
+    Args:
+        trace_memory (bool): Also record the peak python memory of each stage using `tracemalloc` (slows down the
+            processing considerably). Defaults to False.
+    """
+    global _records, _trace_memory
+    _records = []
+    _trace_memory = trace_memory
+    if trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+def disable():
+    """Stops recording stages and returns the records."""
+    global _records, _trace_memory
+    records, _records = _records, None
+    if _trace_memory and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    _trace_memory = False
+    return records or []
+
+def is_enabled():
+    return _records is not None
+
+def enable_profiling(out_path, studies=None, stages=None, top=20):
+    """Profiles selected stages with `cProfile` and `tracemalloc`.
+
+    For each profiled stage, `<study>_<stream>_<stage>.pstats` (open with `pstats.Stats` or snakeviz) and
+    `<study>_<stream>_<stage>.allocations.txt` (the `top` source lines by memory allocated during the stage and 
+    still held at its end) are written to `out_path`. Stages nested in a profiled stage of the same thread are not 
+    profiled separately, allocations of stages running concurrently in other threads are included. Profiling is independent of the stage records (see `enable`), when it is disabled no 
+    profiler or memory tracing is started.
+
+    Args:
+        out_path (str): The output folder.
+        studies (list, optional): Names of the studies to profile (see `StudyDataset.study_name`). Defaults to all.
+        stages (list, optional): The stages to profile (e.g. 'load', 'extract', 'validate', 'save' or 'study'). Defaults to all.
+        top (int): Number of source lines in the allocation summaries. Defaults to 20.
+    """
+    global _profiling
+    os.makedirs(out_path, exist_ok=True)
+    _profiling = {'out_path': out_path, 'studies': None if studies is None else set(studies), 
+                  'stages': None if stages is None else set(stages), 'top': top}
+
+def disable_profiling():
+    global _profiling
+    _profiling = None
+
+def _should_profile(name, labels):
+    if _profiling is None or _local.__dict__.get('profiling'):
+        return False
+    return ((_profiling['studies'] is None or labels.get('study') in _profiling['studies']) and 
+            (_profiling['stages'] is None or name in _profiling['stages']))
+
+def _start_tracing():
+    global _tracing_users, _started_tracing
+    with _tracing_lock:
+        if _tracing_users == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            _started_tracing = True
+        _tracing_users += 1
+
+def _stop_tracing():
+    global _tracing_users, _started_tracing
+    with _tracing_lock:
+        _tracing_users -= 1
+        #only stop tracing started for profiling (not tracing of `enable(trace_memory=True)`)
+        if _tracing_users == 0 and _started_tracing:
+            tracemalloc.stop()
+            _started_tracing = False
+
+@contextmanager
+def _profile(name, labels):
+    config = _profiling
+    file_name = '_'.join(str(labels[key]).replace(',', '+') for key in ['study', 'stream'] if labels.get(key)) + f"_{name}"
+    file_path = os.path.join(config['out_path'], file_name)
+    _start_tracing()
+    before = tracemalloc.take_snapshot()
+    profiler = cProfile.Profile()
+    _local.profiling = True
+    try:
+        profiler.enable()
+    except ValueError:
+        #python >= 3.12 allows only one active profiler (e.g. a stage profiled in another thread)
+        profiler = None
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(f"{file_path}.pstats")
+        _local.profiling = False
+        filters = [tracemalloc.Filter(False, module.__file__) for module in [tracemalloc, cProfile, sys.modules[__name__]]]
+        stats = tracemalloc.take_snapshot().filter_traces(filters).compare_to(before.filter_traces(filters), 'lineno')
+        stats = sorted((stat for stat in stats if stat.size_diff > 0), key=lambda stat: stat.size_diff, reverse=True)
+        _stop_tracing()
+        with open(f"{file_path}.allocations.txt", 'w') as f:
+            f.write(f"Top {config['top']} source lines by memory allocated in stage '{name}' {labels}\n")
+            for stat in stats[:config['top']]:
+                f.write(f"{stat}\n")
+
+def process_max_rss_mb():
+    """Returns the peak resident set size of the process in MB since it started (None if not available).
+
+    This is a high-water mark of the whole process, not of a stage: a stage only raises it if it needs more memory than
+    all earlier stages (use `trace_memory` for the peak of each stage).
+    """
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    #bytes on macOS, kilobytes on linux
+    return max_rss / 2**20 if sys.platform == 'darwin' else max_rss / 2**10
+
+@contextmanager
+def stage(name, **labels):
+    """Records a stage if instrumentation is enabled.
+
+    Stages (loading, extracting, validating and saving a stream, see `StudyDataset`) are recorded with their wall time, 
+    cpu time (of the whole process, including background threads), row count, the peak resident set size of the process 
+    so far (cumulative, see `process_max_rss_mb`) and optionally the peak traced python memory of the stage. When 
+    instrumentation is disabled (the default), only a flag is checked.
+    Peaks of stages that overlap in time (e.g. background writes) include each other's allocations.
+
+    Example:
+        instrumentation.enable(trace_memory=True)
+        study.extract_cgm_history()
+        instrumentation.write_report('data/reports/run')  # run.json and run.csv
+
+    Args:
+        name (str): The stage (e.g. 'load', 'extract', 'validate', 'save').
+        **labels: Additional fields of the record (e.g. `study`, `stream`, `rows`).
+
+    Yields:
+        record (dict): The record, fields can be added while the stage runs (e.g. `record['rows'] = len(df)`).
+    """
+    if _records is None and _profiling is None:
+        yield {}
+        return
+    if _should_profile(name, labels):
+        with _profile(name, labels), _record(name, labels) as record:
+            yield record
+    else:
+        with _record(name, labels) as record:
+            yield record
+
+@contextmanager
+def _record(name, labels):
+    if _records is None:
+        yield {}
+        return
+    record = {'stage': name, **labels}
+    stack = _local.__dict__.setdefault('stack', [])
+    traced = _trace_memory
+    if traced:
+        #the traced peak is global, keep the peak of the enclosing stage before resetting it
+        if stack:
+            stack[-1]['traced_peak'] = max(stack[-1]['traced_peak'], tracemalloc.get_traced_memory()[1])
+        tracemalloc.reset_peak()
+        record['traced_peak'] = 0
+    stack.append(record)
+    start, start_cpu = time.perf_counter(), time.process_time()
+    try:
+        yield record
+    finally:
+        record['wall_seconds'] = time.perf_counter() - start
+        record['cpu_seconds'] = time.process_time() - start_cpu
+        record['process_max_rss_mb'] = process_max_rss_mb()
+        stack.pop()
+        if traced:
+            peak = max(record.pop('traced_peak'), tracemalloc.get_traced_memory()[1])
+            record['traced_peak_mb'] = peak / 2**20
+            if stack:
+                stack[-1]['traced_peak'] = max(stack[-1]['traced_peak'], peak)
+        record['pid'] = os.getpid()
+        if _records is not None:
+            _records.append(record)
+
+def get_records():
+    """Returns the records of the recorded stages (in the order the stages completed)."""
+    return list(_records or [])
+
+def add_records(records):
+    """Adds records of other processes (e.g. the workers of `run_functions.run_parallel`)."""
+    if _records is not None:
+        _records.extend(records)
+
+def write_report(file_path, records=None, **info):
+    """Writes the stage records to `<file_path>.json` (with additional run information) and `<file_path>.csv`.
+
+    Args:
+        file_path (str): The report path without extension.
+        records (list, optional): The records. Defaults to the current records (see `get_records`).
+        **info: Additional information stored in the json report (e.g. options of the run).
+
+    Returns:
+        df (pd.DataFrame): The records as dataframe.
+    """
+    records = get_records() if records is None else records
+    os.makedirs(os.path.dirname(file_path) or '.', exist_ok=True)
+    with open(f"{file_path}.json", 'w') as f:
+        json.dump({**info, 'stages': records}, f, indent=2, default=str)
+    df = pd.DataFrame(records)
+    first = [col for col in REPORT_COLUMNS if col in df.columns]
+    df = df[first + [col for col in df.columns if col not in first]]
+    df.to_csv(f"{file_path}.csv", index=False)
+    return df
@@ -1,6 +1,10 @@
 import logging
 
 class Logger:
+    #if set, loggers write to this file instead of the console (see `redirect_to_file`)
+    log_file = None
+    _names = set()
+
     @staticmethod
     def get_logger(name: str, level=logging.DEBUG) -> logging.Logger:
         """
@@ -14,24 +18,48 @@ class Logger:
             logging.Logger: Configured logger.
         """
         logger = logging.getLogger(name)
+        Logger._names.add(name)
 
         # Avoid adding handlers if the logger is already configured
         if not logger.handlers:
             logger.setLevel(level)
 
-            # Create console handler
-            console_handler = logging.StreamHandler()
-            console_handler.setLevel(level)
-
-            # Add color formatter
-            console_handler.setFormatter(ColorFormatter('%(asctime)s %(message)s', datefmt='[%H:%M:%S]'))
-            
             # Add the handler to the logger
-            logger.addHandler(console_handler)
+            logger.addHandler(Logger._create_handler(level))
             logger.propagate = False
 
         return logger
 
+    @staticmethod
+    def _create_handler(level):
+        if Logger.log_file is None:
+            # Create console handler with color formatter
+            handler = logging.StreamHandler()
+            handler.setFormatter(ColorFormatter('%(asctime)s %(message)s', datefmt='[%H:%M:%S]'))
+        else:
+            handler = logging.FileHandler(Logger.log_file)
+            handler.setFormatter(logging.Formatter('%(asctime)s %(name)s %(levelname)s %(message)s', datefmt='%Y-%m-%d %H:%M:%S'))
+        handler.setLevel(level)
+        return handler
+
+    @staticmethod
+    def redirect_to_file(log_file):
+        """
+        Redirects all loggers created by `get_logger` (existing and future ones) to a file instead of the console.
+
+        Used by worker processes, so that each worker writes an isolated log and the console only shows the progress.
+
+        Args:
+            log_file (str): Path of the log file (appended to if it exists).
+        """
+        Logger.log_file = log_file
+        for name in Logger._names:
+            logger = logging.getLogger(name)
+            for handler in list(logger.handlers):
+                logger.removeHandler(handler)
+                handler.close()
+            logger.addHandler(Logger._create_handler(logger.level))
+
 class ColorFormatter(logging.Formatter):
     COLORS = {
         logging.DEBUG: "\033[37m",  # White
@@ -45,4 +73,4 @@ class ColorFormatter(logging.Formatter):
     def format(self, record):
         log_color = self.COLORS.get(record.levelno, self.RESET)
         record.msg = f"{log_color}{record.msg}{self.RESET}"
-        return super().format(record)
\ No newline at end of file
+        return super().format(record)
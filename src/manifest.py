@@ -0,0 +1,141 @@
+import os
+import json
+import hashlib
+from datetime import datetime
+
+def fingerprint_files(path):
+    """
+    Returns a fingerprint of all files in a directory (recursively) based on their relative paths, sizes and modification times.
+
+    The file contents are not read, so fingerprinting large raw study folders is fast.
+
+    Args:
+        path (str): The directory (or a single file).
+
+    Returns:
+        fingerprint (str): A sha256 hex digest.
+    """
+    h = hashlib.sha256()
+    files = [path] if os.path.isfile(path) else sorted(os.path.join(root, f) for root, _, names in os.walk(path, followlinks=True) for f in names)
+    for file in files:
+        stat = os.stat(file)
+        h.update(f"{os.path.relpath(file, path)}|{stat.st_size}|{stat.st_mtime_ns}\n".encode())
+    return h.hexdigest()
+
+def code_version(paths):
+    """
+    Returns a hash of the contents of all python files in the given directories (or files).
+
+    Args:
+        paths (list of str): Directories or files containing the code that produces the output.
+
+    Returns:
+        version (str): A sha256 hex digest.
+    """
+    h = hashlib.sha256()
+    for path in paths:
+        files = [path] if os.path.isfile(path) else sorted(os.path.join(root, f) for root, _, names in os.walk(path) for f in names if f.endswith('.py'))
+        for file in files:
+            h.update(os.path.basename(file).encode())
+            with open(file, 'rb') as f:
+                h.update(f.read())
+    return h.hexdigest()
+
+def file_checksum(file_path, chunk_size=1 << 20):
+    """Returns the sha256 hex digest of a file."""
+    h = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        while chunk := f.read(chunk_size):
+            h.update(chunk)
+    return h.hexdigest()
+
+def write_json_atomic(data, file_path):
+    """Writes json to a temporary file and renames it, so that readers never see a partially written file."""
+    tmp_path = f"{file_path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, file_path)
+
+class Manifest:
+    """
+    Describes the output of a study: the inputs and code it was created from and the completed streams.
+
+    The manifest is stored as `manifest.json` in the output folder of the study and is rewritten atomically after each
+    completed stream. A run can therefore skip studies whose inputs, code and options did not change and resume a failed
+    run at the first incomplete stream.
+
+    Example manifest:
+    ```
+    {"study": "DCLP3", "source": "9f2c...", "code": "41ab...", "options": {"load_subset": false},
+     "streams": {"cgm_history": {"file": "DCLP3_cgm_history.csv.gz", "rows": 10234, "size": 81234,
+                                 "sha256": "c0ff...", "seconds": 12.3, "completed": "2024-10-01T12:00:00"}}}
+    ```
+    """
+    FILE_NAME = 'manifest.json'
+
+    def __init__(self, out_path, study, source, code, options):
+        self.file_path = os.path.join(out_path, self.FILE_NAME)
+        self.out_path = out_path
+        self.data = {'study': study, 'source': source, 'code': code, 'options': options, 'streams': {}}
+
+    @classmethod
+    def load(cls, out_path, study, source, code, options):
+        """
+        Returns the manifest of a study output folder. Completed streams of an existing manifest are only kept if the
+        study was processed from the same inputs, code and options.
+
+        Args:
+            out_path (str): The output folder of the study.
+            study (str): The study name.
+            source (str): Fingerprint of the raw data (see `fingerprint_files`).
+            code (str): Version of the code (see `code_version`).
+            options (dict): Options that change the output (json serializable).
+
+        Returns:
+            manifest (Manifest): The manifest.
+        """
+        manifest = cls(out_path, study, source, code, options)
+        if os.path.exists(manifest.file_path):
+            try:
+                with open(manifest.file_path) as f:
+                    existing = json.load(f)
+            except json.JSONDecodeError:
+                existing = {}
+            if all(existing.get(key) == manifest.data[key] for key in ['study', 'source', 'code', 'options']):
+                manifest.data['streams'] = existing.get('streams', {})
+        return manifest
+
+    def is_complete(self, stream):
+        """Returns True if the stream was completed and its output file still exists with the recorded size."""
+        entry = self.data['streams'].get(stream)
+        if entry is None:
+            return False
+        file_path = os.path.join(self.out_path, entry['file'])
+        return os.path.exists(file_path) and os.path.getsize(file_path) == entry['size']
+
+    def pending_streams(self, streams):
+        """Returns the streams that need to be (re)processed, in the given order."""
+        return [stream for stream in streams if not self.is_complete(stream)]
+
+    def complete_stream(self, stream, file_path, rows, seconds):
+        """
+        Records a completed stream and saves the manifest.
+
+        Args:
+            stream (str): The stream (e.g. 'cgm_history').
+            file_path (str): The written output file.
+            rows (int): Number of rows written.
+            seconds (float): Processing time of the stream.
+        """
+        self.data['streams'][stream] = {'file': os.path.basename(file_path),
+                                        'rows': int(rows),
+                                        'size': os.path.getsize(file_path),
+                                        'sha256': file_checksum(file_path),
+                                        'seconds': round(seconds, 3),
+                                        'completed': datetime.now().isoformat(timespec='seconds')}
+        self.save()
+
+    def save(self):
+        write_json_atomic(self.data, self.file_path)
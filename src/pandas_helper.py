@@ -1,5 +1,8 @@
 import pandas as pd
 import numpy as np
+from functools import reduce
+from collections import namedtuple
+from src.surrounding_rows import SurroundingRows
 
 def get_duplicated_max_indexes(df, check_cols, max_col):
     """
@@ -26,17 +29,199 @@ def get_duplicated_max_indexes(df, check_cols, max_col):
         dup_indexes, max_indexes, drop_indexes = get_duplicated_max_indexes(df, ['PtID', 'DataDtTm'], 'CGMValue')
         print(df.drop(drop_indexes))
     """
-    # Find duplicated rows based on the specified columns
-    bDuplicated = df.duplicated(check_cols, keep=False)
-    dup_indexes = bDuplicated[bDuplicated].index.values
+    order, starts = _sort_duplicates(df, check_cols, max_col, 'max')
+
+    #the first row of each group (sorted by the check_cols) holds the maximum value
+    dup_positions = np.sort(order)
+    max_positions = order[starts]
+    drop_positions = np.delete(order, starts)
+
+    labels = df.index.values
+    return labels[dup_positions], labels[max_positions], np.sort(labels[drop_positions])
+
+#the rows kept for each group of duplicates: the first or last row (in frame order) or the row with the maximum or
+#minimum value of another column (the first of these rows, missing values are only kept if all values are missing)
+DEDUP_POLICIES = ('first', 'last', 'max', 'min')
+
+DuplicatePolicy = namedtuple('DuplicatePolicy', ['subset', 'keep', 'by'], defaults=['first', None])
+
+def _sort_key(series, descending=False):
+    """Returns an array that sorts like `series` (missing values last, also if `descending`) and is equal for equal values."""
+    dtype = series.dtype
+    if not series.hasnans:
+        if pd.api.types.is_datetime64_any_dtype(dtype) or pd.api.types.is_timedelta64_dtype(dtype):
+            values = np.asarray(series.values).view('i8')
+        else:
+            values = np.asarray(series.to_numpy())
+        #numbers are sorted directly, other values by their rank
+        if values.dtype.kind in 'if':
+            return -values if descending else values
+        if values.dtype.kind == 'b':
+            return -values.astype('int8') if descending else values
+    try:
+        codes, uniques = pd.factorize(series, sort=True)
+    except TypeError:
+        #mixed types can not be sorted, the groups are still found
+        codes, uniques = pd.factorize(series)
+    if descending:
+        codes = np.where(codes < 0, -1, len(uniques) - 1 - codes)
+    return np.where(codes < 0, len(uniques), codes)
+
+def _sort_duplicates(df, subset, by=None, keep='first', dropna=False):
+    """Sorts the duplicated rows by the `subset` columns, the row to keep (see `DEDUP_POLICIES`) first in each group.
+
+    The duplicated rows are found with one hash pass (`pd.DataFrame.duplicated`), only these are sorted. With `dropna`,
+    groups with missing `subset` values are excluded (like in `groupby`).
 
-    # Within the duplciates, find the indexes of the rows with the maximum value in the max_col
-    max_indexes = df.loc[dup_indexes].groupby(check_cols)[max_col].idxmax().values
+    Returns:
+        order (np.ndarray): The positions of the duplicated rows in sorted order.
+        starts (np.ndarray): Positions in `order` where a group starts, the first row of a group is kept.
+    """
+    if keep not in DEDUP_POLICIES:
+        raise ValueError(f"Unknown policy {keep!r}, supported are {DEDUP_POLICIES}")
+    if keep in ('max', 'min') and by is None:
+        raise ValueError(f"The {keep!r} policy requires a `by` column")
+    subset = [subset] if isinstance(subset, str) else list(subset)
+    candidates = np.flatnonzero(df.duplicated(subset, keep=False))
+    if dropna:
+        #rows with missing subset values only duplicate each other
+        candidates = candidates[df[subset].take(candidates).notna().all(axis=1).to_numpy()]
+    if len(candidates) == 0:
+        return candidates, candidates
+    keys = [_sort_key(df[col].take(candidates)) for col in subset]
+    by_keys = [_sort_key(df[by].take(candidates), descending=keep == 'max')] if keep in ('max', 'min') else []
+    #lexsort is stable and sorts by the last key first, rows with equal keys keep their frame order
+    order = np.lexsort(by_keys + keys[::-1])
+    changed = np.zeros(len(order) - 1, dtype=bool)
+    for key in keys:
+        key = key[order]
+        changed |= key[1:] != key[:-1]
+    starts = np.flatnonzero(np.r_[True, changed])
+    if keep == 'last':
+        #the last row of each group is moved to the start of its group
+        ends = np.r_[starts[1:], len(order)] - 1
+        order[starts], order[ends] = order[ends], order[starts].copy()
+    return candidates[order], starts
+
+def duplicated(df, subset, keep='first', by=None):
+    """
+    Marks the rows to drop so that one row per group of `subset` values remains.
 
-    # The other row indexes are to be dropped
-    drop_indexes = np.setdiff1d(dup_indexes, max_indexes)
-    
-    return dup_indexes, max_indexes, drop_indexes
+    Args:
+        df (pd.DataFrame): The dataframe to check for duplicates.
+        subset (list): The columns identifying duplicates.
+        keep (str): Which row of a group to keep, one of `DEDUP_POLICIES`.
+        by (str): The column of the 'max' and 'min' policies.
+
+    Returns:
+        drop (np.ndarray): Boolean mask of the rows to drop (in frame order).
+    """
+    order, starts = _sort_duplicates(df, subset, by, keep)
+    drop = np.zeros(len(df), dtype=bool)
+    drop[np.delete(order, starts)] = True
+    return drop
+
+def deduplicate(df, policies):
+    """
+    Drops duplicates applying one or more policies in order.
+
+    Each policy sorts the duplicated rows once and keeps one row per group of `subset` values (see `DEDUP_POLICIES`).
+    Missing values in the subset columns form a group of their own (as in `drop_duplicates`).
+
+    Args:
+        df (pd.DataFrame): The dataframe to deduplicate.
+        policies (list of DuplicatePolicy): The policies, applied in order.
+
+    Returns:
+        df (pd.DataFrame): The remaining rows (in frame order, the index is kept).
+        dropped (pd.Series): The number of rows dropped by each policy (indexed by the policy description).
+
+    Example:
+        df, dropped = deduplicate(df, [DuplicatePolicy(['PtID', 'datetime', 'Rate']),
+                                       DuplicatePolicy(['PtID', 'datetime'], 'max', 'RecID')])
+    """
+    dropped = {}
+    for policy in policies:
+        policy = DuplicatePolicy(*policy)
+        drop = duplicated(df, policy.subset, policy.keep, policy.by)
+        if drop.any():
+            df = df.take(np.flatnonzero(~drop))
+        dropped[describe_policy(policy)] = int(drop.sum())
+    return df, pd.Series(dropped, dtype='int64', name='dropped')
+
+def describe_policy(policy):
+    """Returns a short description of a `DuplicatePolicy`, e.g. 'max RecID per PtID, datetime'."""
+    subset = [policy.subset] if isinstance(policy.subset, str) else policy.subset
+    keep = policy.keep if policy.by is None else f'{policy.keep} {policy.by}'
+    return f"{keep} per {', '.join(subset)}"
+
+def get_shared_patients(patient_ids):
+    """
+    Returns the patient ids that occur in all of the given collections.
+
+    Args:
+        patient_ids (list of pd.Series or array-like): The patient ids of each table (duplicates are allowed).
+
+    Returns:
+        shared_ids (pd.Index): The patient ids present in all collections.
+    """
+    return reduce(lambda a, b: a.intersection(b), [pd.Index(pd.unique(ids)) for ids in patient_ids])
+
+def filter_patients(df, patient_ids, patient_col='PtID'):
+    """
+    Keeps only the rows of the given patients.
+
+    Args:
+        df (pd.DataFrame): The dataframe to filter.
+        patient_ids (array-like): The patient ids to keep.
+        patient_col (str): The patient id column.
+
+    Returns:
+        df (pd.DataFrame): The filtered dataframe (a new frame, not a view).
+    """
+    #take returns a new frame (not a view), the result can be modified without SettingWithCopy warnings
+    return df.take(np.flatnonzero(df[patient_col].isin(patient_ids)))
+
+def sort_by_patient(df, patient_col='patient_id'):
+    """
+    Groups the rows by patient (sorted by patient id), the order of the rows within a patient is kept.
+
+    Args:
+        df (pd.DataFrame): The dataframe to sort.
+        patient_col (str): The patient id column.
+
+    Returns:
+        df (pd.DataFrame): The sorted dataframe with a new range index (not copied if already sorted).
+        offsets (np.ndarray): Row offsets of the patients, the rows of the i-th patient are `df.iloc[offsets[i]:offsets[i+1]]`.
+    """
+    codes, patients = pd.factorize(df[patient_col], sort=True)
+    if (codes[1:] >= codes[:-1]).all():
+        sorted_codes = codes
+    else:
+        order = np.argsort(codes, kind='stable')
+        df, sorted_codes = df.take(order), codes[order]
+    return df.reset_index(drop=True), np.searchsorted(sorted_codes, np.arange(len(patients) + 1))
+
+def filter_shared_patients(dfs, patient_col='PtID'):
+    """
+    Keeps only the rows of patients that have data in all of the given dataframes.
+
+    This is a standalone helper for tables that are already in memory (e.g. in notebooks). Study loaders use
+    `StudyDataset._load_patient_tables` instead, which caches the shared patients so that streams loaded separately are
+    filtered the same way.
+
+    Args:
+        dfs (list of pd.DataFrame): The dataframes to filter.
+        patient_col (str): The patient id column, must exist in all dataframes.
+
+    Returns:
+        dfs (list of pd.DataFrame): The filtered dataframes in the same order as the input.
+
+    Example:
+        df_bolus, df_basal, df_cgm = filter_shared_patients([df_bolus, df_basal, df_cgm], 'PtID')
+    """
+    shared_ids = get_shared_patients([df[patient_col] for df in dfs])
+    return [filter_patients(df, shared_ids, patient_col) for df in dfs]
 
 def split_sequences(df, label_col):
     """ Assigns a unique group ID to each sequence of consecutive labels.
@@ -150,10 +335,29 @@ def head_tail(df,n=2):
     return pd.concat([df.head(n), df.tail(n)])
 
 
-def get_min_max_duplicates(df,dup_cols,val_col):
-    dups = df[df.duplicated(subset=dup_cols, keep=False)]
-    results = dups.groupby(dup_cols)[val_col].agg(['min','max'])
-    return results
+def _duplicate_groups(df, subset):
+    """Returns the duplicated rows sorted by `subset` (see `_sort_duplicates`), the group starts and the group sizes.
+    As in `groupby`, groups with missing `subset` values are excluded."""
+    subset = [subset] if isinstance(subset, str) else list(subset)
+    order, starts = _sort_duplicates(df, subset, dropna=True)
+    return df.take(order), starts, np.diff(np.r_[starts, len(order)])
+
+def get_min_max_duplicates(df, dup_cols, val_col):
+    """
+    Returns the minimum and maximum value of each group of duplicated rows.
+
+    Args:
+        df (pd.DataFrame): The dataframe to check for duplicates.
+        dup_cols (list): The columns identifying duplicates.
+        val_col (str): The column to get the minimum and maximum value of.
+
+    Returns:
+        results (pd.DataFrame): `min` and `max` columns indexed by the `dup_cols` values of each group (sorted).
+    """
+    dup_cols = [dup_cols] if isinstance(dup_cols, str) else list(dup_cols)
+    #only the used columns of the duplicated rows are taken (not a copy of the whole rows)
+    rows = np.flatnonzero(df.duplicated(subset=dup_cols, keep=False))
+    return df[val_col].take(rows).groupby([df[col].take(rows) for col in dup_cols]).agg(['min', 'max'])
 
 
 def overlaps(df, datetime_col, duration_col):
@@ -175,32 +379,87 @@ def overlaps(df, datetime_col, duration_col):
     return overlap
 
 
+def _differing_groups(values, starts):
+    """Returns for each group (rows sorted by group, see `_duplicate_groups`) whether it has more than one value, missing values count as a value."""
+    codes, _ = pd.factorize(values)
+    return np.minimum.reduceat(codes, starts) != np.maximum.reduceat(codes, starts)
+
 def count_differences_in_duplicates(df, subset):
     """
     Counts the number of differences between duplicated rows for all columns.
     
     Parameters:
         df (pd.DataFrame): The input DataFrame.
+        subset (list): The columns identifying duplicates.
     
     Returns:
-        series (pd.Series): A series where the index represents column names and values represent the count of differences.
+        series (pd.Series): A series where the index represents column names and values represent the number of groups
+            of duplicates in which the column has more than one value.
     """
-    duplicated_rows = df[df.duplicated(keep=False, subset=subset)]  # Keep all duplicate occurrences
-    
-    if duplicated_rows.empty:
+    subset = [subset] if isinstance(subset, str) else list(subset)
+    dups, starts, _ = _duplicate_groups(df, subset)
+    if dups.empty:
         return pd.Series({col: 0 for col in df.columns})
-    
-    # Group by all columns and compute pairwise differences
-    diff_counts = (duplicated_rows.groupby(subset)
-                   .apply(lambda group: group.nunique(dropna=False) > 1)
-                   .sum())
-    
-    return diff_counts
+    return pd.Series({col: 0 if col in subset else int(_differing_groups(dups[col], starts).sum()) for col in df.columns})
+
+def duplicate_report(df, subset):
+    """
+    Profiles the duplicates of a raw table in one pass to choose a deduplication policy (see `DEDUP_POLICIES`).
+
+    Args:
+        df (pd.DataFrame): The raw table.
+        subset (list): The columns identifying duplicates (e.g. patient and datetime).
+
+    Returns:
+        report (pd.DataFrame): One row for each of the other columns with
+            - `groups`: number of groups of duplicated rows,
+            - `differing_groups`: groups in which the column has more than one value (missing values count as a value),
+            - `differing_rows`: rows of these groups,
+            - `missing`: missing values in the duplicated rows,
+            - `zeros`: zero values in the duplicated rows,
+            - `max_spread`: the largest difference between the maximum and minimum value of a group (numeric and
+              datetime columns only, otherwise NaN).
+
+    Example:
+        report = duplicate_report(df_basal, ['PtID', 'DataDtTm'])
+        print(report.sort_values('differing_groups', ascending=False))
+    """
+    subset = [subset] if isinstance(subset, str) else list(subset)
+    dups, starts, sizes = _duplicate_groups(df, subset)
+    report = {}
+    for col in df.columns.drop(subset):
+        values = dups[col]
+        differing = _differing_groups(values, starts) if len(starts) else np.zeros(0, dtype=bool)
+        report[col] = {'groups': len(starts),
+                       'differing_groups': int(differing.sum()),
+                       'differing_rows': int(sizes[differing].sum()),
+                       'missing': int(values.isna().sum()),
+                       'zeros': int((values == 0).sum()) if pd.api.types.is_numeric_dtype(values.dtype) else 0,
+                       'max_spread': _max_spread(values, starts)}
+    return pd.DataFrame.from_dict(report, orient='index',
+                                  columns=['groups', 'differing_groups', 'differing_rows', 'missing', 'zeros', 'max_spread'])
+
+def _max_spread(values, starts):
+    """Returns the largest difference between the maximum and minimum value of a group (see `duplicate_report`)."""
+    dtype = values.dtype
+    is_time = pd.api.types.is_datetime64_any_dtype(dtype) or pd.api.types.is_timedelta64_dtype(dtype)
+    if len(starts) == 0 or pd.api.types.is_bool_dtype(dtype) or not (is_time or pd.api.types.is_numeric_dtype(dtype)):
+        return np.nan
+    if is_time:
+        numbers = np.asarray(values.values).view('i8').astype(float)
+        numbers[values.isna().to_numpy()] = np.nan
+    else:
+        numbers = values.to_numpy(dtype=float, na_value=np.nan)
+    spreads = np.fmax.reduceat(numbers, starts) - np.fmin.reduceat(numbers, starts)
+    spread = np.nanmax(spreads) if not np.isnan(spreads).all() else np.nan
+    return pd.Timedelta(spread, unit='ns') if is_time and not np.isnan(spread) else spread
 
 
 def extract_surrounding_rows(df, index, n, sort_by):
     """
     Extracts rows surrounding a given index after sorting the DataFrame by a subset of columns.
+
+    The DataFrame is sorted on every call, use `src.surrounding_rows.SurroundingRows` to look up many rows.
     
     Parameters:
         df (pd.DataFrame): The input DataFrame.
@@ -212,14 +471,7 @@ def extract_surrounding_rows(df, index, n, sort_by):
     """
     if index not in df.index:
         raise ValueError("The provided index is not in the DataFrame.")
-    
-    sorted_df = df.sort_values(by=sort_by)
-    i_loc = sorted_df.index.get_loc(index)
-    
-    start = max(i_loc - n, 0)
-    end = min(i_loc + n + 1, len(sorted_df))
-    
-    return sorted_df.iloc[start:end]
+    return SurroundingRows(df, sort_by).get(index, n)
 
 
 def grouped_value_counts(df, group_cols, value_cols):
@@ -239,14 +491,9 @@ def grouped_value_counts(df, group_cols, value_cols):
     if isinstance(value_cols, str):
         value_cols = [value_cols]
 
-    def count_values(group):
-        nan_count = group[value_cols].isna().sum().sum()  # Sum NaNs for all value columns
-        non_nan_count = group[value_cols].notna().sum().sum()  # Sum Non-NaNs for all value columns
-        zero_count = (group[value_cols] == 0).sum().sum()  # Sum zeros for all value columns
-        return pd.Series({
-            'NaN Count': nan_count,
-            'Non-NaN Count': non_nan_count,
-            'Zero Count': zero_count
-        })
-
-    return df.groupby(group_cols).apply(count_values).reset_index()
\ No newline at end of file
+    #count per row over all value columns, then sum the rows of each group
+    nan_counts = sum(df[col].isna().to_numpy(dtype='int64') for col in value_cols)
+    counts = pd.DataFrame({'NaN Count': nan_counts,
+                           'Non-NaN Count': len(value_cols) - nan_counts,
+                           'Zero Count': sum((df[col] == 0).to_numpy(dtype='int64') for col in value_cols)}, index=df.index)
+    return counts.groupby([df[col] for col in group_cols]).sum().reset_index()
\ No newline at end of file
@@ -0,0 +1,83 @@
+import pandas as pd
+import numpy as np
+
+class PatientIndex:
+    """
+    Sorted, offset-indexed representation of a history (bolus, basal or cgm) for fast per patient access.
+
+    The history is sorted once by patient and datetime. The rows of each patient are then a contiguous block
+    `data.iloc[offsets[i]:offsets[i+1]]`, so accessing a patient is a slice (a view on the sorted data, not a copy).
+    Time windows of a patient are located by binary search within the block (O(log n) plus the size of the result).
+
+    Attributes:
+        data (pd.DataFrame): The history sorted by patient and datetime (the original index is kept).
+        patients (pd.Index): The sorted patient ids.
+        offsets (np.ndarray): Row offsets of the patients in `data` (length `len(patients) + 1`).
+        datetimes (np.ndarray): The datetimes of `data` (used for the binary search).
+
+    Example:
+        index = PatientIndex(study.extract_cgm_history())
+        for patient_id, cgm in index:
+            print(patient_id, cgm.cgm.mean())
+        day = index.window('10', '2018-04-20', '2018-04-21')
+    """
+
+    def __init__(self, df, patient_col='patient_id', datetime_col='datetime'):
+        self.patient_col = patient_col
+        self.datetime_col = datetime_col
+        codes, patients = pd.factorize(df[patient_col], sort=True)
+        order = np.lexsort((df[datetime_col].to_numpy(), codes))
+        #avoid the copy if the data is already sorted
+        self.data = df if (order[1:] > order[:-1]).all() else df.take(order)
+        self.patients = pd.Index(patients)
+        self.offsets = np.searchsorted(codes[order], np.arange(len(patients) + 1))
+        self.datetimes = self.data[datetime_col].to_numpy()
+
+    def __len__(self):
+        return len(self.patients)
+
+    def __contains__(self, patient_id):
+        return patient_id in self.patients
+
+    def __iter__(self):
+        """Yields `(patient_id, rows)` for each patient in sorted order."""
+        for i, patient_id in enumerate(self.patients):
+            yield patient_id, self.data.iloc[self.offsets[i]:self.offsets[i + 1]]
+
+    def _bounds(self, patient_id):
+        i = self.patients.get_indexer([patient_id])[0]
+        return (0, 0) if i < 0 else (self.offsets[i], self.offsets[i + 1])
+
+    def _search(self, start, end, time):
+        #round up to the resolution of the data, so that datetimes < time are excluded
+        resolution = np.datetime_data(self.datetimes.dtype)[0]
+        time = pd.Timestamp(time).ceil(resolution).to_datetime64().astype(self.datetimes.dtype)
+        return start + np.searchsorted(self.datetimes[start:end], time, side='left')
+
+    def get(self, patient_id):
+        """Returns the rows of a patient sorted by datetime (empty if the patient has no rows).
+
+        Args:
+            patient_id: The patient id.
+
+        Returns:
+            rows (pd.DataFrame): A slice of `data`.
+        """
+        start, end = self._bounds(patient_id)
+        return self.data.iloc[start:end]
+
+    def window(self, patient_id, start=None, end=None):
+        """Returns the rows of a patient with `start <= datetime < end` sorted by datetime.
+
+        Args:
+            patient_id: The patient id.
+            start (datetime-like, optional): Start of the window (inclusive). Defaults to the first row.
+            end (datetime-like, optional): End of the window (exclusive). Defaults to the end of the patient's rows (all remaining rows are included).
+
+        Returns:
+            rows (pd.DataFrame): A slice of `data`.
+        """
+        first, last = self._bounds(patient_id)
+        lo = first if start is None else self._search(first, last, start)
+        hi = last if end is None else self._search(first, last, end)
+        return self.data.iloc[lo:max(lo, hi)]
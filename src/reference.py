@@ -0,0 +1,100 @@
+import numpy as np
+import pandas as pd
+from datetime import timedelta
+
+from src.find_periods import Period
+
+#frozen copies of the original (row by row) implementations, the golden reference of `src.equivalence`.
+#optimize the functions in their modules, never these copies.
+
+def split_bolus(datetime, bolus, duration, sampling_frequency):
+    steps = max(1, np.ceil(duration / sampling_frequency))
+    delivery_per_interval = bolus / steps
+    times = datetime+np.arange(steps)*sampling_frequency
+    deliveries = [delivery_per_interval] * len(times)
+    return {'datetime': times, 'delivery': deliveries}
+
+def bolus_transform(df):
+    """Reference of `src.postprocessing.bolus_transform`."""
+    sampling_frequency = pd.to_timedelta('5min')
+    expanded_rows = [split_bolus(row['datetime'], row['bolus'], row['delivery_duration'], sampling_frequency) for _, row in df.iterrows()]
+
+    datetimes = np.concatenate([item['datetime'] for item in expanded_rows])
+    deliveries = np.concatenate([item['delivery'] for item in expanded_rows])
+    expanded_events = pd.DataFrame({'datetime': datetimes, 'bolus': deliveries})
+    expanded_events['datetime'] = expanded_events['datetime'].dt.floor(sampling_frequency)
+    expanded_events = expanded_events.groupby('datetime').sum().reset_index()
+
+    expanded_events = expanded_events.sort_values('datetime')
+    start_time = df['datetime'].min().floor('D')
+    end_time = (df['datetime'] + df['delivery_duration']).max().ceil('D')
+    all_times = pd.date_range(start=start_time, end=end_time, freq=sampling_frequency, inclusive='left')
+    return expanded_events.set_index('datetime').reindex(all_times, fill_value=0).reset_index(drop=False, names=['datetime'])
+
+def calculate_daily_basal_dose(df):
+    """Reference of `src.tdd.calculate_daily_basal_dose`."""
+    if df.empty:
+        raise ValueError('Empty dataframe passed to calculate daily basal dose')
+
+    valid_days = df.groupby(df.datetime.dt.date).datetime.count()>0
+    valid_days = valid_days.reindex(pd.date_range(df.datetime.min().date(), df.datetime.max().date(), freq='D'), fill_value=False)
+
+    supports = pd.date_range(df.datetime.min().date(), df.datetime.max().date() + pd.Timedelta(days=1), freq='D')
+    missing_supports = supports[~supports.isin(df.datetime)]
+    copy = df.copy()
+    copy = pd.concat([copy, pd.DataFrame({'datetime': missing_supports})]).sort_values(by='datetime').reset_index(drop=True)
+    copy['basal_rate'] = copy['basal_rate'].ffill()
+
+    daydelta = pd.Timedelta(days=1)
+    copy['date'] = copy.datetime.dt.date
+    copy['midnight'] = copy.date == copy.datetime
+    copy['date'] = copy.apply(lambda row: {row['date']} if not row['midnight'] else {row['date'], row['date']-daydelta}, axis=1)
+    copy = copy.drop(columns=['midnight'])
+    copy = copy.explode('date')
+    copy = copy.loc[~copy.date.isin([copy.date.max(),copy.date.min()])]
+
+    def tdd(df):
+        x = (df.datetime.diff().dt.total_seconds()/3600)[1:]
+        y = df['basal_rate'][:-1]
+        return np.nan if len(x) == 0 else np.sum(x.values * y.values)
+
+    tdds = copy.groupby('date').apply(tdd).to_frame().rename(columns={0:'basal'})
+    tdds.loc[valid_days.index[~valid_days]] = np.nan
+    return tdds
+
+def _duration(duration):
+    hours, minutes, seconds = map(int, duration.split(':'))
+    return timedelta(hours=hours, minutes=minutes, seconds=seconds)
+
+def merge_basal_and_temp_basal(df):
+    """Reference of `studies.flair.merge_basal_and_temp_basal`."""
+    adjusted_basal = df.BasalRt.copy()
+    df_sub_temp_basals = df.loc[df.TempBasalAmt.notna()]
+    df_sub_basals = df.loc[df.BasalRt.notna()]
+
+    for index, row in df_sub_temp_basals.iterrows():
+        temp_basal_interval = pd.Interval(row.DateTime, row.DateTime + _duration(row.TempBasalDur))
+        affected_basal_indexes = df_sub_basals.index[df_sub_basals.DateTime.apply(lambda x: x in temp_basal_interval)]
+        if row.TempBasalType == 'Percent':
+            adjusted_basal.loc[affected_basal_indexes] = df_sub_basals.BasalRt.loc[affected_basal_indexes]*row.TempBasalAmt/100
+        else:
+            adjusted_basal.loc[index] = row.TempBasalAmt
+            adjusted_basal[affected_basal_indexes] = np.nan
+    return adjusted_basal
+
+def find_periods(df, value_col, time_col, start_trigger_fun, stop_trigger_fun, use_last_start_occurence=False):
+    """Reference of `src.find_periods.find_periods` (without the NaN warnings)."""
+    df = df.dropna(subset=[time_col, value_col], how='any')
+    df = df.sort_values(by=time_col)
+
+    periods = []
+    start_index = None
+    start_time = None
+    for index, row in df.iterrows():
+        if start_trigger_fun(row[value_col]) and ((start_index is None) or use_last_start_occurence):
+            start_index = index
+            start_time = row[time_col]
+        elif stop_trigger_fun(row[value_col]) and start_index is not None:
+            periods.append(Period(start_index, index, start_time, row[time_col]))
+            start_index = None
+    return periods
@@ -0,0 +1,75 @@
+import pandas as pd
+import numpy as np
+
+class SurroundingRows:
+    """
+    Sorted representation of a dataframe to look up the rows surrounding given rows (e.g. while investigating anomalies).
+
+    The dataframe is sorted once. Index labels are mapped to their position in the sorted data by a hash lookup, so
+    each query is O(1) plus the size of the result, while `pandas_helper.extract_surrounding_rows` sorts the whole
+    dataframe on every call.
+
+    Attributes:
+        data (pd.DataFrame): The dataframe sorted by `sort_by` (the original index is kept).
+
+    Example:
+        rows = SurroundingRows(df_basal, ['PtID', 'datetime'])
+        rows.get(1234, 3)
+        rows.get_many(df_basal.index[df_basal.Rate > 10], 3)
+    """
+
+    def __init__(self, df, sort_by):
+        self.data = df.sort_values(by=sort_by)
+        if not self.data.index.is_unique:
+            raise ValueError("The index of the DataFrame must be unique.")
+
+    def __len__(self):
+        return len(self.data)
+
+    def positions(self, indexes):
+        """Returns the positions of index labels in `data`.
+
+        Args:
+            indexes (array-like): Index labels of the original dataframe.
+
+        Returns:
+            positions (np.ndarray): The positions in `data`.
+        """
+        positions = self.data.index.get_indexer(indexes)
+        if (positions < 0).any():
+            missing = list(pd.Index(indexes)[positions < 0][:5])
+            raise ValueError(f"The provided indexes {missing} are not in the DataFrame.")
+        return positions
+
+    def get(self, index, n):
+        """Returns the rows surrounding a row.
+
+        Args:
+            index: The index label of the row to center on.
+            n (int): The number of rows before and after the row (fewer at the start and end of `data`).
+
+        Returns:
+            rows (pd.DataFrame): A slice of `data`.
+        """
+        position = self.positions([index])[0]
+        return self.data.iloc[max(position - n, 0):position + n + 1]
+
+    def get_many(self, indexes, n):
+        """Returns the rows surrounding each of many rows at once.
+
+        Args:
+            indexes (array-like): The index labels of the rows to center on.
+            n (int): The number of rows before and after each row.
+
+        Returns:
+            rows (pd.DataFrame): The rows surrounding each row (a row can occur more than once), with an additional first
+                index level `center` holding the index label the rows surround. Equal to
+                `pd.concat({index: self.get(index, n) for index in indexes}, names=['center'])` for unique `indexes`.
+        """
+        indexes = pd.Index(indexes)
+        grid = self.positions(indexes)[:, None] + np.arange(-n, n + 1)
+        valid = (grid >= 0) & (grid < len(self.data))
+        rows = self.data.take(grid[valid])
+        centers = np.repeat(indexes, valid.sum(axis=1))
+        rows.index = pd.MultiIndex.from_arrays([centers, rows.index], names=['center', self.data.index.name])
+        return rows
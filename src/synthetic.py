@@ -0,0 +1,594 @@
+import os
+import zlib
+import argparse
+import numpy as np
+import pandas as pd
+
+from src.xport import write_xport
+
+#raw folder names of the studies (see run_functions.py)
+STUDY_FOLDERS = {'DCLP3': 'DCLP3 Public Dataset - Release 3 - 2022-08-04',
+                 'DCLP5': 'DCLP5_Dataset_2022-01-20-5e0f3b16-c890-4ace-9e3b-531f3687cf53',
+                 'PEDAP': 'PEDAP Public Dataset - Release 3 - 2024-09-25',
+                 'IOBP2': 'IOBP2 RCT Public Dataset',
+                 'Flair': 'FLAIRPublicDataSet',
+                 'ReplaceBG': 'REPLACE-BG Dataset-79f6bdc8-3c51-4736-a39f-c4c0f71d45e5',
+                 'Loop': 'Loop study public dataset 2023-01-31',
+                 'T1DEXI': 'T1DEXI',
+                 'T1DEXIP': 'T1DEXIP'}
+
+#readings per day of a 5 minute cgm
+READINGS_PER_DAY = 288
+#number of LOOPDeviceCGM*.txt and LOOPDeviceBasal*.txt files
+LOOP_FILES = 3
+#the loader of ReplaceBG uses this imaginary enrollment date
+REPLACEBG_ENROLLMENT = pd.Timestamp(2015, 1, 1)
+SAS_EPOCH = pd.Timestamp(1960, 1, 1)
+
+def _seconds(values):
+    return pd.to_timedelta(np.asarray(values), unit='s')
+
+def _round(values, step):
+    #the second rounding removes floating point artifacts (e.g. 0.35000000000000003)
+    return np.round(np.round(np.asarray(values) / step) * step, 6)
+
+def format_datetimes(times, fields):
+    """
+    Formats datetimes from fixed width fields without calling `strftime` (which is slow for millions of values).
+
+    Args:
+        times (array-like): The datetimes (no NaT).
+        fields (list): Literal strings, `(values, width)` tuples of integers printed with leading zeros or 2d uint8
+            arrays of characters (one row per datetime).
+
+    Returns:
+        formatted (np.ndarray): The formatted datetimes.
+    """
+    columns = []
+    for field in fields:
+        if isinstance(field, str):
+            columns.append(np.broadcast_to(np.frombuffer(field.encode(), dtype=np.uint8), (len(times), len(field))))
+        elif isinstance(field, tuple):
+            values, width = field
+            columns.append(np.asarray(values)[:, None] // 10 ** np.arange(width - 1, -1, -1) % 10 + ord('0'))
+        else:
+            columns.append(field)
+    chars = np.ascontiguousarray(np.concatenate(columns, axis=1).astype(np.uint8))
+    return chars.view(f'S{chars.shape[1]}').ravel().astype(str)
+
+def flair_dates(times):
+    """Formats datetimes like the JAEB tables (`%m/%d/%Y %I:%M:%S %p`, only the date at midnight)."""
+    times = pd.DatetimeIndex(times)
+    date = [(times.month, 2), '/', (times.day, 2), '/', (times.year, 4)]
+    am_pm = np.frombuffer(np.where(times.hour < 12, 'AM', 'PM').astype('S2').tobytes(), dtype=np.uint8).reshape(-1, 2)
+    formatted = format_datetimes(times, date + [' ', ((times.hour + 11) % 12 + 1, 2), ':', (times.minute, 2), ':', (times.second, 2), ' ', am_pm])
+    return np.where(times == times.normalize(), format_datetimes(times, date), formatted)
+
+def iso_dates(times):
+    """Formats datetimes as `%Y-%m-%d %H:%M:%S`."""
+    times = pd.DatetimeIndex(times)
+    return format_datetimes(times, [(times.year, 4), '-', (times.month, 2), '-', (times.day, 2), ' ',
+                                    (times.hour, 2), ':', (times.minute, 2), ':', (times.second, 2)])
+
+def hms(durations):
+    """Formats durations as `HH:MM:SS` (the duration format of the Flair pump table)."""
+    seconds = pd.TimedeltaIndex(durations).total_seconds().astype(int)
+    return [f'{s // 3600:02d}:{s % 3600 // 60:02d}:{s % 60:02d}' for s in seconds]
+
+def iso_durations(durations):
+    """Formats durations as ISO 8601 durations (e.g. `PT1H30M`, the duration format of T1DEXI)."""
+    formatted = []
+    for s in pd.TimedeltaIndex(durations).total_seconds().astype(int):
+        parts = [f'{value}{unit}' for value, unit in [(s // 3600, 'H'), (s % 3600 // 60, 'M'), (s % 60, 'S')] if value]
+        formatted.append('PT' + (''.join(parts) or '0S'))
+    return formatted
+
+def add_duplicates(rng, df, fraction, mutate=None):
+    """
+    Appends copies of randomly selected rows next to the original rows (like the duplicates of the raw exports).
+
+    Args:
+        rng (np.random.Generator): The random generator.
+        df (pd.DataFrame): The table.
+        fraction (float): Fraction of rows that are duplicated.
+        mutate (callable, optional): Changes the copies (e.g. a different value at the same time).
+
+    Returns:
+        df (pd.DataFrame): The table with duplicates (and a new range index).
+    """
+    n = int(round(len(df) * fraction))
+    if n == 0:
+        return df.reset_index(drop=True)
+    copies = df.iloc[np.sort(rng.choice(len(df), n, replace=False))].copy()
+    if mutate is not None:
+        copies = mutate(copies)
+    return pd.concat([df, copies]).sort_index(kind='stable').reset_index(drop=True)
+
+def cgm(rng, start, days):
+    """
+    Returns 5 minute cgm readings in mg/dL (NaN for sensor warm-ups and dropouts, values can exceed 40-400 mg/dL).
+
+    Returns:
+        df (pd.DataFrame): `datetime` and `cgm` columns, one row per 5 minutes.
+    """
+    n = int(days * READINGS_PER_DAY)
+    times = start + _seconds(rng.integers(0, 300) + np.arange(n) * 300 + rng.integers(-2, 3, n))
+    walk = np.cumsum(rng.normal(0, 6, n))
+    window = max(min(n, READINGS_PER_DAY), 1)
+    trend = np.convolve(walk, np.ones(window) / window, mode='same')
+    daily = 30 * np.sin(np.arange(n) * 2 * np.pi / READINGS_PER_DAY + rng.uniform(0, 2 * np.pi))
+    values = np.clip(np.round(150 + walk - trend + daily), 30, 450)
+    #dropouts and a 2 hour warm-up every 10 days (sensor change)
+    values[rng.random(n) < 0.01] = np.nan
+    for i in range(0, n, 10 * READINGS_PER_DAY):
+        values[i:i + 24] = np.nan
+    return pd.DataFrame({'datetime': times, 'cgm': values})
+
+def boluses(rng, start, days, per_day=5, extended_fraction=0.1):
+    """
+    Returns boluses, some with an extended part (`normal` is 0 for purely extended boluses).
+
+    Returns:
+        df (pd.DataFrame): `datetime` (start of the delivery), `normal`, `extended` (units) and `duration` (of the extended part).
+    """
+    n = rng.poisson(per_day * days)
+    amount = np.maximum(_round(rng.gamma(2, 2, n), 0.05), 0.05)
+    extended = rng.random(n) < extended_fraction
+    share = np.where(rng.random(n) < 0.2, 1, rng.uniform(0.3, 0.8, n))
+    extended_part = np.where(extended, _round(amount * share, 0.05), 0)
+    return pd.DataFrame({'datetime': start + _seconds(np.sort(rng.integers(0, int(days * 86400), n))),
+                         'normal': np.round(amount - extended_part, 2),
+                         'extended': np.round(extended_part, 2),
+                         'duration': pd.to_timedelta(np.where(extended, rng.integers(1, 9, n) * 30, 0), unit='m')})
+
+def basal_profile(rng):
+    """Returns a daily basal profile `(hours, rates)` with 3 to 6 segments (the first one starting at midnight)."""
+    k = rng.integers(3, 7)
+    hours = np.concatenate([[0], np.sort(rng.choice(np.arange(1, 24), k - 1, replace=False))])
+    return hours, _round(rng.uniform(0.3, 1.5, k), 0.025)
+
+def scheduled_rates(profile, times):
+    hours, rates = profile
+    times = pd.DatetimeIndex(times)
+    return rates[np.searchsorted(hours, times.hour + times.minute / 60, side='right') - 1]
+
+def scheduled_basals(profile, start, days):
+    """Returns the start of each basal profile segment: `datetime`, `rate` and `duration` (until the next segment)."""
+    hours, _ = profile
+    offsets = (np.arange(int(np.ceil(days)))[:, None] * 24 + hours[None, :]).ravel()
+    times = start.normalize() + pd.to_timedelta(offsets, unit='h')
+    times = times[(times >= start) & (times < start + pd.Timedelta(days=days))]
+    durations = np.diff(times.append(pd.DatetimeIndex([times[-1] + pd.Timedelta(hours=24 - hours[-1])]))) if len(times) else []
+    return pd.DataFrame({'datetime': times, 'rate': scheduled_rates(profile, times), 'duration': pd.to_timedelta(durations)})
+
+def _events(rng, start, days, per_day, slot_hours, max_minutes, step_minutes):
+    #events start in distinct slots, so that events of the same kind never overlap
+    slots = int(days * 24 // slot_hours)
+    n = min(rng.poisson(per_day * days), slots)
+    times = start + pd.to_timedelta(np.sort(rng.choice(slots, n, replace=False)) * slot_hours * 60 + rng.integers(0, 60, n), unit='m')
+    durations = pd.to_timedelta(rng.integers(1, max_minutes // step_minutes + 1, n) * step_minutes, unit='m')
+    return pd.DataFrame({'datetime': times, 'duration': durations})
+
+def temp_basals(rng, start, days, profile, per_day=0.8):
+    """
+    Returns temporary basal rates, either relative (`Percent`) or absolute (`Rate`).
+
+    Returns:
+        df (pd.DataFrame): `datetime`, `duration`, `type`, `amount` (percent or U/hr) and `rate` (the resulting U/hr).
+    """
+    df = _events(rng, start, days, per_day, 3, 150, 30)
+    percent = rng.random(len(df)) < 0.6
+    df['type'] = np.where(percent, 'Percent', 'Rate')
+    df['amount'] = np.where(percent, rng.choice([0, 30, 50, 70, 80, 120, 150, 200], len(df)), _round(rng.uniform(0, 2, len(df)), 0.05))
+    df['rate'] = np.where(percent, scheduled_rates(profile, df.datetime) * df.amount / 100, df.amount)
+    return df
+
+def suspends(rng, start, days, per_day=0.3):
+    """Returns pump suspends: `datetime` and `duration`."""
+    return _events(rng, start, days, per_day, 4, 120, 10)
+
+def closed_loop_basals(rng, start, days, profile):
+    """Returns the basal rates commanded by a closed loop algorithm every 5 minutes: `datetime` and `rate`."""
+    n = int(days * READINGS_PER_DAY)
+    times = start + _seconds(rng.integers(0, 300) + np.arange(n) * 300)
+    #the algorithm keeps its adjustment for a while
+    changes = rng.random(n) < 0.3
+    changes[0] = True
+    factors = rng.choice([0, 0, 0.5, 0.8, 1, 1, 1, 1.2, 1.5, 2], n)[np.maximum.accumulate(np.where(changes, np.arange(n), 0))]
+    return pd.DataFrame({'datetime': times, 'rate': np.round(scheduled_rates(profile, times) * factors, 3)})
+
+def changes_only(df, column):
+    """Keeps only rows where the value changed (rate change tables only report changes)."""
+    return df.loc[df[column].ne(df[column].shift())]
+
+def _patient_start(rng, start):
+    return start + pd.Timedelta(days=int(rng.integers(0, 30)))
+
+def _clock_correction(rng, times, days, start):
+    """
+    Returns `(reported, adjusted)` datetimes of a patient. For some patients the pump clock was off until the middle
+    of the study, the reported datetimes are shifted for these rows and the adjusted datetimes hold the correct time.
+    """
+    times = pd.DatetimeIndex(times)
+    adjusted = pd.Series(pd.NaT, index=range(len(times)), dtype='datetime64[ns]')
+    if rng.random() < 0.25:
+        wrong = times < start + pd.Timedelta(days=days / 2)
+        adjusted[wrong] = times[wrong]
+        times = times.where(~wrong, times + pd.Timedelta(hours=int(rng.choice([-8, -1, 1, 12]))))
+    return times, adjusted
+
+def _format_optional(times, fmt):
+    times = pd.Series(times)
+    return pd.Series(np.where(times.notna(), fmt(times.fillna(pd.Timestamp(0))), None))
+
+def write_dclp(path, rng, patients, days, start, duplicates, dclp5=False):
+    """Writes the Tandem tables of DCLP3 (`Data Files`, ISO datetimes) or DCLP5 (study folder, JAEB datetimes)."""
+    fmt = flair_dates if dclp5 else iso_dates
+    tables = {'bolus': [], 'basal': [], 'cgm': []}
+    for pt in range(1, patients + 1):
+        pt_start = _patient_start(rng, start)
+        profile = basal_profile(rng)
+        bolus = boluses(rng, pt_start, days)
+        #the extended part is reported when it completes
+        rows = pd.concat([pd.DataFrame({'datetime': bolus.datetime, 'BolusAmount': bolus.normal, 'BolusType': 'Standard'})[bolus.normal > 0],
+                          pd.DataFrame({'datetime': bolus.datetime + bolus.duration, 'BolusAmount': bolus.extended, 'BolusType': 'Extended'})[bolus.extended > 0]])
+        rows = rows.sort_values('datetime', kind='stable')
+        basal = changes_only(closed_loop_basals(rng, pt_start, days, profile), 'rate').rename(columns={'rate': 'CommandedBasalRate'})
+        glucose = cgm(rng, pt_start, days).dropna()
+        #out of range readings are reported as 0 with a high (1) or low (2) indicator
+        glucose['HighLowIndicator'] = np.select([glucose.cgm > 400, glucose.cgm < 40], [1, 2], 0)
+        glucose['CGMValue'] = glucose.cgm.where(glucose.HighLowIndicator == 0, 0).astype(int)
+        for name, df in [('bolus', rows), ('basal', basal), ('cgm', glucose)]:
+            times, adjusted = _clock_correction(rng, df.datetime, days, pt_start)
+            df = df.assign(PtID=pt, DataDtTm=fmt(times), DataDtTm_adjusted=_format_optional(adjusted, fmt).values)
+            tables[name].append(df)
+
+    columns = {'bolus': ['PtID', 'DataDtTm', 'DataDtTm_adjusted', 'BolusAmount', 'BolusType'],
+               'basal': ['PtID', 'DataDtTm', 'DataDtTm_adjusted', 'CommandedBasalRate'],
+               'cgm': ['PtID', 'DataDtTm', 'DataDtTm_adjusted', 'CGMValue', 'HighLowIndicator']}
+    #duplicated rates and readings with different values
+    mutations = {'bolus': None,
+                 'basal': lambda df: df.assign(CommandedBasalRate=np.round(df.CommandedBasalRate + 0.1, 3)),
+                 'cgm': lambda df: df.assign(CGMValue=df.CGMValue + rng.integers(1, 5, len(df)))}
+    if dclp5:
+        folder, names = path, {'bolus': 'DCLP5TandemBolus_Completed_Combined_b.txt', 'basal': 'DCLP5TandemBASALRATECHG_b.txt', 'cgm': 'DCLP5TandemCGMDATAGXB_b.txt'}
+    else:
+        folder, names = os.path.join(path, 'Data Files'), {'bolus': 'Pump_BolusDelivered.txt', 'basal': 'Pump_BasalRateChange.txt', 'cgm': 'Pump_CGMGlucoseValue.txt'}
+    os.makedirs(folder, exist_ok=True)
+    for name, dfs in tables.items():
+        df = add_duplicates(rng, pd.concat(dfs, ignore_index=True)[columns[name]], duplicates, mutations[name])
+        df.insert(0, 'RecID', np.arange(1, len(df) + 1))
+        df.to_csv(os.path.join(folder, names[name]), sep='|', index=False)
+
+def write_dclp3(path, rng, patients, days, start, duplicates):
+    write_dclp(path, rng, patients, days, start, duplicates)
+
+def write_dclp5(path, rng, patients, days, start, duplicates):
+    write_dclp(path, rng, patients, days, start, duplicates, dclp5=True)
+
+def write_pedap(path, rng, patients, days, start, duplicates):
+    """Writes the Tandem tables of PEDAP. Extended boluses are reported at completion with their duration in minutes."""
+    bolus_rows, basal_rows, cgm_rows = [], [], []
+    for pt in range(1, patients + 1):
+        pt_start = _patient_start(rng, start)
+        profile = basal_profile(rng)
+        bolus = boluses(rng, pt_start, days)
+        bolus_rows += [pd.DataFrame({'PtID': pt, 'DeviceDtTm': bolus.datetime, 'BolusAmount': bolus.normal, 'Duration': 0.0})[bolus.normal > 0],
+                       pd.DataFrame({'PtID': pt, 'DeviceDtTm': bolus.datetime + bolus.duration, 'BolusAmount': bolus.extended,
+                                     'Duration': bolus.duration.dt.total_seconds() / 60})[bolus.extended > 0]]
+        basal = changes_only(closed_loop_basals(rng, pt_start, days, profile), 'rate')
+        basal_rows.append(pd.DataFrame({'PtID': pt, 'DeviceDtTm': basal.datetime, 'BasalRate': basal.rate}))
+        glucose = cgm(rng, pt_start, days).dropna()
+        cgm_rows.append(pd.DataFrame({'PtID': pt, 'DeviceDtTm': glucose.datetime, 'CGMValue': glucose.cgm.clip(40, 400).astype(int)}))
+
+    folder = os.path.join(path, 'Data Files')
+    os.makedirs(folder, exist_ok=True)
+    bolus = pd.concat(bolus_rows).sort_values(['PtID', 'DeviceDtTm'], kind='stable')
+    bolus['DeviceDtTm'] = flair_dates(bolus.DeviceDtTm)
+    #a few boluses miss their datetime
+    bolus.loc[rng.random(len(bolus)) < 0.001, 'DeviceDtTm'] = None
+    for df, name in [(bolus, 'PEDAPTandemBOLUSDELIVERED.txt'),
+                     (pd.concat(basal_rows).assign(DeviceDtTm=lambda df: flair_dates(df.DeviceDtTm)), 'PEDAPTandemBASALRATECHG.txt'),
+                     (pd.concat(cgm_rows).assign(DeviceDtTm=lambda df: flair_dates(df.DeviceDtTm)), 'PEDAPTandemCGMDataGXB.txt')]:
+        df = add_duplicates(rng, df.reset_index(drop=True), duplicates)
+        df.insert(0, 'RecID', np.arange(1, len(df) + 1))
+        df.to_csv(os.path.join(folder, name), sep='|', index=False)
+
+def write_iobp2(path, rng, patients, days, start, duplicates):
+    """Writes the iLet table of IOBP2: one row per 5 minutes with the cgm and the insulin delivered since the previous row."""
+    rows = []
+    for pt in range(1, patients + 1):
+        pt_start = _patient_start(rng, start)
+        profile = basal_profile(rng)
+        n = int(days * READINGS_PER_DAY)
+        #the iLet reports on an exact 5 minute grid (midnight is reported without time)
+        times = pt_start + pd.to_timedelta(np.arange(n) * 5, unit='m')
+        basal = scheduled_rates(profile, times) * rng.choice([0, 0.5, 1, 1, 1.5, 2], n) * 5 / 60
+        correction = np.where(rng.random(n) < 0.05, _round(rng.uniform(0.05, 1, n), 0.05), 0)
+        meal = np.zeros(n)
+        bolus = boluses(rng, pt_start, days)
+        np.add.at(meal, np.minimum(((bolus.datetime - pt_start) // pd.Timedelta(minutes=5)).to_numpy(), n - 1), bolus.normal + bolus.extended)
+        rows.append(pd.DataFrame({'PtID': pt, 'DeviceDtTm': flair_dates(times), 'CGMVal': cgm(rng, pt_start, days).cgm.clip(39, 401).values,
+                                  'BasalDelivPrev': np.round(basal, 3), 'BolusDelivPrev': correction, 'MealBolusDelivPrev': np.round(meal, 2)}))
+    folder = os.path.join(path, 'Data Tables')
+    os.makedirs(folder, exist_ok=True)
+    df = add_duplicates(rng, pd.concat(rows, ignore_index=True), duplicates)
+    df.insert(0, 'RecID', np.arange(1, len(df) + 1))
+    df.to_csv(os.path.join(folder, 'IOBP2DeviceiLet.txt'), sep='|', index=False)
+
+def write_flair(path, rng, patients, days, start, duplicates):
+    """
+    Writes the Flair pump and cgm tables. The pump table holds one event per row: basal rate changes, temp basals
+    (followed by the scheduled rate for `Percent` temp basals), boluses, suspends, auto mode changes and daily TDDs.
+    """
+    pump_rows, cgm_rows = [], []
+    for pt in range(1, patients + 1):
+        pt_start = _patient_start(rng, start)
+        profile = basal_profile(rng)
+        schedule = scheduled_basals(profile, pt_start, days)
+        temps = temp_basals(rng, pt_start, days, profile)
+        percent = temps.loc[temps.type == 'Percent']
+        reported = pd.concat([percent.datetime + pd.Timedelta(seconds=1), percent.datetime + percent.duration + pd.Timedelta(seconds=1)])
+        bolus = boluses(rng, pt_start, days)
+        suspend = suspends(rng, pt_start, days)
+        mode_changes = pt_start + pd.to_timedelta(np.sort(rng.integers(0, int(days * 86400), max(int(days), 1))), unit='s')
+        day_ends = pt_start.normalize() + pd.to_timedelta(np.arange(1, int(np.ceil(days)) + 1), unit='D')
+        events = [pd.DataFrame({'DateTime': schedule.datetime, 'BasalRt': schedule.rate}),
+                  pd.DataFrame({'DateTime': reported, 'BasalRt': scheduled_rates(profile, reported)}),
+                  pd.DataFrame({'DateTime': temps.datetime, 'TempBasalAmt': temps.amount, 'TempBasalType': temps.type, 'TempBasalDur': hms(temps.duration)}),
+                  pd.DataFrame({'DateTime': bolus.datetime, 'BolusDeliv': bolus.normal + bolus.extended,
+                                'ExtendBolusDuration': np.where(bolus.extended > 0, hms(bolus.duration), None)}),
+                  pd.DataFrame({'DateTime': suspend.datetime, 'Suspend': rng.choice(['USER_SUSPEND', 'ALARM_SUSPEND', 'LOW_SG_SUSPEND'], len(suspend))}),
+                  pd.DataFrame({'DateTime': suspend.datetime + suspend.duration, 'Suspend': 'NORMAL_PUMPING'}),
+                  pd.DataFrame({'DateTime': mode_changes, 'AutoModeStatus': np.arange(len(mode_changes)) % 2 == 0}),
+                  pd.DataFrame({'DateTime': day_ends, 'TDD': _round(rng.normal(40, 8, len(day_ends)), 0.05)})]
+        pump = pd.concat([df for df in events if len(df)]).sort_values('DateTime', kind='stable')
+        pump['PtID'] = pt
+        pump_rows.append(pump)
+        glucose = cgm(rng, pt_start, days).dropna()
+        times, adjusted = _clock_correction(rng, glucose.datetime, days, pt_start)
+        cgm_rows.append(pd.DataFrame({'PtID': pt, 'DataDtTm': flair_dates(times), 'DataDtTm_adjusted': _format_optional(adjusted, flair_dates).values,
+                                      'CGM': glucose.cgm.clip(40, 400).astype(int).values}))
+
+    pump = pd.concat(pump_rows, ignore_index=True)
+    pump['DataDtTm'] = flair_dates(pump.DateTime)
+    #reindex: short periods may have no events of a kind (e.g. no suspends)
+    pump = pump.reindex(columns=['PtID', 'DataDtTm', 'BasalRt', 'TempBasalAmt', 'TempBasalType', 'TempBasalDur', 'BolusDeliv', 'ExtendBolusDuration',
+                                 'Suspend', 'AutoModeStatus', 'TDD'])
+    folder = os.path.join(path, 'Data Tables')
+    os.makedirs(folder, exist_ok=True)
+    for df, name in [(pump, 'FLAIRDevicePump.txt'), (pd.concat(cgm_rows, ignore_index=True), 'FLAIRDeviceCGM.txt')]:
+        df = add_duplicates(rng, df, duplicates)
+        df.insert(0, 'RecID', np.arange(1, len(df) + 1))
+        df.to_csv(os.path.join(folder, name), sep='|', index=False)
+
+def _replacebg_times(times):
+    delta = pd.DatetimeIndex(times) - REPLACEBG_ENROLLMENT
+    return {'DeviceDtTmDaysFromEnroll': delta.days, 'DeviceTm': hms(delta - pd.to_timedelta(delta.days, unit='D'))}
+
+def write_replacebg(path, rng, patients, days, start, duplicates):
+    """
+    Writes the device tables of REPLACE-BG. Datetimes are days from enrollment and time of day, durations are
+    milliseconds (Diasend bolus durations are minutes) and boluses reference their upload.
+    """
+    uploads, bolus_rows, basal_rows, cgm_rows = [], [], [], []
+    for pt in range(1, patients + 1):
+        #the data starts up to 3 weeks before enrollment
+        pt_start = REPLACEBG_ENROLLMENT + pd.Timedelta(days=int(rng.integers(-21, 0)))
+        profile = basal_profile(rng)
+        upload_ids = np.arange(len(uploads) + 1, len(uploads) + 3)
+        sources = rng.choice(['Carelink', 'Diasend', 'Tidepool'], len(upload_ids))
+        uploads += [{'RecID': upload_id, 'PtId': str(pt), 'DataSource': source} for upload_id, source in zip(upload_ids, sources)]
+
+        bolus = boluses(rng, pt_start, days)
+        parents = rng.choice(upload_ids, len(bolus))
+        diasend = sources[np.searchsorted(upload_ids, parents)] == 'Diasend'
+        extended = bolus.extended > 0
+        duration = bolus.duration.dt.total_seconds().to_numpy() * np.where(diasend, 1 / 60, 1000)
+        bolus_type = np.where(extended, np.where(bolus.normal > 0, 'Dual/Square', 'Square'), np.where(rng.random(len(bolus)) < 0.05, 'Combination', 'Normal'))
+        bolus_rows.append(pd.DataFrame({'ParentHDeviceUploadsID': parents, 'PtID': str(pt), **_replacebg_times(bolus.datetime), 'BolusType': bolus_type,
+                                        'Normal': bolus.normal, 'Extended': np.where(extended, bolus.extended, np.nan),
+                                        'Duration': np.where(extended, duration, np.nan), 'ExpectedNormal': bolus.normal,
+                                        'ExpectedExtended': np.where(extended, bolus.extended, np.nan),
+                                        'ExpectedDuration': np.where(extended, bolus.duration.dt.total_seconds() * 1000, np.nan)}))
+
+        #scheduled segments, temp basals and suspends (followed by the scheduled rate when they end)
+        schedule = scheduled_basals(profile, pt_start, days)
+        temps = temp_basals(rng, pt_start, days, profile)
+        suspend = suspends(rng, pt_start, days)
+        ends = pd.concat([temps.datetime + temps.duration, suspend.datetime + suspend.duration])
+        basal = pd.concat([pd.DataFrame({'datetime': schedule.datetime, 'BasalType': 'scheduled', 'Duration': schedule.duration, 'Rate': schedule.rate}),
+                           pd.DataFrame({'datetime': ends, 'BasalType': 'scheduled', 'Duration': pd.Timedelta(minutes=30), 'Rate': scheduled_rates(profile, ends)}),
+                           pd.DataFrame({'datetime': temps.datetime, 'BasalType': 'temp', 'Duration': temps.duration, 'Rate': np.round(temps.rate, 3),
+                                         'SuprBasalType': 'scheduled', 'SuprRate': scheduled_rates(profile, temps.datetime)}),
+                           pd.DataFrame({'datetime': suspend.datetime, 'BasalType': 'suspend', 'Duration': suspend.duration, 'Rate': np.nan})])
+        basal = basal.sort_values('datetime', kind='stable')
+        milliseconds = (basal.Duration.dt.total_seconds() * 1000).astype('int64')
+        basal_rows.append(pd.DataFrame({'ParentHDeviceUploadsID': rng.choice(upload_ids, len(basal)), 'PtID': str(pt), **_replacebg_times(basal.datetime),
+                                        'BasalType': basal.BasalType.values, 'Duration': milliseconds.values, 'ExpectedDuration': milliseconds.values,
+                                        'Rate': basal.Rate.values, 'SuprBasalType': basal.SuprBasalType.values, 'SuprDuration': np.nan,
+                                        'SuprRate': basal.SuprRate.values}))
+
+        glucose = cgm(rng, pt_start, days).dropna()
+        calibrations = glucose.sample(frac=2 / READINGS_PER_DAY, random_state=rng.integers(2**31)).sort_index()
+        readings = pd.concat([glucose.assign(RecordType='CGM'), calibrations.assign(RecordType='Calibration')]).sort_values('datetime', kind='stable')
+        cgm_rows.append(pd.DataFrame({'ParentHDeviceUploadsID': rng.choice(upload_ids), 'PtID': str(pt), **_replacebg_times(readings.datetime),
+                                      'RecordType': readings.RecordType.values, 'GlucoseValue': readings.cgm.clip(39, 401).astype(int).values}))
+
+    folder = os.path.join(path, 'Data Tables')
+    os.makedirs(folder, exist_ok=True)
+    #temporal duplicates have a new RecID (the latest record is kept)
+    for dfs, name in [(bolus_rows, 'HDeviceBolus.txt'), (basal_rows, 'HDeviceBasal.txt'), (cgm_rows, 'HDeviceCGM.txt')]:
+        df = add_duplicates(rng, pd.concat(dfs, ignore_index=True), duplicates)
+        df.insert(0, 'RecID', np.arange(1, len(df) + 1))
+        df.to_csv(os.path.join(folder, name), sep='|', index=False)
+    pd.DataFrame(uploads).to_csv(os.path.join(folder, 'HDeviceUploads.txt'), sep='|', index=False)
+    pd.DataFrame({'RecID': range(1, patients + 1), 'PtID': range(1, patients + 1),
+                  'TrtGroup': rng.choice(['CGM Only', 'CGM+BGM'], patients)}).to_csv(os.path.join(folder, 'HPtRoster.txt'), sep='|', index=False)
+
+def write_loop(path, rng, patients, days, start, duplicates, files=LOOP_FILES):
+    """
+    Writes the Loop tables: UTC datetimes, cgm in mmol/L and temp basals every few minutes. Cgm and basal records of
+    the patients are split across `files` files (`LOOPDeviceCGM1.txt`, ...).
+    """
+    roster, bolus_rows, basal_rows, cgm_rows = [], [], [], []
+    for pt in range(1, patients + 1):
+        offset = int(rng.choice([-8, -7, -6, -5, -4]))
+        roster.append({'RecID': pt, 'PtID': pt, 'PtTimezoneOffset': offset})
+        #datetimes are stored in UTC
+        pt_start = _patient_start(rng, start) - pd.Timedelta(hours=offset)
+        profile = basal_profile(rng)
+        bolus = boluses(rng, pt_start, days, extended_fraction=0.01)
+        extended = bolus.extended > 0
+        bolus_rows.append(pd.DataFrame({'PtID': pt, 'UTCDtTm': bolus.datetime, 'BolusType': np.where(extended, 'square', 'normal'),
+                                        'Normal': bolus.normal, 'Extended': np.where(extended, bolus.extended, np.nan),
+                                        'Duration': np.where(extended, bolus.duration.dt.total_seconds() * 1000, np.nan)}))
+        temps = changes_only(closed_loop_basals(rng, pt_start, days, profile), 'rate')
+        suspend = suspends(rng, pt_start, days, per_day=0.1)
+        basal = pd.concat([pd.DataFrame({'UTCDtTm': temps.datetime, 'BasalType': 'temp', 'Duration': 1800000, 'Rate': temps.rate}),
+                           pd.DataFrame({'UTCDtTm': suspend.datetime, 'BasalType': 'suspend', 'Duration': suspend.duration.dt.total_seconds().astype(int) * 1000, 'Rate': 0.0})])
+        basal_rows.append(basal.sort_values('UTCDtTm', kind='stable').assign(PtID=pt))
+        glucose = cgm(rng, pt_start, days).dropna()
+        records = np.where(rng.random(len(glucose)) < 0.002, 'Calibration', 'CGM')
+        cgm_rows.append(pd.DataFrame({'PtID': pt, 'UTCDtTm': glucose.datetime, 'RecordType': records, 'CGMVal': np.round(glucose.cgm.clip(39, 401) / 18.018, 5)}))
+
+    folder = os.path.join(path, 'Data Tables')
+    os.makedirs(folder, exist_ok=True)
+    pd.DataFrame(roster).to_csv(os.path.join(folder, 'PtRoster.txt'), sep='|', index=False)
+    bolus = add_duplicates(rng, pd.concat(bolus_rows, ignore_index=True), duplicates)
+    bolus.assign(UTCDtTm=iso_dates(bolus.UTCDtTm)).to_csv(os.path.join(folder, 'LOOPDeviceBolus.txt'), sep='|', index=False)
+    columns = {'Basal': ['PtID', 'UTCDtTm', 'BasalType', 'Duration', 'Rate'], 'CGM': ['PtID', 'UTCDtTm', 'RecordType', 'CGMVal']}
+    for name, dfs in [('Basal', basal_rows), ('CGM', cgm_rows)]:
+        for i, group in enumerate(np.array_split(np.arange(patients), min(files, patients)), start=1):
+            df = add_duplicates(rng, pd.concat([dfs[j] for j in group], ignore_index=True)[columns[name]], duplicates)
+            df.assign(UTCDtTm=iso_dates(df.UTCDtTm)).to_csv(os.path.join(folder, f'LOOPDevice{name}{i}.txt'), sep='|', index=False)
+
+def _sas_datetimes(times):
+    return (pd.DatetimeIndex(times) - SAS_EPOCH).total_seconds().values
+
+def write_t1dexi(path, rng, patients, days, start, duplicates, study='T1DEXI'):
+    """
+    Writes the DX, FACM and LB tables of T1DEXI (or T1DEXIP) as XPORT files. Pump patients report basal flow rates
+    (with ISO durations, suspends and overlaps) and boluses with normal and extended parts, patients on multiple
+    daily injections report basal and bolus injections.
+    """
+    dx_rows, facm_rows, lb_rows = [], [], []
+    for pt in range(1, patients + 1):
+        usubjid = str(pt)
+        pt_start = _patient_start(rng, start)
+        profile = basal_profile(rng)
+        device = rng.choice(['INSULIN PUMP', 'CLOSED LOOP INSULIN PUMP', 'MULTIPLE DAILY INJECTIONS'], p=[0.3, 0.4, 0.3])
+        mdi = device == 'MULTIPLE DAILY INJECTIONS'
+        dx_rows.append({'USUBJID': usubjid, 'SPDEVID': '', 'DXSEQ': 1.0, 'DXTRT': device, 'DXCAT': 'INSULIN DELIVERY', 'DXSCAT': '',
+                        'DXPRESP': 'Y', 'DXSTRTPT': '', 'DXDTC': _sas_datetimes([pt_start])[0], 'DXENRTPT': '', 'DXEVINTX': '', 'VISIT': 'SCREENING'})
+
+        bolus = boluses(rng, pt_start, days, extended_fraction=0 if mdi else 0.1)
+        extended = bolus.extended > 0
+        facm = [pd.DataFrame({'FATEST': 'BOLUS INSULIN', 'FACAT': 'BOLUS', 'FADTC': bolus.datetime, 'FAORRES': bolus.normal + bolus.extended,
+                              'FAORRESU': 'U', 'FADUR': np.where(extended, iso_durations(bolus.duration), ''),
+                              'INSNMBOL': np.nan if mdi else bolus.normal.where(bolus.normal > 0),
+                              'INSEXBOL': bolus.extended.where(extended), 'INSSTYPE': np.where(extended, 'extended', 'normal')})]
+        if mdi:
+            injections = pt_start.normalize() + pd.to_timedelta(np.arange(int(np.ceil(days))) * 24 + 22, unit='h') + _seconds(rng.integers(0, 3600, int(np.ceil(days))))
+            facm.append(pd.DataFrame({'FATEST': 'BASAL INSULIN', 'FACAT': 'BASAL', 'FADTC': injections,
+                                      'FAORRES': _round(rng.normal(profile[1].mean() * 24, 1, len(injections)), 0.5), 'FAORRESU': 'U', 'FADUR': ''}))
+        else:
+            if device == 'CLOSED LOOP INSULIN PUMP':
+                rates = changes_only(closed_loop_basals(rng, pt_start, days, profile), 'rate').assign(INSSTYPE='scheduled')
+            else:
+                schedule, temps = scheduled_basals(profile, pt_start, days), temp_basals(rng, pt_start, days, profile)
+                rates = pd.concat([schedule.assign(INSSTYPE='scheduled'), temps.assign(INSSTYPE='temp')]).sort_values('datetime', kind='stable')
+            suspend = suspends(rng, pt_start, days)
+            rates = pd.concat([rates[['datetime', 'rate', 'INSSTYPE']], suspend.assign(rate=0.0, INSSTYPE='suspend')[['datetime', 'rate', 'INSSTYPE']]])
+            rates = rates.sort_values('datetime', kind='stable')
+            durations = rates.datetime.shift(-1).fillna(rates.datetime.max() + pd.Timedelta(hours=1)) - rates.datetime
+            #some flow rates overlap with the next one
+            durations = durations.where(rng.random(len(rates)) > 0.02, durations + pd.Timedelta(minutes=30))
+            facm.append(pd.DataFrame({'FATEST': 'BASAL FLOW RATE', 'FACAT': 'BASAL', 'FADTC': rates.datetime, 'FAORRES': rates.rate,
+                                      'FAORRESU': 'U/hr', 'FADUR': iso_durations(durations), 'INSSTYPE': rates.INSSTYPE}))
+        facm = pd.concat(facm).sort_values('FADTC', kind='stable')
+        facm.insert(0, 'USUBJID', usubjid)
+        facm['INSDVSRC'] = 'Injections' if mdi else 'Pump'
+        facm_rows.append(facm)
+
+        glucose = cgm(rng, pt_start, days).dropna()
+        lb_rows += [pd.DataFrame({'USUBJID': usubjid, 'LBTESTCD': 'HBA1C', 'LBTEST': 'Hemoglobin A1C', 'LBCAT': 'CHEMISTRY',
+                                  'LBORRES': [round(rng.uniform(5.5, 9.5), 1)], 'LBORRESU': '%', 'LBDTC': [pt_start]}),
+                    pd.DataFrame({'USUBJID': usubjid, 'LBTESTCD': 'GLUC', 'LBTEST': 'Glucose', 'LBCAT': 'CGM',
+                                  'LBORRES': glucose.cgm.clip(40, 400).values, 'LBORRESU': 'mg/dL', 'LBDTC': glucose.datetime.values})]
+
+    os.makedirs(path, exist_ok=True)
+    dx = pd.DataFrame(dx_rows)
+    dx.insert(0, 'STUDYID', study)
+    dx.insert(1, 'DOMAIN', 'DX')
+    write_xport(dx, os.path.join(path, 'DX.xpt'), 'DX', 'Device Exposure')
+
+    #exact duplicates and duplicated flow rates with different values
+    facm = add_duplicates(rng, pd.concat(facm_rows, ignore_index=True), duplicates / 2)
+    facm = add_duplicates(rng, facm, duplicates / 2, lambda df: df.assign(FAORRES=df.FAORRES.where(df.FATEST != 'BASAL FLOW RATE', df.FAORRES + 0.05)))
+    facm['FADTC'] = _sas_datetimes(facm.FADTC)
+    facm = facm.assign(STUDYID=study, DOMAIN='FA', FASEQ=facm.groupby('USUBJID').cumcount() + 1.0, FAOBJ='INSULIN',
+                       FATESTCD=facm.FATEST.map({'BOLUS INSULIN': 'INSBOLUS', 'BASAL INSULIN': 'INSBASAL', 'BASAL FLOW RATE': 'INSBASFR'}),
+                       FASTRESC=facm.FAORRES.map('{:g}'.format), FASTRESN=facm.FAORRES, FASTRESU=facm.FAORRESU.where(facm.FAORRESU == 'U', ''))
+    facm = facm[['STUDYID', 'DOMAIN', 'USUBJID', 'FASEQ', 'FATESTCD', 'FATEST', 'FAOBJ', 'FACAT', 'FAORRES', 'FAORRESU', 'FASTRESC', 'FASTRESN',
+                 'FASTRESU', 'FADTC', 'FADUR', 'INSDVSRC', 'INSSTYPE', 'INSNMBOL', 'INSEXBOL']]
+    write_xport(facm, os.path.join(path, 'FACM.xpt'), 'FACM', 'Findings About Clinical Events - Insulin')
+
+    lb = add_duplicates(rng, pd.concat(lb_rows, ignore_index=True), duplicates)
+    lb['LBDTC'] = _sas_datetimes(lb.LBDTC)
+    lb.insert(0, 'STUDYID', study)
+    lb.insert(1, 'DOMAIN', 'LB')
+    lb.insert(3, 'LBSEQ', lb.groupby('USUBJID').cumcount() + 1.0)
+    write_xport(lb, os.path.join(path, 'LB.xpt'), 'LB', 'Laboratory Test Results')
+
+def write_t1dexip(path, rng, patients, days, start, duplicates):
+    write_t1dexi(path, rng, patients, days, start, duplicates, study='T1DEXIP')
+
+WRITERS = {'DCLP3': write_dclp3, 'DCLP5': write_dclp5, 'PEDAP': write_pedap, 'IOBP2': write_iobp2, 'Flair': write_flair,
+           'ReplaceBG': write_replacebg, 'Loop': write_loop, 'T1DEXI': write_t1dexi, 'T1DEXIP': write_t1dexip}
+
+def generate(out_path, studies=None, patients=10, days=7, seed=0, start='2020-01-01', duplicates=0.01):
+    """
+    Writes synthetic raw data of the supported studies, with the folder names, file names, columns and formats the
+    study classes expect.
+
+    The data is random but plausible: 5 minute cgm readings with gaps, basal profiles, temp basals, suspends, closed
+    loop basal rates, normal and extended boluses and duplicated rows. The output of a study only depends on the seed,
+    the number of patients and the duration (not on the other selected studies).
+
+    Example:
+        generate('data/synthetic/data/raw', patients=50, days=30)
+        # then process it: cd data/synthetic && python ../../run_functions.py
+
+    Args:
+        out_path (str): The raw data folder (the study folders are created inside).
+        studies (list, optional): Names of the studies (keys of `STUDY_FOLDERS`). Defaults to all.
+        patients (int): Number of patients per study.
+        days (float): Days of data per patient.
+        seed (int): Seed of the random generator.
+        start (str): Earliest start date of the patients' data.
+        duplicates (float): Fraction of duplicated rows in each table.
+
+    Returns:
+        folders (dict): The study folders by study name.
+    """
+    folders = {}
+    for study in studies or list(STUDY_FOLDERS):
+        if study not in WRITERS:
+            raise ValueError(f"Unknown study '{study}', must be one of {list(WRITERS)}")
+        folders[study] = os.path.join(out_path, STUDY_FOLDERS[study])
+        rng = np.random.default_rng([seed, zlib.crc32(study.encode())])
+        WRITERS[study](folders[study], rng, patients, days, pd.Timestamp(start), duplicates)
+    return folders
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate synthetic raw study data (e.g. for tests and benchmarks).")
+    parser.add_argument('--out', default='data/synthetic/data/raw', help="Raw data folder to write the study folders to.")
+    parser.add_argument('--studies', nargs='+', choices=list(STUDY_FOLDERS), help="Studies to generate (default: all).")
+    parser.add_argument('--patients', type=int, default=10, help="Number of patients per study.")
+    parser.add_argument('--days', type=float, default=7, help="Days of data per patient.")
+    parser.add_argument('--seed', type=int, default=0, help="Seed of the random generator.")
+    parser.add_argument('--duplicates', type=float, default=0.01, help="Fraction of duplicated rows in each table.")
+    args = parser.parse_args()
+    for study, folder in generate(args.out, args.studies, args.patients, args.days, args.seed, duplicates=args.duplicates).items():
+        print(f"{study}: {folder}")
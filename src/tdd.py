@@ -123,6 +123,7 @@ def calculate_tdd(df_bolus, df_basal):
     Returns:
         tdd (DataFrame): DataFrame containing both the bolus and basal tdd data.
     """
-    daily_basals = df_basal.groupby('patient_id').apply(calculate_daily_basal_dose, include_groups=False )
-    daily_bolus = df_bolus.groupby('patient_id').apply(calculate_daily_bolus_dose, include_groups=False)
+    #observed=True: skip patients that are not in the data when patient_id is categorical (compact dtypes)
+    daily_basals = df_basal.groupby('patient_id', observed=True).apply(calculate_daily_basal_dose, include_groups=False )
+    daily_bolus = df_bolus.groupby('patient_id', observed=True).apply(calculate_daily_bolus_dose, include_groups=False)
     return daily_basals.merge(daily_bolus, how='outer', on=['patient_id', 'date'])
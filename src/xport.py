@@ -0,0 +1,88 @@
+import struct
+from datetime import datetime
+import numpy as np
+import pandas as pd
+
+#80 byte header records of the SAS transport (XPORT version 5) format
+LIBRARY_HEADER = 'HEADER RECORD*******LIBRARY HEADER RECORD!!!!!!!000000000000000000000000000000  '
+MEMBER_HEADER = 'HEADER RECORD*******MEMBER  HEADER RECORD!!!!!!!000000000000000001600000000140  '
+DESCRIPTOR_HEADER = 'HEADER RECORD*******DSCRPTR HEADER RECORD!!!!!!!000000000000000000000000000000  '
+NAMESTR_HEADER = 'HEADER RECORD*******NAMESTR HEADER RECORD!!!!!!!000000{:04d}00000000000000000000  '
+OBS_HEADER = 'HEADER RECORD*******OBS     HEADER RECORD!!!!!!!000000000000000000000000000000  '
+
+def to_ibm_float(values):
+    """
+    Converts floats to 8 byte IBM hexadecimal floating point numbers (the numeric format of XPORT files).
+
+    The conversion is exact, IBM floats have a 56 bit fraction. NaNs are stored as the SAS missing value `.`.
+
+    Args:
+        values (array-like): The values.
+
+    Returns:
+        ibm (np.ndarray): The IBM floats as big endian uint64.
+    """
+    values = np.asarray(values, dtype=float)
+    ibm = np.zeros(len(values), dtype=np.uint64)
+    ibm[np.isnan(values)] = np.uint64(0x2e) << np.uint64(56)
+    nonzero = ~np.isnan(values) & (values != 0)
+    #x = m * 2^e with 0.5 <= m < 1 and x = f * 16^e16 with 1/16 <= f < 1
+    mantissa, exponent = np.frexp(np.abs(values[nonzero]))
+    exponent16 = -(-exponent // 4)
+    shift = (4 * exponent16 - exponent).astype(np.uint64)
+    fraction = np.ldexp(mantissa, 53).astype(np.uint64) << (np.uint64(3) - shift)
+    sign = (values[nonzero] < 0).astype(np.uint64) << np.uint64(63)
+    ibm[nonzero] = sign | ((exponent16 + 64).astype(np.uint64) << np.uint64(56)) | fraction
+    return ibm.astype('>u8')
+
+def _pad(data, fill=b' '):
+    return data + fill * (-len(data) % 80)
+
+def _namestr(number, name, is_numeric, length, position):
+    return struct.pack('>hhhh8s40s8shhh2s8shhl52s', 1 if is_numeric else 2, 0, length, number, name.encode().ljust(8),
+                       name.encode().ljust(40), b' ' * 8, 0, 0, 0, b'\x00\x00', b' ' * 8, 0, 0, position, b'\x00' * 52)
+
+def write_xport(df, file_path, name, label='', created=None):
+    """
+    Writes a dataframe as SAS transport file (XPORT version 5, the `.xpt` files of the T1DEXI studies).
+
+    Numeric columns are stored as 8 byte IBM floats (NaNs as missing values), all other columns as blank padded latin-1
+    strings (NaNs as empty strings). The file can be read with `pd.read_sas`.
+
+    Args:
+        df (pd.DataFrame): The data (column names with at most 8 characters).
+        file_path (str): The output file.
+        name (str): The dataset name (at most 8 characters, e.g. 'FACM').
+        label (str): The dataset label (at most 40 characters).
+        created (datetime, optional): Creation time stored in the headers. Defaults to 2020-01-01 (reproducible files).
+    """
+    timestamp = (created or datetime(2020, 1, 1)).strftime('%d%b%y:%H:%M:%S').upper()
+    columns, namestrs, position = [], [], 0
+    for number, column in enumerate(df.columns, start=1):
+        values = df[column]
+        if pd.api.types.is_numeric_dtype(values):
+            data = to_ibm_float(values.astype(float)).view(np.uint8).reshape(-1, 8)
+        else:
+            encoded = np.array(values.fillna('').astype(str).str.encode('latin-1').tolist() or [b''], dtype=bytes)[:len(values)]
+            length = max(encoded.dtype.itemsize, 1)
+            #numpy pads with null bytes, SAS with blanks
+            data = np.frombuffer(encoded.astype(f'S{length}').tobytes(), dtype=np.uint8).reshape(-1, length).copy()
+            data[data == 0] = ord(' ')
+        columns.append(data)
+        namestrs.append(_namestr(number, column, pd.api.types.is_numeric_dtype(values), data.shape[1], position))
+        position += data.shape[1]
+
+    header = ''.join([LIBRARY_HEADER,
+                      f"{'SAS':8}{'SAS':8}{'SASLIB':8}{'9.4':8}{'X64_7PRO':8}{'':24}{timestamp}",
+                      f"{timestamp}{'':64}",
+                      MEMBER_HEADER,
+                      DESCRIPTOR_HEADER,
+                      f"{'SAS':8}{name:8}{'SASDATA':8}{'9.4':8}{'X64_7PRO':8}{'':24}{timestamp}",
+                      f"{timestamp}{'':16}{label:40}{'DATA':8}",
+                      NAMESTR_HEADER.format(len(df.columns))]).encode()
+    rows = np.concatenate(columns, axis=1) if columns else np.empty((len(df), 0), dtype=np.uint8)
+    with open(file_path, 'wb') as f:
+        f.write(header)
+        f.write(_pad(b''.join(namestrs)))
+        f.write(OBS_HEADER.encode())
+        f.write(_pad(np.ascontiguousarray(rows).tobytes()))
@@ -1,8 +1,16 @@
-from .dclp import DCLP3,DCLP5
-from .flair import Flair
-from .iobp2 import IOBP2
-from .loop import Loop
-from .t1dexi import T1DEXI, T1DEXIP
-from .pedap import PEDAP
-from .studydataset import StudyDataset
-from .replacebg import ReplaceBG
\ No newline at end of file
+import importlib
+
+#the study classes are imported on first access, e.g. `from studies import DCLP3` does not import the other studies
+_MODULES = {'DCLP3': 'dclp', 'DCLP5': 'dclp', 'Flair': 'flair', 'IOBP2': 'iobp2', 'Loop': 'loop', 'T1DEXI': 't1dexi', 'T1DEXIP': 't1dexi',
+            'PEDAP': 'pedap', 'StudyDataset': 'studydataset', 'ReplaceBG': 'replacebg'}
+__all__ = list(_MODULES)
+
+def __getattr__(name):
+    if name not in _MODULES:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(f".{_MODULES[name]}", __name__), name)
+    globals()[name] = value
+    return value
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
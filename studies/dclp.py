@@ -1,61 +1,60 @@
 import os
+import functools
 import pandas as pd
-from functools import reduce
 from datetime import timedelta
-import numpy as np
 
 from src.find_periods import find_periods, Period
-from src import pandas_helper
+from src.pandas_helper import DuplicatePolicy
 from .studydataset import StudyDataset
 from src.date_helper import parse_flair_dates
 
 class DCLP3(StudyDataset):
-    def _load_data(self, subset):
+    #raw table holding each stream and the columns read from it
+    STREAM_TABLES = {'bolus_event_history': 'bolus', 'basal_event_history': 'basal', 'cgm_history': 'cgm'}
+    TABLE_COLUMNS = {'bolus': ['RecID', 'PtID', 'DataDtTm', 'BolusAmount', 'BolusType', 'DataDtTm_adjusted'],
+                     'basal': ['RecID', 'PtID', 'DataDtTm', 'CommandedBasalRate', 'DataDtTm_adjusted'],
+                     'cgm': ['RecID', 'PtID', 'DataDtTm', 'CGMValue', 'DataDtTm_adjusted', 'HighLowIndicator']}
+    #for cgm we just keep the first value, for basal we decided to use the maximum value
+    DUPLICATE_POLICIES = {'cgm': [DuplicatePolicy(['PtID', 'DataDtTm'], 'first')],
+                          'basal': [DuplicatePolicy(['PtID', 'DataDtTm'], 'max', 'CommandedBasalRate')]}
+
+    def __init__(self, study_path, **kwargs):
+        super().__init__(study_path, 'DCLP3', **kwargs)
         data_table_path = os.path.join(self.study_path, 'Data Files')
-        df_bolus = pd.read_csv(os.path.join(data_table_path, 'Pump_BolusDelivered.txt'), sep='|', low_memory=False, 
-                               usecols=['RecID', 'PtID', 'DataDtTm', 'BolusAmount', 'BolusType', 'DataDtTm_adjusted'],
-                               skiprows=lambda x: (x % 10 != 0) & subset)
-        df_basal = pd.read_csv(os.path.join(data_table_path, 'Pump_BasalRateChange.txt'), sep='|', low_memory=False, 
-                               usecols=['RecID', 'PtID', 'DataDtTm', 'CommandedBasalRate', 'DataDtTm_adjusted'],
-                               skiprows=lambda x: (x % 10 != 0) & subset)
-        df_cgm = pd.read_csv(os.path.join(data_table_path, 'Pump_CGMGlucoseValue.txt'), sep='|', low_memory=False, 
-                             usecols=['RecID', 'PtID', 'DataDtTm', 'CGMValue', 'DataDtTm_adjusted', 'HighLowIndicator'],
-                             skiprows=lambda x: (x % 10 != 0) & subset)
+        self.table_files = {'bolus': os.path.join(data_table_path, 'Pump_BolusDelivered.txt'),
+                            'basal': os.path.join(data_table_path, 'Pump_BasalRateChange.txt'),
+                            'cgm': os.path.join(data_table_path, 'Pump_CGMGlucoseValue.txt')}
+        self.datetime_col = 'datetime'
+        self.df_bolus = None
+        self.df_basal = None
+        self.df_cgm = None
 
-        # Handle duplicates
-        # for cgm we just keep the first value
-        df_cgm.drop_duplicates(['PtID', 'DataDtTm'], keep='first', inplace=True)
-        # for basal we decided top use the maximum value
-        _, _, drop_indexes = pandas_helper.get_duplicated_max_indexes(df_basal, ['PtID', 'DataDtTm'], 'CommandedBasalRate')
-        df_basal.drop(drop_indexes, inplace=True)
+    def _read_table(self, name, subset, usecols=None):
+        return pd.read_csv(self.table_files[name], sep='|', low_memory=False, usecols=usecols or self.TABLE_COLUMNS[name],
+                           skiprows=lambda x: (x % 10 != 0) & subset)
 
-        #remove patients with incomplete data
-        intersecting_ids = reduce(np.intersect1d, (df_basal.PtID.unique(), df_bolus.PtID.unique(), df_cgm.PtID.unique()))
-        df_basal = df_basal[df_basal.PtID.isin(intersecting_ids)]
-        df_bolus = df_bolus[df_bolus.PtID.isin(intersecting_ids)]
-        df_cgm = df_cgm[df_cgm.PtID.isin(intersecting_ids)]
-        
-        #force datatypes (needed for output validation)
-        df_cgm['PtID'] = df_cgm.PtID.astype(str)
-        df_bolus['PtID'] = df_bolus.PtID.astype(str)
-        df_basal['PtID'] = df_basal.PtID.astype(str)
+    def _read_patients(self, name, subset):
+        return self._read_table(name, subset, ['PtID']).PtID
 
-        self.datetime_col = 'datetime'
+    def _parse_table(self, name, df):
+        df = self._deduplicate(df, name, self.DUPLICATE_POLICIES.get(name, []))
+        #force datatypes (needed for output validation)
+        df['PtID'] = df.PtID.astype(str)
         #setting datetimes (using the adjusted datetime if available)
-        df_bolus[self.datetime_col] = pd.to_datetime(df_bolus.DataDtTm_adjusted.fillna(df_bolus.DataDtTm))
-        df_basal[self.datetime_col] = pd.to_datetime(df_basal.DataDtTm_adjusted.fillna(df_basal.DataDtTm))
-        df_cgm[self.datetime_col] = pd.to_datetime(df_cgm.DataDtTm_adjusted.fillna(df_cgm.DataDtTm))
+        df[self.datetime_col] = pd.to_datetime(df.DataDtTm_adjusted.fillna(df.DataDtTm))
+        df = df.drop(columns=['DataDtTm', 'DataDtTm_adjusted'])
+        return df.sort_values(by=['PtID', self.datetime_col])
 
-        df_cgm.drop(columns=['DataDtTm', 'DataDtTm_adjusted'], inplace=True)
-        df_bolus.drop(columns=['DataDtTm', 'DataDtTm_adjusted'], inplace=True)
-        df_basal.drop(columns=['DataDtTm', 'DataDtTm_adjusted'], inplace=True)
-        
-        self.df_bolus = df_bolus.sort_values(by=['PtID',self.datetime_col])
-        self.df_basal = df_basal.sort_values(by=['PtID',self.datetime_col])
-        self.df_cgm = df_cgm.sort_values(by=['PtID',self.datetime_col])
-    
-    def __init__(self, study_path):
-        super().__init__(study_path, 'DCLP3')
+    def _load_streams(self, streams, subset):
+        names = self._missing_tables(streams)
+        #remove patients with incomplete data (first, so that all following steps only process remaining rows)
+        #tables of other streams are only read for their patient ids
+        tables = self._load_patient_tables(names,
+                                           {name: functools.partial(self._read_table, name, subset) for name in self.TABLE_COLUMNS},
+                                           {name: functools.partial(self._read_patients, name, subset) for name in self.TABLE_COLUMNS})
+        for name, df in tables.items():
+            setattr(self, f'df_{name}', self._parse_table(name, df))
+        return self._available_streams()
 
     def _extract_basal_event_history(self):
         temp = self.df_basal.copy()
@@ -101,43 +100,24 @@ class DCLP3(StudyDataset):
         return df_cgm
 
 class DCLP5(DCLP3):
-    def __init__(self, study_path):
-        super().__init__(study_path)
+    def __init__(self, study_path, **kwargs):
+        super().__init__(study_path, **kwargs)
         self.study_name = 'DCLP5'
-    
-    def _load_data(self, subset):
-        df_bolus = pd.read_csv(os.path.join(self.study_path, 'DCLP5TandemBolus_Completed_Combined_b.txt'), sep='|', low_memory=False, 
-                               usecols=['RecID', 'PtID', 'DataDtTm', 'BolusAmount', 'BolusType', 'DataDtTm_adjusted'],
-                               skiprows=lambda x: (x % 10 != 0) & subset)
-        df_basal = pd.read_csv(os.path.join(self.study_path, 'DCLP5TandemBASALRATECHG_b.txt'), sep='|', low_memory=False, 
-                               usecols=['RecID', 'PtID', 'DataDtTm', 'CommandedBasalRate', 'DataDtTm_adjusted'],
-                               skiprows=lambda x: (x % 10 != 0) & subset)
-        df_cgm = pd.read_csv(os.path.join(self.study_path, 'DCLP5TandemCGMDATAGXB_b.txt'), sep='|', low_memory=False, 
-                             usecols=['RecID', 'PtID', 'DataDtTm', 'CGMValue', 'DataDtTm_adjusted', 'HighLowIndicator'],
-                             skiprows=lambda x: (x % 10 != 0) & subset)
-
-        # Handle duplicates
-        # for cgm we just keep the first value
-        df_cgm.drop_duplicates(['PtID', 'DataDtTm'], keep='first', inplace=True)
-        # for basal we decided top use the maximum value
-        _, _, drop_indexes = pandas_helper.get_duplicated_max_indexes(df_basal, ['PtID', 'DataDtTm'], 'CommandedBasalRate')
-        df_basal.drop(drop_indexes, inplace=True)
+        self.table_files = {'bolus': os.path.join(self.study_path, 'DCLP5TandemBolus_Completed_Combined_b.txt'),
+                            'basal': os.path.join(self.study_path, 'DCLP5TandemBASALRATECHG_b.txt'),
+                            'cgm': os.path.join(self.study_path, 'DCLP5TandemCGMDATAGXB_b.txt')}
 
+    def _parse_table(self, name, df):
+        df = self._deduplicate(df, name, self.DUPLICATE_POLICIES.get(name, []))
         #force datatypes (needed for output validation)
-        df_cgm['PtID'] = df_cgm.PtID.astype(str)
-        df_bolus['PtID'] = df_bolus.PtID.astype(str)
-        df_basal['PtID'] = df_basal.PtID.astype(str)
-
+        df['PtID'] = df.PtID.astype(str)
         #setting datetimes (using the adjusted datetime if available)
-        self.datetime_col = 'datetime'
-        df_bolus[self.datetime_col] = df_bolus.DataDtTm_adjusted.fillna(df_bolus.DataDtTm).transform(parse_flair_dates, format_date='%m/%d/%Y', format_time='%I:%M:%S %p')
-        df_basal[self.datetime_col] = df_basal.DataDtTm_adjusted.fillna(df_basal.DataDtTm).transform(parse_flair_dates, format_date='%m/%d/%Y', format_time='%I:%M:%S %p')
-        df_cgm[self.datetime_col] = df_cgm.DataDtTm_adjusted.fillna(df_cgm.DataDtTm).transform(parse_flair_dates, format_date='%m/%d/%Y', format_time='%I:%M:%S %p')
+        df[self.datetime_col] = df.DataDtTm_adjusted.fillna(df.DataDtTm).transform(parse_flair_dates, format_date='%m/%d/%Y', format_time='%I:%M:%S %p')
+        return df.drop(columns=['DataDtTm', 'DataDtTm_adjusted'])
 
-        df_cgm.drop(columns=['DataDtTm', 'DataDtTm_adjusted'], inplace=True)
-        df_bolus.drop(columns=['DataDtTm', 'DataDtTm_adjusted'], inplace=True)
-        df_basal.drop(columns=['DataDtTm', 'DataDtTm_adjusted'], inplace=True)
-        
-        self.df_bolus = df_bolus
-        self.df_basal = df_basal
-        self.df_cgm = df_cgm
\ No newline at end of file
+    def _load_streams(self, streams, subset):
+        names = self._missing_tables(streams)
+        tables = self._load_tables({name: functools.partial(self._read_table, name, subset) for name in names})
+        for name, df in tables.items():
+            setattr(self, f'df_{name}', self._parse_table(name, df))
+        return self._available_streams()
@@ -6,6 +6,7 @@ from datetime import timedelta
 from .studydataset import StudyDataset
 from src.find_periods import find_periods
 from src.date_helper import parse_flair_dates, convert_duration_to_timedelta
+from src.pandas_helper import DuplicatePolicy
 
 def merge_basal_and_temp_basal(df):
     """
@@ -74,8 +75,11 @@ def disable_basal(df, periods, column):
     return adjusted_basals
 
 class Flair(StudyDataset):
-    def __init__(self, study_path: str):
-        super().__init__(study_path, 'Flair')
+    #raw table holding each stream
+    STREAM_TABLES = {'bolus_event_history': 'pump', 'basal_event_history': 'pump', 'cgm_history': 'cgm'}
+
+    def __init__(self, study_path: str, **kwargs):
+        super().__init__(study_path, 'Flair', **kwargs)
         self.basals = None
         self.boluses = None
         self.cgms = None
@@ -90,32 +94,40 @@ class Flair(StudyDataset):
         #if not os.path.exists(self.cgm_file):
         #    raise FileNotFoundError(f"File not found: {self.study_path}")
 
-    def _load_data(self, subset) -> tuple[pd.DataFrame, pd.DataFrame]:
-        
-        if self.df_pump is None and self.df_cgm is None:
-            df_cgm = pd.read_csv(self.cgm_file, sep="|", low_memory=False, usecols=['PtID', 'DataDtTm', 'DataDtTm_adjusted', 'CGM'],
-                                 skiprows=lambda x: (x % 10 != 0) & subset)
+    def _load_streams(self, streams, subset):
+        #only read the tables required for the streams
+        names = self._missing_tables(streams)
+        tasks = {}
+        if 'cgm' in names:
+            tasks['cgm'] = lambda: pd.read_csv(self.cgm_file, sep="|", low_memory=False, usecols=['PtID', 'DataDtTm', 'DataDtTm_adjusted', 'CGM'],
+                                               skiprows=lambda x: (x % 10 != 0) & subset)
+        if 'pump' in names:
+            tasks['pump'] = lambda: pd.read_csv(self.pump_file, sep="|", low_memory=False, usecols=['PtID', 'DataDtTm', 
+                                                                                            'BasalRt', 'TempBasalAmt', 'TempBasalType', 'TempBasalDur',
+                                                                                            'BolusDeliv', 'ExtendBolusDuration',
+                                                                                            'Suspend', 'AutoModeStatus', 
+                                                                                            'TDD'],
+                                                                                            skiprows=lambda x: (x % 10 != 0) & subset)
+        tables = self._load_tables(tasks)
+        if 'cgm' in tables:
+            df_cgm = tables['cgm']
             df_cgm['DateTime'] = df_cgm.loc[df_cgm.DataDtTm.notna(), 'DataDtTm'].transform(parse_flair_dates).astype('datetime64[ns]')
             df_cgm['DateTimeAdjusted'] = df_cgm.loc[df_cgm.DataDtTm_adjusted.notna(), 'DataDtTm_adjusted'].transform(parse_flair_dates).astype('datetime64[ns]')
             self.df_cgm = df_cgm
 
-            df_pump = pd.read_csv(self.pump_file, sep="|", low_memory=False, usecols=['PtID', 'DataDtTm', 
-                                                                                    'BasalRt', 'TempBasalAmt', 'TempBasalType', 'TempBasalDur',
-                                                                                    'BolusDeliv', 'ExtendBolusDuration',
-                                                                                    'Suspend', 'AutoModeStatus', 
-                                                                                    'TDD'],
-                                                                                    skiprows=lambda x: (x % 10 != 0) & subset)
-            
+        if 'pump' in tables:
+            df_pump = tables['pump']
             df_pump['DateTime'] = df_pump.loc[df_pump.DataDtTm.notna(), 'DataDtTm'].transform(parse_flair_dates)
             #to datetime required because otherwise pandas provides a Object type which will fail the studydataset validation
             df_pump['DateTime'] = pd.to_datetime(df_pump['DateTime'])
             self.df_pump = df_pump.sort_values('DateTime')
+        return self._available_streams()
     
     def _extract_bolus_event_history(self):
         if self.boluses is None:
             subFrame = self.df_pump.dropna(subset=['BolusDeliv'])
             #ther are duplicated boluses, we need to remove them
-            subFrame = subFrame[~subFrame.duplicated(subset=['PtID','DateTime', 'BolusDeliv'], keep='first')]
+            subFrame = self._deduplicate(subFrame, 'bolus', [DuplicatePolicy(['PtID', 'DateTime', 'BolusDeliv'])])
             boluses = subFrame[['PtID', 'DateTime', 'BolusDeliv', 'ExtendBolusDuration']].copy().astype({'PtID': str})
             boluses = boluses.rename(columns={'PtID': 'patient_id', 'DateTime': 'datetime', 'BolusDeliv': 'bolus', 'ExtendBolusDuration': 'delivery_duration'})
             boluses.delivery_duration = boluses.delivery_duration.apply(lambda x: convert_duration_to_timedelta(x) if pd.notnull(x) else pd.Timedelta(0))
@@ -178,6 +190,8 @@ class Flair(StudyDataset):
         Raises:
             ValueError: If the method is not one of: 'max', 'sum', 'latest', 'all'.
         """
+        #TDDs are stored in the pump table (loaded for boluses and basals)
+        self.load_data(self.load_subset, streams=['bolus_event_history'])
         TDDs = self.df_pump.dropna(subset=['TDD'])[['PtID','DateTime','TDD']]
         TDDs['date'] = TDDs.DateTime.dt.date
         TDDs['PtID'] = TDDs.PtID.astype(str)
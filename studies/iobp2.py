@@ -7,8 +7,8 @@ from .studydataset import StudyDataset
 
 class IOBP2(StudyDataset):
 
-    def __init__(self, study_path: str):
-        super().__init__(study_path, "IOBP2")
+    def __init__(self, study_path: str, **kwargs):
+        super().__init__(study_path, "IOBP2", **kwargs)
         #in place for testing purposes
         self.iletFilePath = self.study_path
         self.iletFilePath = os.path.join(self.study_path, 'Data Tables', 'IOBP2DeviceiLet.txt')
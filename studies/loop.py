@@ -1,21 +1,21 @@
 import pandas as pd
-from dask import dataframe as dd
 from src.logger import Logger
+from src.pandas_helper import DuplicatePolicy
 import os 
 
 from .studydataset import StudyDataset
 
 class Loop(StudyDataset):
 
-    def __init__(self, study_path):
-        super().__init__(study_path, 'Loop')
+    def __init__(self, study_path, **kwargs):
+        super().__init__(study_path, 'Loop', **kwargs)
         
         self._cgm_parquet_filename = 'loop_cgm.parquet'
         self._basal_parquet_filename = 'loop_basal.parquet'
         self._bolus_parquet_filename = 'loop_bolus.parquet'
 
         self.logger = Logger.get_logger('Loop')
-        self.load_subset = False
+        self.df_patient = None
         
         # Create a temporary directory to store the parquet files
         self.temp_dir = os.path.join(self.study_path, '..', '..', 'temp')
@@ -32,26 +32,33 @@ class Loop(StudyDataset):
             ddf.to_parquet(parquet_path, partition_on='PtID')
             self.logger.debug(f"CSV files converted to parquet file {parquet_path}")
 
-    def _load_data(self, subset: bool = False):
-        self.df_patient = pd.read_csv(os.path.join(self.study_path, 'Data Tables',  'PtRoster.txt'), sep='|')
-        self.load_subset = subset
+    def _load_streams(self, streams, subset):
+        #dask is imported when needed, importing studies should not pay for it
+        from dask import dataframe as dd
+        #the patient roster is needed by all streams (timezone offsets)
+        if self.df_patient is None:
+            self.df_patient = pd.read_csv(os.path.join(self.study_path, 'Data Tables',  'PtRoster.txt'), sep='|')
         
         # Create a temporary directory to store the parquet files
         if not os.path.exists(self.temp_dir):
             os.makedirs(self.temp_dir)
             self.logger.debug(f"Temporary directory created at {self.temp_dir}")
         
-        # Load the data from the CSV files and convert them to parquet files
-        ddf_cgm = dd.read_csv(os.path.join(self.study_path, 'Data Tables', 'LOOPDeviceCGM*.txt'), sep='|', 
-                            parse_dates=['UTCDtTm'], date_format='%Y-%m-%d %H:%M:%S', 
-                            usecols=['PtID', 'UTCDtTm', 'RecordType', 'CGMVal'])
-        ddf_basal = dd.read_csv(os.path.join(self.study_path, 'Data Tables', 'LOOPDeviceBasal*.txt'), sep='|', 
+        # Convert the CSV files of the requested streams to parquet files (boluses are read directly during extraction)
+        if 'cgm_history' in streams:
+            ddf_cgm = dd.read_csv(os.path.join(self.study_path, 'Data Tables', 'LOOPDeviceCGM*.txt'), sep='|', 
                                 parse_dates=['UTCDtTm'], date_format='%Y-%m-%d %H:%M:%S', 
-                                usecols=['PtID', 'UTCDtTm', 'BasalType', 'Duration', 'Rate'])
-        self.convert_csv_to_partqet(ddf_cgm, os.path.join(self.temp_dir, self._cgm_parquet_filename))
-        self.convert_csv_to_partqet(ddf_basal, os.path.join(self.temp_dir, self._basal_parquet_filename))
+                                usecols=['PtID', 'UTCDtTm', 'RecordType', 'CGMVal'])
+            self.convert_csv_to_partqet(ddf_cgm, os.path.join(self.temp_dir, self._cgm_parquet_filename))
+        if 'basal_event_history' in streams:
+            ddf_basal = dd.read_csv(os.path.join(self.study_path, 'Data Tables', 'LOOPDeviceBasal*.txt'), sep='|', 
+                                    parse_dates=['UTCDtTm'], date_format='%Y-%m-%d %H:%M:%S', 
+                                    usecols=['PtID', 'UTCDtTm', 'BasalType', 'Duration', 'Rate'])
+            self.convert_csv_to_partqet(ddf_basal, os.path.join(self.temp_dir, self._basal_parquet_filename))
+        return streams
     
     def _extract_cgm_as_dask(self):
+        from dask import dataframe as dd
         # Load the parquet file
         ddf = dd.read_parquet(os.path.join(self.temp_dir,self._cgm_parquet_filename), aggregate_files='PtID')
         if self.load_subset:
@@ -95,7 +102,7 @@ class Loop(StudyDataset):
                                 usecols=['PtID', 'UTCDtTm', 'Normal', 'Extended', 'Duration'])
         
         #drop duplicates
-        df = df.drop_duplicates(subset=['PtID', 'UTCDtTm'])
+        df = self._deduplicate(df, 'bolus', [DuplicatePolicy(['PtID', 'UTCDtTm'])])
         
         # Convert to local datetime
         df = df.merge(self.df_patient[['PtID', 'PtTimezoneOffset']], on='PtID', how='left')
@@ -123,6 +130,7 @@ class Loop(StudyDataset):
         return df
 
     def _extract_basal_as_dask(self):
+        from dask import dataframe as dd
         # Load the parquet file
         ddf = dd.read_parquet(os.path.join(self.temp_dir, self._basal_parquet_filename), 
                               aggregate_files='PtID',
@@ -1,50 +1,56 @@
 from studies.studydataset import StudyDataset
 import os
+import functools
 import pandas as pd
 from src.date_helper import parse_flair_dates
+from src.pandas_helper import DuplicatePolicy
 
 
 class PEDAP(StudyDataset):
-    def _load_data(self, subset):
+    #raw table holding each stream and the columns read from it
+    STREAM_TABLES = {'bolus_event_history': 'bolus', 'basal_event_history': 'basal', 'cgm_history': 'cgm'}
+    TABLE_COLUMNS = {'bolus': ['PtID', 'DeviceDtTm', 'BolusAmount', 'Duration'],
+                     'basal': ['PtID', 'DeviceDtTm', 'BasalRate'],
+                     'cgm': ['PtID', 'DeviceDtTm', 'CGMValue']}
+    #duplicated rows are identified by these columns, the first row is kept
+    DUPLICATE_POLICIES = {'bolus': [DuplicatePolicy(['PtID', 'DeviceDtTm', 'BolusAmount'])],
+                          'basal': [DuplicatePolicy(['PtID', 'DeviceDtTm', 'BasalRate'])],
+                          'cgm': [DuplicatePolicy(['PtID', 'DeviceDtTm'])]}
+
+    def __init__(self, study_path, **kwargs):
+        super().__init__(study_path, 'PEDAP', **kwargs)
         data_table_path = os.path.join(self.study_path, 'Data Files')
+        self.table_files = {'bolus': os.path.join(data_table_path, 'PEDAPTandemBOLUSDELIVERED.txt'),
+                            'basal': os.path.join(data_table_path, 'PEDAPTandemBASALRATECHG.txt'),
+                            'cgm': os.path.join(data_table_path, 'PEDAPTandemCGMDataGXB.txt')}
+        self.df_bolus = None
+        self.df_basal = None
+        self.df_cgm = None
 
-        df_bolus = pd.read_csv(os.path.join(data_table_path, 'PEDAPTandemBOLUSDELIVERED.txt'), sep="|", 
-                                    usecols=['PtID', 'DeviceDtTm', 'BolusAmount', 'Duration'],
-                                    skiprows=lambda x: (x % 10 != 0) & subset)
-        
-        df_basal = pd.read_csv(os.path.join(data_table_path, 'PEDAPTandemBASALRATECHG.txt'), sep="|", 
-                               usecols=['PtID', 'DeviceDtTm', 'BasalRate'],
-                               skiprows=lambda x: (x % 10 != 0) & subset)
-        
-        df_cgm = pd.read_csv(os.path.join(data_table_path, 'PEDAPTandemCGMDataGXB.txt'), sep="|", 
-                                  usecols=['PtID', 'DeviceDtTm', 'CGMValue'],
-                                  skiprows=lambda x: (x % 10 != 0) & subset)
-        
-        # remove duplicated rows
-        df_basal = df_basal.drop_duplicates(subset=['PtID','DeviceDtTm','BasalRate'])
-        df_bolus = df_bolus.drop_duplicates(subset=['PtID','DeviceDtTm','BolusAmount'])
-        df_cgm = df_cgm.drop_duplicates(subset=['PtID','DeviceDtTm'])
-        
+    def _read_table(self, name, subset, usecols=None):
+        df = pd.read_csv(self.table_files[name], sep="|", usecols=usecols or self.TABLE_COLUMNS[name],
+                         skiprows=lambda x: (x % 10 != 0) & subset)
         #remove missing DeviceDtTm for the bolus dataset (there are 4 entries)
-        df_bolus = df_bolus.dropna(subset=['DeviceDtTm'])
+        if name == 'bolus':
+            df = df.dropna(subset=['DeviceDtTm'])
+        return df
 
-        # get patient ids with data in all 3 datasets
-        intersecting_patient_ids = set(df_cgm.PtID.unique()).intersection(set(df_bolus.PtID.unique())).intersection(set(df_basal.PtID.unique()))
-        
-        df_bolus = df_bolus[df_bolus.PtID.isin(intersecting_patient_ids)]
-        df_basal = df_basal[df_basal.PtID.isin(intersecting_patient_ids)]
-        df_cgm = df_cgm[df_cgm.PtID.isin(intersecting_patient_ids)]
-        df_basal.drop
-        df_bolus['DeviceDtTm'] = parse_flair_dates(df_bolus['DeviceDtTm'])
-        df_basal['DeviceDtTm'] = parse_flair_dates(df_basal['DeviceDtTm'])
-        df_cgm['DeviceDtTm'] = parse_flair_dates(df_cgm['DeviceDtTm'])
+    def _read_patients(self, name, subset):
+        return self._read_table(name, subset, ['PtID', 'DeviceDtTm']).PtID
 
-        self.df_bolus = df_bolus
-        self.df_basal = df_basal
-        self.df_cgm = df_cgm
-    
-    def __init__(self, study_path):
-        super().__init__(study_path, 'PEDAP')
+    def _load_streams(self, streams, subset):
+        names = self._missing_tables(streams)
+        # keep patient ids with data in all 3 datasets (tables of other streams are only read for their patient ids)
+        tables = self._load_patient_tables(names,
+                                           {name: functools.partial(self._read_table, name, subset) for name in self.TABLE_COLUMNS},
+                                           {name: functools.partial(self._read_patients, name, subset) for name in self.TABLE_COLUMNS})
+        for name, df in tables.items():
+            # remove duplicated rows
+            df = self._deduplicate(df, name, self.DUPLICATE_POLICIES[name])
+            #parse datetimes (only for the remaining rows)
+            df['DeviceDtTm'] = parse_flair_dates(df['DeviceDtTm'])
+            setattr(self, f'df_{name}', df)
+        return self._available_streams()
 
     def _extract_basal_event_history(self):
         temp = self.df_basal[['PtID', 'BasalRate', 'DeviceDtTm']].astype({'PtID':str}).copy()
@@ -1,95 +1,98 @@
 import pandas as pd
 from studies.studydataset import StudyDataset
 from datetime import datetime, timedelta
-from functools import reduce
 import numpy as np
 import os
-from src import pandas_helper, logger
+import functools
+from src import logger
+from src.pandas_helper import DuplicatePolicy
 
-class ReplaceBG(StudyDataset):
-    def __init__(self, study_path):
-        super().__init__(study_path, 'ReplaceBG')
-    
-    def _load_data(self, subset: bool = False):
-        study_path = self.study_path
+def merge_bolus_uploads(df_bolus, df_uploads):
+    """Adds the data source (e.g. Diasend) of the parent upload to each bolus row."""
+    return pd.merge(df_bolus, 
+                    df_uploads.rename(columns={'RecID':'ParentHDeviceUploadsID'})[['PtID','ParentHDeviceUploadsID','DataSource']],
+                    on=['PtID','ParentHDeviceUploadsID'])
 
+class ReplaceBG(StudyDataset):
+    #raw table holding each stream
+    STREAM_TABLES = {'bolus_event_history': 'bolus', 'basal_event_history': 'basal', 'cgm_history': 'cgm'}
+    TABLE_FILES = {'bolus': 'HDeviceBolus.txt', 'basal': 'HDeviceBasal.txt', 'cgm': 'HDeviceCGM.txt'}
+
+    def __init__(self, study_path, **kwargs):
+        super().__init__(study_path, 'ReplaceBG', **kwargs)
+        self.df_bolus = None
+        self.df_basal = None
+        self.df_cgm = None
+        self.df_uploads = None
+
+    def _read_table(self, name, subset, usecols=None):
+        return pd.read_csv(os.path.join(self.study_path, 'Data Tables', self.TABLE_FILES[name]), sep='|', dtype={'PtID': str}, usecols=usecols,
+                           skiprows=lambda x: (x % 10 != 0) & subset)
+
+    def _read_uploads(self):
+        #cached, the uploads are needed for the bolus patient ids and again when the boluses are loaded
+        if self.df_uploads is None:
+            self.df_uploads = pd.read_csv(os.path.join(self.study_path, 'Data Tables', 'HDeviceUploads.txt'), sep='|', dtype={'PtId': str},
+                                          usecols=['PtId', 'RecID', 'DataSource']).rename(columns={'PtId': 'PtID'})
+        return self.df_uploads
+
+    def _read_patients(self, name, subset):
+        return self._read_table(name, subset, ['PtID']).PtID
+
+    def _load_streams(self, streams, subset):
+        names = self._missing_tables(streams)
         #imaginary start date we chose since data is relative to enrollment
         enrollment_start = datetime(2015, 1, 1)
-        #load data
-        df_basal = pd.read_csv(os.path.join(study_path, 'Data Tables', 'HDeviceBasal.txt'), sep='|',dtype={'PtID':str},
-                       skiprows=lambda x: (x % 10 != 0) & subset)
-        df_bolus = pd.read_csv(os.path.join(study_path, 'Data Tables', 'HDeviceBolus.txt'), sep='|',dtype={'PtID':str},
-                       skiprows=lambda x: (x % 10 != 0) & subset)
-        df_patient = pd.read_csv(os.path.join(study_path, 'Data Tables', 'HPtRoster.txt'), sep='|',dtype={'PtID':str},
-                     skiprows=lambda x: (x % 10 != 0) & subset)
-        df_cgm = pd.read_csv(os.path.join(study_path, 'Data Tables', 'HDeviceCGM.txt'), sep='|',dtype={'PtID':str},
-                     skiprows=lambda x: (x % 10 != 0) & subset)
-        df_uploads = pd.read_csv(os.path.join(study_path, 'Data Tables', 'HDeviceUploads.txt'), sep='|',dtype={'PtId':str}).rename(columns={'PtId':'PtID'})
-        
-        #convert datetimes
-        df_basal['datetime'] = enrollment_start + pd.to_timedelta(df_basal['DeviceDtTmDaysFromEnroll'], unit='D') + pd.to_timedelta(df_basal['DeviceTm'])
-        df_bolus['datetime'] = enrollment_start + pd.to_timedelta(df_bolus['DeviceDtTmDaysFromEnroll'], unit='D') + pd.to_timedelta(df_bolus['DeviceTm'])
-        df_cgm['datetime'] = enrollment_start + pd.to_timedelta(df_cgm['DeviceDtTmDaysFromEnroll'], unit='D') + pd.to_timedelta(df_cgm['DeviceTm'])
-
-        df_basal['hour_of_day'] = df_basal.datetime.dt.hour
-        df_bolus['hour_of_day'] = df_bolus.datetime.dt.hour
-        df_cgm['hour_of_day'] = df_cgm.datetime.dt.hour
-
-        df_bolus['day'] = df_bolus.datetime.dt.date
-        df_basal['day'] = df_basal.datetime.dt.date
-        df_cgm['day'] = df_cgm.datetime.dt.date
 
-        df_basal.drop(columns=['DeviceDtTmDaysFromEnroll', 'DeviceTm'], inplace=True)
-        df_bolus.drop(columns=['DeviceDtTmDaysFromEnroll', 'DeviceTm'], inplace=True)
-        df_cgm.drop(columns=['DeviceDtTmDaysFromEnroll', 'DeviceTm'], inplace=True)
+        #load data (the tables are read concurrently)
+        #only keep patients that are in all datasets (first, so that the conversions below only process remaining rows), 
+        #tables of other streams are only read with their patient id columns (the uploads are cached for the bolus ids)
+        #boluses are merged with their uploads once both are read (only boluses with an upload are kept)
+        patient_readers = {name: functools.partial(self._read_patients, name, subset) for name in ['basal', 'cgm']}
+        patient_readers['bolus'] = (lambda bolus, uploads: merge_bolus_uploads(bolus, uploads).PtID, ['bolus_patient_ids', 'uploads'])
+        tables = self._load_patient_tables(names,
+                                           {'bolus': (merge_bolus_uploads, ['bolus_table', 'uploads']),
+                                            'basal': functools.partial(self._read_table, 'basal', subset),
+                                            'cgm': functools.partial(self._read_table, 'cgm', subset)},
+                                           patient_readers,
+                                           helpers={'bolus_table': functools.partial(self._read_table, 'bolus', subset),
+                                                    'bolus_patient_ids': functools.partial(self._read_table, 'bolus', subset, ['PtID', 'ParentHDeviceUploadsID']),
+                                                    'uploads': self._read_uploads})
+
+        for name, df in tables.items():
+            #convert datetimes
+            df['datetime'] = enrollment_start + pd.to_timedelta(df['DeviceDtTmDaysFromEnroll'], unit='D') + pd.to_timedelta(df['DeviceTm'])
+            df['hour_of_day'] = df.datetime.dt.hour
+            df['day'] = df.datetime.dt.date
+            df.drop(columns=['DeviceDtTmDaysFromEnroll', 'DeviceTm'], inplace=True)
 
         # convert durations
-        
-        #Diasend specific: Diasend durations are in minutes not ms (only exist in boluses)
-        # adjust bolus durations (from minutes to ms) and treat boluses without extended part as normal boluses
-        df_bolus = pd.merge(df_bolus, 
-                    df_uploads.rename(columns={'RecID':'ParentHDeviceUploadsID'})[['PtID','ParentHDeviceUploadsID','DataSource']],
-                    on=['PtID','ParentHDeviceUploadsID'])
-        df_bolus.loc[df_bolus.DataSource=='Diasend','Duration'] *= 60*1000
-        df_bolus.loc[(df_bolus.DataSource=='Diasend') & df_bolus.Extended.isna() & df_bolus.Duration.notna(),['Duration']] = np.nan
-
-        df_basal['Duration'] = pd.to_timedelta(df_basal['Duration'], unit='ms')
-        df_basal['ExpectedDuration'] = pd.to_timedelta(df_basal['ExpectedDuration'], unit='ms')
-        df_basal['SuprDuration'] = pd.to_timedelta(df_basal['SuprDuration'], unit='ms')
-        df_bolus['Duration'] = pd.to_timedelta(df_bolus['Duration'], unit='ms')
-        df_bolus['ExpectedDuration'] = pd.to_timedelta(df_bolus['ExpectedDuration'], unit='ms')
-        
-        #drop patients that are not in all datasets 
-        patient_ids_to_keep = reduce(np.intersect1d, [df_basal['PtID'].unique(), 
-                                  df_bolus['PtID'].unique(), 
-                                  df_cgm['PtID'].unique()])
-        df_basal = df_basal[df_basal['PtID'].isin(patient_ids_to_keep)]
-        df_bolus = df_bolus[df_bolus['PtID'].isin(patient_ids_to_keep)]
-        df_cgm = df_cgm[df_cgm['PtID'].isin(patient_ids_to_keep)]
+        if 'bolus' in tables:
+            df_bolus = tables['bolus']
+            #Diasend specific: Diasend durations are in minutes not ms (only exist in boluses)
+            # adjust bolus durations (from minutes to ms) and treat boluses without extended part as normal boluses
+            df_bolus.loc[df_bolus.DataSource=='Diasend','Duration'] *= 60*1000
+            df_bolus.loc[(df_bolus.DataSource=='Diasend') & df_bolus.Extended.isna() & df_bolus.Duration.notna(),['Duration']] = np.nan
+            df_bolus['Duration'] = pd.to_timedelta(df_bolus['Duration'], unit='ms')
+            df_bolus['ExpectedDuration'] = pd.to_timedelta(df_bolus['ExpectedDuration'], unit='ms')
+
+        if 'basal' in tables:
+            df_basal = tables['basal']
+            df_basal['Duration'] = pd.to_timedelta(df_basal['Duration'], unit='ms')
+            df_basal['ExpectedDuration'] = pd.to_timedelta(df_basal['ExpectedDuration'], unit='ms')
+            df_basal['SuprDuration'] = pd.to_timedelta(df_basal['SuprDuration'], unit='ms')
 
         #sort data by patient and datetime
-        df_basal = df_basal.sort_values(by=['PtID', 'datetime'])
-        df_bolus = df_bolus.sort_values(by=['PtID', 'datetime'])
-        df_cgm = df_cgm.sort_values(by=['PtID', 'datetime'])
-
-        # Assign to self
-        self.df_basal = df_basal
-        self.df_bolus = df_bolus
-        self.df_patient = df_patient
-        self.df_cgm = df_cgm
-        self.df_uploads = df_uploads
-
-        self.data_loaded = True
+        for name, df in tables.items():
+            setattr(self, f'df_{name}', df.sort_values(by=['PtID', 'datetime']))
+        return self._available_streams()
 
     def _extract_bolus_event_history(self):
 
-        #drop actual duplicates
+        #drop actual duplicates, then temporal duplciates keeping the maximum RecID row
         df_bolus = self.df_bolus.copy()
-        df_bolus = df_bolus.drop_duplicates(subset=['PtID', 'datetime','BolusType','Normal','Extended','Duration'])
-
-        #drop temporal duplciates keeping the maximum RecID row 
-        _, _, i_drop = pandas_helper.get_duplicated_max_indexes(df_bolus, ['PtID', 'datetime'], 'RecID')
-        df_bolus = df_bolus.drop(index=i_drop)
+        df_bolus = self._deduplicate(df_bolus, 'bolus', [DuplicatePolicy(['PtID', 'datetime', 'BolusType', 'Normal', 'Extended', 'Duration']),
+                                                         DuplicatePolicy(['PtID', 'datetime'], 'max', 'RecID')])
 
         #for boluses with BolusType == Combination, we treat these as Normal and set Duration to NaN,
         #this removes 4 extended boluses with zero duration considered to be invalid
@@ -122,10 +125,9 @@ class ReplaceBG(StudyDataset):
     def _extract_basal_event_history(self):
         df_basal = self.df_basal.copy()
 
-        #drop duplicates with same duration and rate
-        _,_,i_drop = pandas_helper.get_duplicated_max_indexes(df_basal, ['PtID', 'datetime'], 'RecID')
-        df_basal = df_basal.drop(index=i_drop)
-        df_basal = df_basal.drop_duplicates(subset=['PtID', 'datetime','Rate', 'Duration'],keep='first')
+        #drop temporal duplicates keeping the maximum RecID row, then duplicates with same duration and rate
+        df_basal = self._deduplicate(df_basal, 'basal', [DuplicatePolicy(['PtID', 'datetime'], 'max', 'RecID'),
+                                                         DuplicatePolicy(['PtID', 'datetime', 'Rate', 'Duration'])])
         
         #replace NaNs Rates with zero (we know these only come from Suspends and temp basals)
         df_basal.fillna({'Rate':0}, inplace=True)
@@ -140,7 +142,7 @@ class ReplaceBG(StudyDataset):
     def _extract_cgm_history(self):
         df_cgm = self.df_cgm.copy()
 
-        df_cgm = df_cgm.drop_duplicates(subset=['PtID', 'datetime','RecordType','GlucoseValue'])
+        df_cgm = self._deduplicate(df_cgm, 'cgm', [DuplicatePolicy(['PtID', 'datetime', 'RecordType', 'GlucoseValue'])])
 
         #drop Calibrations
         df_cgm = df_cgm.loc[df_cgm.RecordType == 'CGM']
@@ -1,64 +1,475 @@
 import pandas as pd
+import numpy as np
 import os
+import functools
+import queue
+import threading
+import io
+import gzip
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 from src.logger import Logger
+from src import pandas_helper
+from src import instrumentation
+from src.patient_index import PatientIndex
+from src.indexed_csv import compress_blocks, save_indexed_csv, index_path
 logger = Logger.get_logger(__name__)
 
+VALIDATION_MODES = ('strict', 'sampled', 'off')
+VALIDATION_SAMPLE_SIZE = 10000
+_validation_mode = 'strict'
+
+def set_validation_mode(mode):
+    """Sets how extracted dataframes are validated.
+
+    Args:
+        mode (str): One of
+            
+            - 'strict': check dtypes and all values of object columns (default)
+            - 'sampled': check dtypes and a sample of `VALIDATION_SAMPLE_SIZE` values of object columns
+            - 'off': skip validation (e.g. for production runs of already validated studies)
+    """
+    global _validation_mode
+    if mode not in VALIDATION_MODES:
+        raise ValueError(f"Validation mode must be one of {VALIDATION_MODES} but is '{mode}'")
+    _validation_mode = mode
+
+def get_validation_mode():
+    """Returns the current validation mode (see `set_validation_mode`)."""
+    return _validation_mode
+
+def is_string_series(series, mode=None):
+    """Checks if a series holds strings using its dtype.
+
+    String and categorical (with string categories) dtypes are accepted without looking at the values. For object dtypes,
+    the values are checked in a vectorized way, either all of them (strict mode) or an evenly spaced sample (sampled mode).
+
+    Args:
+        series (pd.Series): The series to check.
+        mode (str, optional): The validation mode, defaults to the current validation mode (see `set_validation_mode`).
+
+    Returns:
+        bool: True if the series holds strings.
+    """
+    mode = _validation_mode if mode is None else mode
+    dtype = series.dtype
+    if isinstance(dtype, pd.CategoricalDtype):
+        values = dtype.categories.to_series()
+    elif isinstance(dtype, pd.StringDtype):
+        return True
+    elif pd.api.types.is_object_dtype(dtype):
+        values = series
+    else:
+        return False
+
+    if mode == 'sampled' and len(values) > VALIDATION_SAMPLE_SIZE:
+        values = values.iloc[np.linspace(0, len(values) - 1, VALIDATION_SAMPLE_SIZE).astype(int)]
+    return pd.api.types.infer_dtype(values, skipna=False) in ('string', 'empty')
+
+def check_bolus_output_dataframe(df):
+    """Validates a bolus event history dataframe (see `StudyDataset.extract_bolus_event_history`), raises if invalid."""
+    if _validation_mode == 'off':
+        return df
+    if not isinstance(df, pd.DataFrame):
+        raise TypeError("Output should be a pandas DataFrame")
+    required_columns = ['patient_id', 'datetime', 'bolus', 'delivery_duration']
+    if set(df.columns) != set(required_columns):
+        raise ValueError(f"DataFrame should have columns 'patient_id', 'datetime' and 'basal_rate' but has {df.columns}")
+    if not pd.api.types.is_datetime64_dtype(df['datetime'].dtype):
+        raise ValueError(f"DataFrame should have a 'datetime' column of type pandas datetime but is {df['datetime'].dtype}")
+    if not is_string_series(df['patient_id']):
+        raise ValueError("DataFrame should have a 'patient_id' column of type string")
+    if not pd.api.types.is_numeric_dtype(df['bolus'].dtype):
+        raise ValueError(f"DataFrame should have a 'bolus' column of type float but is {df['bolus'].dtype}")
+    if not pd.api.types.is_timedelta64_dtype(df['delivery_duration'].dtype):
+        raise ValueError(f"DataFrame should have a 'delivery_duration' column of type timedelta but is {df['delivery_duration'].dtype}")
+    return df
+
+def check_basal_output_dataframe(df):
+    """Validates a basal event history dataframe (see `StudyDataset.extract_basal_event_history`), raises if invalid."""
+    if _validation_mode == 'off':
+        return df
+    if not isinstance(df, pd.DataFrame):
+        raise TypeError("Output should be a pandas DataFrame")
+    required_columns = ['patient_id', 'datetime', 'basal_rate']
+    if set(df.columns) != set(required_columns):
+        raise ValueError(f"DataFrame should have columns 'patient_id', 'datetime' and 'basal_rate' but has {df.columns}")
+    if not pd.api.types.is_datetime64_dtype(df['datetime'].dtype):
+        raise ValueError(f"DataFrame should have a 'datetime' column of type pandas datetime but is {df['datetime'].dtype}")
+    if not is_string_series(df['patient_id']):
+        raise ValueError("DataFrame should have a 'patient_id' column of type string")
+    if not pd.api.types.is_numeric_dtype(df['basal_rate'].dtype):
+        raise ValueError(f"DataFrame should have a 'basal_rate' column of numeric type but is {df['basal_rate'].dtype}")
+    return df
+
+def check_cgm_output_dataframe(df):
+    """Validates a cgm history dataframe (see `StudyDataset.extract_cgm_history`), raises if invalid."""
+    if _validation_mode == 'off':
+        return df
+    if not isinstance(df, pd.DataFrame):
+        raise TypeError("Output should be a pandas DataFrame")
+    required_columns = ['patient_id', 'datetime', 'cgm']
+    if set(df.columns) != set(required_columns):
+        raise ValueError(f"DataFrame should have columns 'patient_id', 'datetime' and 'cgm' but has {df.columns}")
+    if not pd.api.types.is_datetime64_dtype(df['datetime'].dtype):
+        raise ValueError(f"DataFrame should have a 'datetime' column of type pandas datetime but is {df['datetime'].dtype}")
+    if not is_string_series(df['patient_id']):
+        raise ValueError("DataFrame should have a 'patient_id' column of type string")
+    if not pd.api.types.is_numeric_dtype(df['cgm'].dtype):
+        raise ValueError(f"DataFrame should have a 'cgm' column of numeric type but is {df['cgm'].dtype}")
+    return df
+
 def validate_bolus_output_dataframe(func):
+    @functools.wraps(func)
     def wrapper(*args, **kwargs):
-        df = func(*args, **kwargs)
-        if not isinstance(df, pd.DataFrame):
-            raise TypeError("Output should be a pandas DataFrame")
-        required_columns = ['patient_id', 'datetime', 'bolus', 'delivery_duration']
-        if set(df.columns) != set(required_columns):
-            raise ValueError(f"DataFrame should have columns 'patient_id', 'datetime' and 'basal_rate' but has {df.columns}")
-        if not pd.api.types.is_datetime64_dtype(df['datetime'].dtype):
-            raise ValueError("DataFrame should have a 'datetime' column of type pandas datetime but is {df['datetime'].dtype}")
-        if not all(isinstance(item, str) for item in df['patient_id']):
-            raise ValueError("DataFrame should have a 'patient_id' column of type string")
-        if not pd.api.types.is_numeric_dtype(df['bolus'].dtype):
-            raise ValueError("DataFrame should have a 'bolus' column of type float but is {df['bolus'].dtype}")
-        if not pd.api.types.is_timedelta64_dtype(df['delivery_duration'].dtype):
-            raise ValueError(f"DataFrame should have a 'delivery_duration' column of type timedelta but is {df['delivery_duration'].dtype}")
-        return df
+        return check_bolus_output_dataframe(func(*args, **kwargs))
     return wrapper
 
 def validate_basal_output_dataframe(func):
+    @functools.wraps(func)
     def wrapper(*args, **kwargs):
-        df = func(*args, **kwargs)
-        if not isinstance(df, pd.DataFrame):
-            raise TypeError("Output should be a pandas DataFrame")
-        required_columns = ['patient_id', 'datetime', 'basal_rate']
-        if set(df.columns) != set(required_columns):
-            raise ValueError(f"DataFrame should have columns 'patient_id', 'datetime' and 'basal_rate' but has {df.columns}")
-        if not pd.api.types.is_datetime64_dtype(df['datetime'].dtype):
-            raise ValueError("DataFrame should have a 'datetime' column of type pandas datetime")
-        if not all(isinstance(item, str) for item in df['patient_id']):
-            raise ValueError("DataFrame should have a 'patient_id' column of type string")
-        if not pd.api.types.is_numeric_dtype(df['basal_rate'].dtype):
-            raise ValueError(f"DataFrame should have a 'basal_rate' column of numeric type but is {df['basal_rate'].dtype}")
-        return df
+        return check_basal_output_dataframe(func(*args, **kwargs))
     return wrapper
 
 def validate_cgm_output_dataframe(func):
+    @functools.wraps(func)
     def wrapper(*args, **kwargs):
-        df = func(*args, **kwargs)
-        if not isinstance(df, pd.DataFrame):
-            raise TypeError("Output should be a pandas DataFrame")
-        required_columns = ['patient_id', 'datetime', 'cgm']
-        if set(df.columns) != set(required_columns):
-            raise ValueError(f"DataFrame should have columns 'patient_id', 'datetime' and 'cgm' but has {df.columns}")
-        if not pd.api.types.is_datetime64_dtype(df['datetime'].dtype):
-            raise ValueError("DataFrame should have a 'datetime' column of type pandas datetime")
-        if not pd.api.types.is_object_dtype(df['patient_id'].dtype) or not all(isinstance(item, str) for item in df['patient_id']):
-            raise ValueError("DataFrame should have a 'patient_id' column of type string")
-        if not pd.api.types.is_numeric_dtype(df['cgm'].dtype):
-            raise ValueError(f"DataFrame should have a 'cgm' column of numeric type but is {df['cgm'].dtype}")
-        return df
+        return check_cgm_output_dataframe(func(*args, **kwargs))
     return wrapper
 
+def run_load_tasks(tasks, max_workers=None):
+    """Runs loading tasks on a thread pool, starting dependent tasks as soon as their inputs are ready.
+
+    Independent tasks (typically reading raw tables) run concurrently, bounded by `max_workers`. 
+    Dependent tasks (e.g. merging two tables) are started once all of their dependencies finished.
+
+    Args:
+        tasks (dict): Maps a task name to either a callable without arguments or a tuple `(callable, [dependencies])`.
+            Dependent callables are called with the results of their dependencies (in the listed order).
+        max_workers (int, optional): Maximum number of tasks running at the same time. If 1, the tasks run 
+            sequentially in the calling thread. Defaults to None (the thread pool default).
+
+    Returns:
+        results (dict): Maps each task name to its result.
+
+    Example:
+        ```
+        tables = run_load_tasks({'bolus': lambda: pd.read_csv('bolus.txt', sep='|'),
+                                 'uploads': lambda: pd.read_csv('uploads.txt', sep='|'),
+                                 'bolus_merged': (lambda bolus, uploads: bolus.merge(uploads), ['bolus', 'uploads'])})
+        ```
+    """
+    normalized = {}
+    for name, task in tasks.items():
+        fun, dependencies = task if isinstance(task, tuple) else (task, [])
+        unknown = set(dependencies) - set(tasks)
+        if unknown:
+            raise ValueError(f"Task '{name}' depends on unknown tasks {unknown}")
+        normalized[name] = (fun, list(dependencies))
+
+    results = {}
+    pending = dict(normalized)
+
+    def pop_ready():
+        ready = [name for name, (_, dependencies) in pending.items() if all(d in results for d in dependencies)]
+        return [(name, pending.pop(name)) for name in ready]
+
+    if max_workers == 1:
+        while pending:
+            ready = pop_ready()
+            if not ready:
+                raise ValueError(f"Circular dependencies between tasks {list(pending)}")
+            for name, (fun, dependencies) in ready:
+                results[name] = fun(*[results[d] for d in dependencies])
+        return results
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        running = {}
+        while pending or running:
+            for name, (fun, dependencies) in pop_ready():
+                running[executor.submit(fun, *[results[d] for d in dependencies])] = name
+            if not running:
+                raise ValueError(f"Circular dependencies between tasks {list(pending)}")
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    results[name] = future.result()
+                except Exception:
+                    for other in running:
+                        other.cancel()
+                    raise
+    return results
+
+COMPACT_PATIENT_ID_DTYPES = {'category': 'category', 'pyarrow': 'string[pyarrow]'}
+
+def compact_dtypes(df, patient_id_dtype='category'):
+    """Converts an extracted history to memory efficient dtypes.
+
+    - `patient_id`: categorical or pyarrow string
+    - `datetime`, `delivery_duration`: second resolution
+    - `cgm`: int16 (Int16 if there are missing values), truncated like in the csv output
+    - `bolus`, `basal_rate`: float32 (~7 significant digits, values exactly halfway between two 4-digit decimals may round differently when saved)
+
+    Args:
+        df (pd.DataFrame): A bolus, basal or cgm history (see `StudyDataset`).
+        patient_id_dtype (str): Either 'category' or 'pyarrow'.
+
+    Returns:
+        df (pd.DataFrame): The converted dataframe.
+    """
+    if patient_id_dtype not in COMPACT_PATIENT_ID_DTYPES:
+        raise ValueError(f"patient_id_dtype must be one of {list(COMPACT_PATIENT_ID_DTYPES)} but is '{patient_id_dtype}'")
+    dtypes = {'patient_id': COMPACT_PATIENT_ID_DTYPES[patient_id_dtype],
+              'datetime': 'datetime64[s]',
+              'delivery_duration': 'timedelta64[s]',
+              'bolus': 'float32',
+              'basal_rate': 'float32'}
+    df = df.astype({col: dtype for col, dtype in dtypes.items() if col in df.columns})
+    if 'cgm' in df.columns:
+        cgm = np.trunc(df['cgm'])
+        df['cgm'] = cgm.astype('Int16' if cgm.isna().any() else 'int16')
+    return df
+
+def to_unix_seconds(datetimes):
+    """Converts a datetime series of any resolution to integer seconds since epoch (rounded down)."""
+    per_second = {'s': 1, 'ms': 10**3, 'us': 10**6, 'ns': 10**9}[np.datetime_data(datetimes.dtype)[0]]
+    return datetimes.astype('int64') // per_second
+
+def replace_columns(df, **columns):
+    """Returns a dataframe with some columns replaced without copying the remaining columns.
+
+    Args:
+        df (pd.DataFrame): The source dataframe (not modified).
+        **columns: Maps column names to the replacing series.
+
+    Returns:
+        df (pd.DataFrame): A new dataframe with the same column order as `df`.
+    """
+    return pd.concat([columns[col].rename(col) if col in columns else df[col] for col in df.columns], axis=1, copy=False)
+
 def save_to_csv(df, file_path, compressed):
-    df.to_csv(file_path + (".csv.gz" if compressed else '.csv'), index=False, 
-                compression='gzip' if compressed else None)
+    save_output(df, file_path, 'csv.gz' if compressed else 'csv')
+
+OUTPUT_FORMATS = ('csv', 'csv.gz', 'csv.zst', 'parquet', 'feather')
+
+#compression methods of the csv output formats (zstd requires the `zstandard` package)
+CSV_CODECS = {'csv': None, 'csv.gz': 'gzip', 'csv.zst': 'zstd'}
+
+#default compression levels of the csv codecs (the defaults of pandas)
+DEFAULT_COMPRESSION_LEVELS = {'gzip': 9, 'zstd': 3}
+
+#rows converted and written at a time by `save_to_csv_chunked`
+CSV_CHUNK_ROWS = 1_000_000
+
+#rows per gzip member written by `save_to_block_gzip`
+BLOCK_GZIP_ROWS = 250_000
+
+#maximum rows of a parquet row group, row groups only contain whole patients (unless a patient has more rows)
+PARQUET_ROW_GROUP_SIZE = 1_000_000
+
+def get_output_format(compressed, output_format=None):
+    """Returns the output format, `output_format` takes precedence over `compressed` (csv.gz or csv)."""
+    if output_format is None:
+        return 'csv.gz' if compressed else 'csv'
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"output_format must be one of {list(OUTPUT_FORMATS)} but is '{output_format}'")
+    return output_format
+
+def output_path(file_path, output_format):
+    """Returns the path of the file written by `save_output`."""
+    return f"{file_path}.{output_format}"
+
+def csv_compression(output_format, compression=None):
+    """Returns the compression options of a csv output format with defaults applied.
+
+    Args:
+        output_format (str): 'csv', 'csv.gz' or 'csv.zst'.
+        compression (dict, optional): `level` (gzip: 1-9, default 9, zstd: 1-22, default 3), `threads` (default 1) and 
+            `index` (csv.gz only, see `save_output`).
+
+    Returns:
+        compression (dict): The `method` (None, 'gzip' or 'zstd'), `level`, `threads` and `index`.
+    """
+    compression = compression or {}
+    unknown = set(compression) - {'level', 'threads', 'index'}
+    if unknown:
+        raise ValueError(f"Unknown compression options {sorted(unknown)}, supported are 'level', 'threads' and 'index'")
+    method = CSV_CODECS[output_format]
+    if compression.get('index') and method != 'gzip':
+        raise ValueError(f"Indexed outputs require the csv.gz format but the format is '{output_format}'")
+    level = compression.get('level')
+    return {'method': method,
+            'level': DEFAULT_COMPRESSION_LEVELS.get(method) if level is None else level,
+            'threads': compression.get('threads', 1),
+            'index': bool(compression.get('index'))}
+
+def open_csv(file_path, options):
+    """Opens a csv output file for writing text, compressed according to `options` (see `csv_compression`)."""
+    if options['method'] == 'gzip':
+        f = gzip.open(file_path, 'wb', compresslevel=options['level'])
+    elif options['method'] == 'zstd':
+        import zstandard
+        cctx = zstandard.ZstdCompressor(level=options['level'], threads=options['threads'] if options['threads'] > 1 else 0)
+        f = zstandard.open(file_path, 'wb', cctx=cctx)
+    else:
+        f = open(file_path, 'wb')
+    #newline='' writes the line terminator of to_csv unchanged (like pandas does when writing to a path)
+    return io.TextIOWrapper(f, encoding='utf-8', newline='')
+
+def save_to_csv_chunked(df, file_path, options, convert=None, chunk_rows=None):
+    """Converts and writes a dataframe in batches of rows to a single csv file.
+
+    Only one batch is converted and formatted at a time, so the memory needed on top of `df` does not grow with its size.
+    The file is identical to `convert(df).to_csv(file_path, index=False, compression=...)`.
+
+    Args:
+        df (pd.DataFrame): The data.
+        file_path (str): The output file.
+        options (dict): The compression options (see `csv_compression`).
+        convert (callable, optional): Converts a batch of rows to the output format (e.g. to integer timestamps).
+        chunk_rows (int, optional): Number of rows per batch. Defaults to `CSV_CHUNK_ROWS`.
+    """
+    chunk_rows = chunk_rows or CSV_CHUNK_ROWS
+    convert = convert or (lambda chunk: chunk)
+    with open_csv(file_path, options) as f:
+        for start in range(0, max(len(df), 1), chunk_rows):
+            convert(df.iloc[start:start + chunk_rows]).to_csv(f, index=False, header=start == 0)
+
+def save_to_block_gzip(df, file_path, level=9, threads=None, block_rows=BLOCK_GZIP_ROWS, convert=None):
+    """Saves a csv file as a sequence of gzip members that are compressed in parallel threads (zlib releases the GIL).
+
+    Concatenated gzip members are a valid gzip file, it can be read by gunzip, python's gzip module and pandas and 
+    decompresses to the same csv as `df.to_csv(index=False)`. At most `threads` blocks are compressed at a time.
+
+    Args:
+        df (pd.DataFrame): The data.
+        file_path (str): The output file.
+        level (int): The gzip compression level (1-9).
+        threads (int, optional): Number of compression threads. Defaults to the number of cpus.
+        block_rows (int): Number of rows per gzip member.
+        convert (callable, optional): Converts a block of rows to the output format (see `save_to_csv_chunked`).
+    """
+    convert = convert or (lambda chunk: chunk)
+    blocks = (convert(df.iloc[start:start + block_rows]).to_csv(index=False, header=start == 0).encode() for start in range(0, max(len(df), 1), block_rows))
+    with open(file_path, 'wb') as f:
+        for member in compress_blocks(blocks, level, threads or os.cpu_count()):
+            f.write(member)
+
+def save_to_parquet(df, file_path, patient_col='patient_id', row_group_size=PARQUET_ROW_GROUP_SIZE):
+    """Saves a history as parquet file sorted by patient with row groups aligned to patient boundaries.
+
+    Readers can skip row groups using the patient id statistics, e.g. `pd.read_parquet(path, filters=[('patient_id', '==', '10')])`.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    df, offsets = pandas_helper.sort_by_patient(df, patient_col)
+    #greedily combine patients into row groups of at most row_group_size rows
+    bounds = [0]
+    for previous, offset in zip(offsets[:-1], offsets[1:]):
+        if offset - bounds[-1] > row_group_size and previous > bounds[-1]:
+            bounds.append(previous)
+    if len(df) > bounds[-1]:
+        bounds.append(len(df))
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    with pq.ParquetWriter(file_path, table.schema, compression='zstd') as writer:
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            writer.write_table(table.slice(start, end - start), row_group_size=end - start)
+
+def save_to_feather(df, file_path, patient_col='patient_id'):
+    """Saves a history as feather (arrow ipc) file sorted by patient."""
+    df, _ = pandas_helper.sort_by_patient(df, patient_col)
+    df.to_feather(file_path, compression='zstd')
+
+def save_output(df, file_path, output_format, compression=None, convert=None):
+    """Saves a history in one of the `OUTPUT_FORMATS`.
+
+    All formats contain the same columns (see `StudyDataset.save_cgm_to_file`). The csv formats keep the row order, 
+    parquet and feather files are sorted by patient.
+
+    Args:
+        df (pd.DataFrame): The history.
+        file_path (str): The output path without extension (see `output_path`).
+        output_format (str): One of `OUTPUT_FORMATS`.
+        compression (dict, optional): Compression `level` and `threads` of the csv formats (see `csv_compression`). 
+            With more than one thread, csv.gz files are written by `save_to_block_gzip`. With `index=True`, csv.gz files
+            are sorted by patient and compressed per patient with a sidecar index for random access by patient (see 
+            `src.indexed_csv.save_indexed_csv`). Defaults to gzip level 9 (single threaded) and zstd level 3.
+        convert (callable, optional): Converts rows of `df` to the output format (e.g. to integer timestamps). The csv 
+            formats convert and write batches of rows, so the converted history is never held in memory as a whole.
+    """
+    path = output_path(file_path, output_format)
+    if output_format in CSV_CODECS:
+        options = csv_compression(output_format, compression)
+        if options['index']:
+            save_indexed_csv(df, path, options['level'], options['threads'], convert=convert)
+            return
+        #an index of a previous run would not match the new file
+        if os.path.exists(index_path(path)):
+            os.remove(index_path(path))
+        if options['method'] == 'gzip' and options['threads'] > 1:
+            save_to_block_gzip(df, path, options['level'], options['threads'], convert=convert)
+        else:
+            save_to_csv_chunked(df, path, options, convert)
+    elif output_format == 'parquet':
+        save_to_parquet(df if convert is None else convert(df), path)
+    else:
+        save_to_feather(df if convert is None else convert(df), path)
+
+class BackgroundWriter:
+    """Writes files in a background thread, so that the caller can continue (e.g. extract the next stream) while the
+    previous file is formatted and compressed.
+
+    At most `max_pending` write jobs wait in the queue (plus the one being written), `submit` blocks while the queue is
+    full. This caps the memory held by frames waiting to be written. Leaving the context waits for all pending writes
+    and raises the first error of a write job.
+
+    Example:
+        with BackgroundWriter() as writer:
+            study.save_bolus_event_history_to_file(out_path, True, writer=writer)
+            study.save_basal_event_history_to_file(out_path, True, writer=writer)
+    """
+    def __init__(self, max_pending=1):
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while (job := self._queue.get()) is not None:
+            fun, args, kwargs = job
+            #skip remaining jobs after an error, it is raised in the caller's thread
+            if self._error is None:
+                try:
+                    fun(*args, **kwargs)
+                except Exception as e:
+                    self._error = e
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise self._error
+
+    def submit(self, fun, *args, **kwargs):
+        """Queues `fun(*args, **kwargs)`, blocks while `max_pending` jobs are waiting."""
+        self._raise_error()
+        self._queue.put((fun, args, kwargs))
+
+    def close(self):
+        """Waits for all pending jobs and raises the first error of a job."""
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        self._raise_error()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            #do not mask the original error
+            self._queue.put(None)
+            self._thread.join()
 
 class StudyDataset:
     """
@@ -68,18 +479,26 @@ class StudyDataset:
 
     The class has several methods:
 
-    - `load_data`: This method is automatically called before extracting data. However, it can also be called up-front. After data was loaded 
-        the member variable `data_loaded` is set to True. It calls the `_load_data` method which should be implemented by subclasses.
+    - `load_data`: This method is automatically called before extracting data, loading only what the extracted stream needs. 
+        However, it can also be called up-front. After all data was loaded the member variable `data_loaded` is set to True. 
+        It calls the `_load_data` method which should be implemented by subclasses. Subclasses storing the streams in separate 
+        tables can implement `_load_streams` instead, so that extracting one stream only loads the tables it needs.
+        Subclasses reading several independent tables should use `_load_tables` to read them concurrently. The number of
+        concurrent reads is limited by `max_load_workers` (constructor argument).
     
     - `extract_bolus_event_history`, `extract_basal_event_history`, and `extract_cgm_history`:
       These methods are designed to extract specific types of data from the DataFrame.
-      They are decorated with `validate_bolus_output_dataframe`, `validate_basal_output_dataframe`,
-      and `validate_cgm_output_dataframe` respectively, which validate the output data.
+      The extracted data is cached and validated once using `check_bolus_output_dataframe`, `check_basal_output_dataframe`,
+      and `check_cgm_output_dataframe` respectively (see `set_validation_mode` to control how thoroughly).
       These methods should not be overridden by subclasses. Instead, subclasses should implement the corresponding `_extract_*` methods.
 
     - `_extract_bolus_event_history`, `_extract_basal_event_history`, and `_extract_cgm_history`:
       These methods are meant to be overridden by subclasses to extract specific types of data from the DataFrame.
 
+    - `iter_patients`: Iterates over the patients, yielding the extracted histories of one patient at a time. The histories
+      are sorted and indexed by patient once (see `patient_index`), so each patient is a slice of the indexed data.
+      `get_window` uses the same indexes to look up the rows of a patient in a time window.
+
     The returned dataframes are as follows:
 
     - For bolus event history: The DataFrame should have the columns 'patient_id' (string),
@@ -90,6 +509,13 @@ class StudyDataset:
 
     - For cgm history: The DataFrame should have the columns 'patient_id' (string),
       'datetime' (pandas datetime), and 'cgm' (float).
+
+    If the class is initialized with `compact='category'` or `compact='pyarrow'`, the extracted histories use compact dtypes 
+    instead (see `compact_dtypes`), which reduces memory and speeds up grouping by patient. The memory usage before and 
+    after the conversion is logged.
+
+    The raw data is kept in memory until `release` is called. If the class is initialized with `auto_release=True`, the raw 
+    data is released automatically as soon as all three histories were extracted. Released data is loaded again on demand.
     """
 
     COL_NAME_PATIENT_ID = 'patient_id'
@@ -100,13 +526,140 @@ class StudyDataset:
     COL_NAME_CGM = 'cgm'
 
 
-    def __init__(self, study_path, study_name):
+    HISTORIES = ('bolus_event_history', 'basal_event_history', 'cgm_history')
+
+    def __init__(self, study_path, study_name, max_load_workers=None, compact=None, auto_release=False):
+        if compact is not None and compact not in COMPACT_PATIENT_ID_DTYPES:
+            raise ValueError(f"compact must be None or one of {list(COMPACT_PATIENT_ID_DTYPES)} but is '{compact}'")
         self.study_path = study_path
         self.study_name = study_name
+        self.max_load_workers = max_load_workers
+        self.compact = compact
+        self.auto_release = auto_release
         self.bolus_event_history = None
         self.basal_event_history = None
         self.cgm_history = None
         self.data_loaded = False
+        self.loaded_streams = set()
+        self.load_subset = False
+        self.shared_patients = None
+        self.patient_indexes = {}
+
+    def _load_tables(self, tasks):
+        """Runs the loading tasks concurrently using at most `max_load_workers` threads (see `run_load_tasks`).
+
+        Args:
+            tasks (dict): Maps a task name to a callable or a tuple `(callable, [dependencies])`.
+
+        Returns:
+            results (dict): Maps each task name to its result.
+        """
+        return run_load_tasks(tasks, max_workers=self.max_load_workers)
+
+    def _missing_tables(self, streams):
+        """Returns the raw tables required for `streams` that were not loaded yet.
+
+        Requires the subclass to map each stream to its raw table in `STREAM_TABLES` and to store table `name` as `df_<name>`.
+        """
+        return sorted({self.STREAM_TABLES[stream] for stream in streams if getattr(self, f'df_{self.STREAM_TABLES[stream]}') is None})
+
+    def _available_streams(self):
+        """Returns the streams whose raw tables are loaded (see `_missing_tables`)."""
+        return [stream for stream, table in self.STREAM_TABLES.items() if getattr(self, f'df_{table}') is not None]
+
+    def _load_patient_tables(self, names, readers, patient_readers, patient_col='PtID', helpers=None):
+        """Reads the raw tables `names` and keeps only the rows of patients with data in all tables of `patient_readers`.
+
+        The shared patients are determined once and cached in `shared_patients`. Tables that are not requested are only 
+        read for their patient ids, so that tables loaded later (for other streams) are filtered the same way.
+
+        Args:
+            names (list): The tables to read.
+            readers (dict): Maps table names to callables returning the raw table.
+            patient_readers (dict): Maps all table names to callables returning the patient ids of the table.
+            patient_col (str): The patient id column.
+            helpers (dict, optional): Tasks that readers depend on (readers can be `(callable, [dependencies])` tuples, 
+                see `run_load_tasks`). Only the helpers needed by the scheduled readers run.
+
+        Returns:
+            tables (dict): Maps each requested table name to the filtered table.
+        """
+        tasks = {name: readers[name] for name in names}
+        if self.shared_patients is None:
+            tasks.update({f'{name}_patients': read for name, read in patient_readers.items() if name not in names})
+        needed = {dependency for task in tasks.values() if isinstance(task, tuple) for dependency in task[1]}
+        tasks.update({name: task for name, task in (helpers or {}).items() if name in needed})
+        tables = self._load_tables(tasks)
+        if self.shared_patients is None:
+            self.shared_patients = pandas_helper.get_shared_patients([tables[name][patient_col] if name in names else tables[f'{name}_patients']
+                                                                      for name in patient_readers])
+        return {name: pandas_helper.filter_patients(tables[name], self.shared_patients, patient_col) for name in names}
+
+    def _compact(self, df, name):
+        """Converts an extracted history to compact dtypes if enabled and logs the memory usage before and after."""
+        if self.compact is None:
+            return df
+        before = df.memory_usage(deep=True).sum()
+        df = compact_dtypes(df, self.compact)
+        after = df.memory_usage(deep=True).sum()
+        logger.info(f"{self.study_name} {name}: {before/1e6:.1f} MB -> {after/1e6:.1f} MB using compact dtypes")
+        return df
+
+    def _deduplicate(self, df, name, policies):
+        """Drops duplicated rows of a table using `pandas_helper.deduplicate` and logs the rows dropped by each policy."""
+        df, dropped = pandas_helper.deduplicate(df, policies)
+        for policy, count in dropped.items():
+            logger.debug(f"{self.study_name} {name}: dropped {count} duplicated rows ({policy})")
+        return df
+
+    def memory_usage(self):
+        """Returns the memory used by each dataframe held by the study (raw tables and extracted histories).
+
+        Returns:
+            memory (pd.Series): Memory in bytes indexed by attribute name.
+        """
+        return pd.Series({name: value.memory_usage(deep=True).sum() for name, value in vars(self).items()
+                          if isinstance(value, pd.DataFrame)}, dtype='int64')
+
+    def release(self, histories=False):
+        """Releases the raw data held by the study.
+
+        All dataframes (and cached patient indexes) held by the study except the extracted histories are dropped and 
+        `data_loaded` is reset, so the data is loaded again if another history needs to be extracted.
+
+        Args:
+            histories (bool, optional): Also drop the extracted histories and their patient indexes. Defaults to False.
+        """
+        keep = () if histories else self.HISTORIES
+        released = [name for name, value in vars(self).items()
+                    if isinstance(value, (pd.DataFrame, pd.Series, pd.Index)) and name not in keep]
+        for name in released:
+            setattr(self, name, None)
+        if histories:
+            self.patient_indexes = {}
+        self.data_loaded = False
+        self.loaded_streams = set()
+        logger.debug(f"{self.study_name}: released {released}")
+
+    def _release_if_done(self):
+        if self.auto_release and all(getattr(self, name) is not None for name in self.HISTORIES):
+            self.release()
+
+    def _load_streams(self, streams, subset):
+        """Loads the data required to extract the given streams.
+
+        The default implementation loads all data using `_load_data`. Subclasses that store the streams in separate tables
+        override this method to only load the tables required by `streams` (reusing tables loaded earlier).
+
+        Args:
+            streams (set): Names of the histories to load the data for (see `HISTORIES`).
+            subset (bool): Should only load a small subset of the data.
+
+        Returns:
+            loaded_streams (iterable): The histories that can be extracted after loading.
+        """
+        self._load_data(subset=subset)
+        return self.HISTORIES
 
     def _load_data(self, subset: bool = False):
         raise NotImplementedError("Subclasses should implement the _load_data method")
@@ -118,20 +671,25 @@ class StudyDataset:
         raise NotImplementedError("Subclasses should implement the _extract_cgm_history method")
     
     
-    def load_data(self, subset=False):
+    def load_data(self, subset=False, streams=None):
         """Method to load the data from the study directory. 
         
-        This method should be called before extracting any data from the dataset. 
-        This method should not be overridden by subclasses. Instead, subclasses should implement the _load_data method.
+        This method is called automatically before extracting data from the dataset, each `extract_*` method only loads the 
+        data required for its stream. This method should not be overridden by subclasses. Instead, subclasses should 
+        implement the _load_data method (or _load_streams to support loading streams independently).
         
         Args:
             subset (bool, optional): Should only load a small subset of the data for testing purposes. Defaults to False.
+            streams (list, optional): The histories to load the data for (see `HISTORIES`). Defaults to all.
         """
-        if not self.data_loaded:
-            self._load_data(subset=subset)
-            self.data_loaded = True
+        streams = set(self._check_streams(streams))
+        missing = streams - self.loaded_streams
+        if missing:
+            self.load_subset = subset
+            with instrumentation.stage('load', study=self.study_name, stream=','.join(sorted(missing))):
+                self.loaded_streams.update(self._load_streams(missing, subset))
+            self.data_loaded = self.loaded_streams.issuperset(self.HISTORIES)
 
-    @validate_bolus_output_dataframe
     def extract_bolus_event_history(self):
         """ Extract bolus event history from the dataset. 
         
@@ -149,11 +707,10 @@ class StudyDataset:
                 these are the duration of the extended delivery.
         """
         if self.bolus_event_history is None:
-            self.load_data()
-            self.bolus_event_history = self._extract_bolus_event_history()
+            self.bolus_event_history = self._extract('bolus_event_history', self._extract_bolus_event_history, check_bolus_output_dataframe)
+            self._release_if_done()
         return self.bolus_event_history
 
-    @validate_basal_output_dataframe
     def extract_basal_event_history(self):
         """ Extract basal event history from the dataset. 
         This method does do type checking on the output data and should not be overriden by subclasses. 
@@ -167,11 +724,10 @@ class StudyDataset:
                 - `basal_rate`: A float representing the basal rate in units per hour
         """
         if self.basal_event_history is None:
-            self.load_data()
-            self.basal_event_history = self._extract_basal_event_history()
+            self.basal_event_history = self._extract('basal_event_history', self._extract_basal_event_history, check_basal_output_dataframe)
+            self._release_if_done()
         return self.basal_event_history
 
-    @validate_cgm_output_dataframe
     def extract_cgm_history(self):
         """ Extract cgm measurements from the dataset. This method does
         do type checking on the output data and should not be overriden
@@ -186,16 +742,111 @@ class StudyDataset:
         
         """
         if self.cgm_history is None:
-            self.load_data()
-            self.cgm_history = self._extract_cgm_history()
+            self.cgm_history = self._extract('cgm_history', self._extract_cgm_history, check_cgm_output_dataframe)
+            self._release_if_done()
         return self.cgm_history
     
     
-    def save_cgm_to_file(self, out_path,  compressed=False):
+    def _extract(self, stream, extract, check):
+        """Loads the data of a stream, extracts, compacts and validates it (see the `extract_*` methods)."""
+        self.load_data(self.load_subset, streams=[stream])
+        with instrumentation.stage('extract', study=self.study_name, stream=stream) as record:
+            df = self._compact(extract(), stream)
+            record['rows'] = len(df)
+        with instrumentation.stage('validate', study=self.study_name, stream=stream, rows=len(df)):
+            df = check(df)
+        return df
+
+    def _check_streams(self, streams):
+        streams = list(self.HISTORIES if streams is None else streams)
+        if not set(streams).issubset(self.HISTORIES):
+            raise ValueError(f"Unknown streams {sorted(set(streams).difference(self.HISTORIES))}, must be in {list(self.HISTORIES)}")
+        return streams
+
+    def patient_index(self, stream):
+        """Returns the `PatientIndex` of an extracted history. The index is built once and cached.
+
+        Args:
+            stream (str): One of `HISTORIES`.
+
+        Returns:
+            index (PatientIndex): The history sorted by patient and datetime with per patient offsets.
+        """
+        self._check_streams([stream])
+        if stream not in self.patient_indexes:
+            self.patient_indexes[stream] = PatientIndex(getattr(self, f'extract_{stream}')(), self.COL_NAME_PATIENT_ID, self.COL_NAME_DATETIME)
+        return self.patient_indexes[stream]
+
+    def iter_patients(self, streams=None):
+        """Iterates over the patients of the study, one patient at a time.
+
+        The histories are extracted and indexed once (see `patient_index`), the rows of a patient are slices of the 
+        indexed histories and not copied. Patients without data in one of the streams get an empty frame for that stream.
+
+        Args:
+            streams (list, optional): The histories to include (see `HISTORIES`). Defaults to all.
+
+        Yields:
+            patient (tuple): `(patient_id, histories)` where `histories` maps each stream to the rows of the patient sorted by datetime.
+
+        Example:
+            for patient_id, histories in study.iter_patients(['bolus_event_history', 'cgm_history']):
+                print(patient_id, histories['bolus_event_history'].bolus.sum(), histories['cgm_history'].cgm.mean())
+        """
+        indexes = {stream: self.patient_index(stream) for stream in self._check_streams(streams)}
+        patients = functools.reduce(lambda a, b: a.union(b), [index.patients for index in indexes.values()])
+        for patient_id in patients:
+            yield patient_id, {stream: index.get(patient_id) for stream, index in indexes.items()}
+
+    def get_window(self, patient_id, start=None, end=None, streams=None):
+        """Returns the rows of a patient within a time window (`start <= datetime < end`).
+
+        The rows are located by binary search in the patient indexes (see `patient_index`) instead of filtering the whole
+        histories, so repeated lookups (e.g. patient-days in notebooks) are fast.
+
+        Args:
+            patient_id (str): The patient id.
+            start (datetime-like, optional): Start of the window (inclusive). Defaults to the first row of the patient.
+            end (datetime-like, optional): End of the window (exclusive). Defaults to the end of the patient's rows (all remaining rows are included).
+            streams (list, optional): The histories to include (see `HISTORIES`). Defaults to all.
+
+        Returns:
+            histories (dict): Maps each stream to the rows of the patient in the window sorted by datetime.
+
+        Example:
+            day = study.get_window('10', '2018-04-20', '2018-04-21', ['cgm_history'])['cgm_history']
+        """
+        return {stream: self.patient_index(stream).window(patient_id, start, end) for stream in self._check_streams(streams)}
+
+    #conversions to the output format (reduce file size), applied to batches of rows while writing (see `save_output`)
+    def _cgm_output(self, df):
+        return replace_columns(df, **{self.COL_NAME_DATETIME: to_unix_seconds(df[self.COL_NAME_DATETIME]),
+                                      self.COL_NAME_CGM: df[self.COL_NAME_CGM].astype('int')})
+
+    def _bolus_output(self, df):
+        return replace_columns(df, **{self.COL_NAME_DATETIME: to_unix_seconds(df[self.COL_NAME_DATETIME]),
+                                      self.COL_NAME_BOLUS_DELIVERY_DURATION: df[self.COL_NAME_BOLUS_DELIVERY_DURATION].dt.total_seconds().astype('int'),
+                                      self.COL_NAME_BOLUS: df[self.COL_NAME_BOLUS].astype('float64').round(4)})
+
+    def _basal_output(self, df):
+        return replace_columns(df, **{self.COL_NAME_DATETIME: to_unix_seconds(df[self.COL_NAME_DATETIME]),
+                                      self.COL_NAME_BASAL_RATE: df[self.COL_NAME_BASAL_RATE].astype('float64').round(4)})
+
+    def _write(self, stream, df, file_path, output_format, compression, writer, convert):
+        def save():
+            with instrumentation.stage('save', study=self.study_name, stream=stream, rows=len(df), format=output_format):
+                save_output(df, file_path, output_format, compression, convert)
+        if writer is None:
+            save()
+        else:
+            writer.submit(save)
+        return output_path(file_path, output_format)
+
+    def save_cgm_to_file(self, out_path, compressed=False, writer=None, output_format=None, compression=None):
         """Save the cgm history to a file.
         This method extracts the cgm history, processes it to reduce file size,
         and saves it to a specified output directory. If the directory does not exist,
-        it will be created. The filenames follow the pattern <study_name>_cgm_history.csv(.gz)
+        it will be created. The filenames follow the pattern <study_name>_cgm_history.<format> (csv, csv.gz, csv.zst, parquet or feather)
 
         The output csv format is as follows:
         - patient_id: A string representing the patient ID
@@ -213,23 +864,28 @@ class StudyDataset:
         Args:
             out_path (str): The path to the output directory where the file will be saved.
             compressed (bool, optional): If True, the output file will be compressed. Defaults to False.
+            writer (BackgroundWriter, optional): If given, the file is written in the background by the writer. Defaults to None.
+            output_format (str, optional): One of `OUTPUT_FORMATS` ('csv', 'csv.gz', 'csv.zst', 'parquet', 'feather'), overrides `compressed`. 
+                Parquet and feather files contain the same columns sorted by patient. Defaults to None.
+            compression (dict, optional): Compression `level` and `threads` of the csv formats (see `save_output`). Defaults to None.
+
+        Returns:
+            file_path (str): The path of the output file.
         """
         if not os.path.exists(out_path):
             logger.warning(f"Output directory {out_path} does not exist. Creating it now.")
             os.makedirs(out_path)
+        output_format = get_output_format(compressed, output_format)
         file_path = os.path.join(out_path, f"{self.study_name}_cgm_history")
-        df_cgm = self.extract_cgm_history().copy()
-        #reduce file size
-        df_cgm[self.COL_NAME_DATETIME] = df_cgm[self.COL_NAME_DATETIME].astype('int64')//10**9
-        df_cgm[self.COL_NAME_CGM] = df_cgm[self.COL_NAME_CGM].astype('int')
-        save_to_csv(df_cgm, file_path, compressed)    
+        df_cgm = self.extract_cgm_history()
+        return self._write('cgm_history', df_cgm, file_path, output_format, compression, writer, self._cgm_output)
         
-    def save_bolus_event_history_to_file(self, out_path, compressed=False):
+    def save_bolus_event_history_to_file(self, out_path, compressed=False, writer=None, output_format=None, compression=None):
         """
         Save the bolus event history to a file.
         This method extracts the bolus event history, processes it to reduce file size,
         and saves it to a specified output directory. If the directory does not exist,
-        it will be created. The filenames follow the pattern <study_name>_bolus_event_history.csv(.gz)
+        it will be created. The filenames follow the pattern <study_name>_bolus_event_history.<format> (csv, csv.gz, csv.zst, parquet or feather)
 
         The output csv format is as follows:
         - patient_id: A string representing the patient ID
@@ -248,27 +904,28 @@ class StudyDataset:
         Parameters:
             out_path (str): The path to the output directory where the file will be saved.
             compressed (bool): If True, the output file will be compressed. Default is False.
+            writer (BackgroundWriter, optional): If given, the file is written in the background by the writer. Default is None.
+            output_format (str, optional): One of `OUTPUT_FORMATS` ('csv', 'csv.gz', 'csv.zst', 'parquet', 'feather'), overrides `compressed`. 
+                Parquet and feather files contain the same columns sorted by patient. Default is None.
+            compression (dict, optional): Compression `level` and `threads` of the csv formats (see `save_output`). Default is None.
         Returns:
-            None
+            file_path (str): The path of the output file.
         """
 
         if not os.path.exists(out_path):
             logger.warning(f"Output directory {out_path} does not exist. Creating it now.")
             os.makedirs(out_path)
+        output_format = get_output_format(compressed, output_format)
         file_path = os.path.join(out_path, f"{self.study_name}_bolus_event_history")
-        df_bolus = self.extract_bolus_event_history().copy()
-        # Reduce file size
-        df_bolus[self.COL_NAME_DATETIME] = df_bolus[self.COL_NAME_DATETIME].astype('int64') // 10**9
-        df_bolus[self.COL_NAME_BOLUS_DELIVERY_DURATION] = df_bolus[self.COL_NAME_BOLUS_DELIVERY_DURATION].dt.total_seconds().astype('int')
-        df_bolus[self.COL_NAME_BOLUS] = df_bolus[self.COL_NAME_BOLUS].round(4)
-        save_to_csv(df_bolus, file_path, compressed)
-
-    def save_basal_event_history_to_file(self, out_path, compressed=False):
+        df_bolus = self.extract_bolus_event_history()
+        return self._write('bolus_event_history', df_bolus, file_path, output_format, compression, writer, self._bolus_output)
+
+    def save_basal_event_history_to_file(self, out_path, compressed=False, writer=None, output_format=None, compression=None):
         """
         Save the basal event history to a file.
         This method extracts the basal event history, processes it to reduce file size,
         and saves it to a specified output directory. If the directory does not exist,
-        it will be created. The filenames follow the pattern <study_name>_basal_event_history.csv(.gz) 
+        it will be created. The filenames follow the pattern <study_name>_basal_event_history.<format> (csv, csv.gz, csv.zst, parquet or feather) 
 
         The output format is as follows: csv file with the following columns:
         - patient_id: A string representing the patient ID
@@ -286,17 +943,18 @@ class StudyDataset:
         Parameters:
             out_path (str): The path to the output directory where the file will be saved.
             compressed (bool): If True, the output file will be compressed. Default is False.
+            writer (BackgroundWriter, optional): If given, the file is written in the background by the writer. Default is None.
+            output_format (str, optional): One of `OUTPUT_FORMATS` ('csv', 'csv.gz', 'csv.zst', 'parquet', 'feather'), overrides `compressed`. 
+                Parquet and feather files contain the same columns sorted by patient. Default is None.
+            compression (dict, optional): Compression `level` and `threads` of the csv formats (see `save_output`). Default is None.
         Returns:
-            None
+            file_path (str): The path of the output file.
         """
 
         if not os.path.exists(out_path):
             logger.warning(f"Output directory {out_path} does not exist. Creating it now.")
             os.makedirs(out_path)
+        output_format = get_output_format(compressed, output_format)
         file_path = os.path.join(out_path, f"{self.study_name}_basal_event_history")
-        df_basal = self.extract_basal_event_history().copy()
-        # Reduce file size
-        df_basal[self.COL_NAME_DATETIME] = df_basal[self.COL_NAME_DATETIME].astype('int64') // 10**9
-        df_basal[self.COL_NAME_BASAL_RATE] = df_basal[self.COL_NAME_BASAL_RATE].round(4)
-
-        save_to_csv(df_basal, file_path, compressed)
\ No newline at end of file
+        df_basal = self.extract_basal_event_history()
+        return self._write('basal_event_history', df_basal, file_path, output_format, compression, writer, self._basal_output)
\ No newline at end of file
@@ -2,14 +2,13 @@ import pandas as pd
 import os 
 import numpy as np
 from datetime import datetime, timedelta
-import isodate
 
 from studies.studydataset import StudyDataset
 from src.logger import Logger
-from src.pandas_helper import get_duplicated_max_indexes
+from src.pandas_helper import DuplicatePolicy
 
-def load_facm(path, subset):
-        
+def read_facm(path, subset):
+        """Reads the FACM table and drops columns we don't need. Datetimes and durations are not parsed yet (see `parse_facm`)."""
         #if subset, read only the first 25k Rows
         if subset:
             chunk_size = 25000 
@@ -29,21 +28,51 @@ def load_facm(path, subset):
                                   'INSDVSRC',# Source of insulin delivery (Injections or Pump). Not needed for extraction.
                                   'INSSTYPE'# Insulin subtype (e.g., suspend, etc.) but many NaN values making it unreliable to select basal, not needed
                                   ])
-        
+        return facm
+
+def parse_facm(facm):
+        """Parses datetimes (FADTC) and durations (FADUR) of a FACM table returned by `read_facm`, drops duplicates and sorts by FADTC."""
         #datetimes
         facm['FADTC'] = facm['FADTC'].apply(lambda x: datetime(1960, 1, 1) + timedelta(seconds=x) if pd.notnull(x) else pd.NaT)
-        #durations
+        #durations (isodate is only imported when a FACM table is parsed)
+        import isodate
         facm['FADUR'] = facm.FADUR.dropna().apply(isodate.parse_duration, as_timedelta_if_possible=True)
         #drop duplciates
         facm = facm.drop_duplicates()
         return facm.sort_values('FADTC')
 
+def load_facm(path, subset):
+        return parse_facm(read_facm(path, subset))
+
 def load_dx(path):
         dx = pd.read_sas(path, encoding='latin-1').replace('', np.nan)
         dx = dx.drop(columns=['DXSCAT','DXPRESP','STUDYID','DOMAIN','SPDEVID','DXSEQ','DXCAT','DXSCAT','DXSTRTPT','DXDTC','DXENRTPT','DXEVINTX','VISIT'])
         return dx
 
-def load_lb(path, subset):
+def read_patient_ids(path, subset, category=None, chunk_rows=500_000):
+    """Reads the unique patient ids (USUBJID) of a table in chunks, without keeping the whole table in memory.
+
+    Args:
+        path (str): The XPT file.
+        subset (bool): Only read the first 25k rows (as `read_facm` and `read_lb`).
+        category (str, optional): Only the ids of rows with this LBCAT (see `read_lb`).
+        chunk_rows (int): Number of rows read at a time.
+
+    Returns:
+        patient_ids (pd.Series): The unique patient ids, converted as in `read_facm` and `read_lb`.
+    """
+    ids = []
+    with pd.read_sas(path, encoding='latin-1', chunksize=25000 if subset else chunk_rows) as reader:
+        for chunk in reader:
+            if category is not None:
+                chunk = chunk.loc[chunk.LBCAT == category]
+            ids.append(chunk.USUBJID.unique())
+            if subset:
+                break
+    return pd.Series(pd.unique(np.concatenate(ids)) if ids else [], dtype=object).replace('', np.nan).astype('str')
+
+def read_lb(path, subset):
+    """Reads the CGM readings from the LB table. Datetimes are not parsed yet (see `parse_lb`)."""
     #if subset, read only the first 25k Rows
     if subset:
         chunk_size = 25000 
@@ -55,10 +84,15 @@ def load_lb(path, subset):
     lb = lb.replace('', np.nan).astype({'USUBJID': 'str'})[['USUBJID','LBCAT','LBORRES','LBDTC']]
     #drop hab1c readings and keep only CGM readings
     lb = lb.loc[lb.LBCAT=='CGM']
-    #date conversion
+    return lb.drop(columns='LBCAT')
+
+def parse_lb(lb):
+    """Parses the datetimes (LBDTC) of a LB table returned by `read_lb`."""
     lb['LBDTC'] = lb['LBDTC'].apply(lambda x: datetime(1960, 1, 1) + timedelta(seconds=x) if pd.notnull(x) else pd.NaT)
-    lb.drop(columns='LBCAT',inplace=True)
     return lb
+
+def load_lb(path, subset):
+    return parse_lb(read_lb(path, subset))
      
 def overlaps(df):
     assert df.FADTC.is_monotonic_increasing
@@ -68,41 +102,46 @@ def overlaps(df):
     return overlap
 
 class T1DEXI(StudyDataset):
-    def __init__(self, study_path, drop_mdi=False):
-        super().__init__(study_path, 'T1DEXI')
+    def __init__(self, study_path, drop_mdi=False, **kwargs):
+        super().__init__(study_path, 'T1DEXI', **kwargs)
         self.drop_mdi = drop_mdi
+        self.facm = None
+        self.dx = None
+        self.lb = None
     
-    
-    def _load_data(self, subset: bool = False):
-        dx = load_dx(os.path.join(self.study_path,'DX.xpt'))
-        facm = load_facm(os.path.join(self.study_path,'FACM.xpt'),subset)
-        lb = load_lb(os.path.join(self.study_path,'LB.xpt'),subset)
-        
-        #only keep patients that have data in all three datasets
-        facm_patients = facm.USUBJID.unique()
-        dx_patients = dx.USUBJID.unique()
-        lb_patients = lb.USUBJID.unique()
-        shared_patients = set(facm_patients) & set(dx_patients) & set(lb_patients)
+    def _load_streams(self, streams, subset):
+        #boluses and basals are stored in FACM, cgms in LB. DX is always needed (mdi patients, device type)
+        names = [name for name, needed in [('dx', True), 
+                                           ('facm', bool(streams & {'bolus_event_history', 'basal_event_history'})),
+                                           ('lb', 'cgm_history' in streams)] if needed and getattr(self, name) is None]
+        readers = {'dx': lambda: load_dx(os.path.join(self.study_path,'DX.xpt')),
+                   'facm': lambda: read_facm(os.path.join(self.study_path,'FACM.xpt'),subset),
+                   'lb': lambda: read_lb(os.path.join(self.study_path,'LB.xpt'),subset)}
+        patient_readers = {'dx': lambda: readers['dx']().USUBJID,
+                           'facm': lambda: read_patient_ids(os.path.join(self.study_path,'FACM.xpt'),subset),
+                           'lb': lambda: read_patient_ids(os.path.join(self.study_path,'LB.xpt'),subset,'CGM')}
         
-        facm = facm[facm['USUBJID'].isin(shared_patients)]
-        dx = dx[dx['USUBJID'].isin(shared_patients)]
-        lb = lb[lb['USUBJID'].isin(shared_patients)]
+        #only keep patients that have data in all three datasets (tables of other streams are read in chunks for their 
+        #patient ids only, the tables are read again if their streams are requested later)
+        tables = self._load_patient_tables(names, readers, patient_readers, 'USUBJID')
+        dx = tables.get('dx', self.dx)
         
         #drop all mdi patients (we have reasons to believe the recordings contain a lot of duplicates)
         if self.drop_mdi:
             mdi_patients = dx.loc[dx.DXTRT=='MULTIPLE DAILY INJECTIONS'].USUBJID.unique()
-            facm = facm.loc[~facm.USUBJID.isin(mdi_patients)]
-            lb = lb.loc[~lb.USUBJID.isin(mdi_patients)]
-
-        
-        # merge device data (DXTRT) to facm (we need this later to distinguish between pump and mdi patients)
-        facm = pd.merge(facm, dx.loc[~dx.DXTRT.isin(['INSULIN PUMP','CLOSED LOOP INSULIN PUMP'])], on='USUBJID',how='left')
-        facm = facm.astype({'USUBJID': 'str'})
-
-        self.facm = facm
+            tables = {name: df.loc[~df.USUBJID.isin(mdi_patients)] if name != 'dx' else df for name, df in tables.items()}
+
+        #parse datetimes and durations of the remaining rows
+        if 'facm' in tables:
+            facm = parse_facm(tables['facm'])
+            # merge device data (DXTRT) to facm (we need this later to distinguish between pump and mdi patients)
+            facm = pd.merge(facm, dx.loc[~dx.DXTRT.isin(['INSULIN PUMP','CLOSED LOOP INSULIN PUMP'])], on='USUBJID',how='left')
+            self.facm = facm.astype({'USUBJID': 'str'})
+        if 'lb' in tables:
+            self.lb = parse_lb(tables['lb'])
         self.dx = dx
-        self.lb = lb
-        self.data_loaded = True
+        return [stream for stream, table in [('bolus_event_history', self.facm), ('basal_event_history', self.facm), ('cgm_history', self.lb)] 
+                if table is not None]
 
     def _extract_bolus_event_history(self):
         bolus_rows = self.facm.loc[self.facm.FATEST=='BOLUS INSULIN'].copy()
@@ -151,8 +190,7 @@ class T1DEXI(StudyDataset):
         basal_rows = basal_rows.loc[basal_rows.FATEST=='BASAL FLOW RATE']
 
         #drop duplicated flow rates, keeping the maximum value
-        (_,_,i_drop) =  get_duplicated_max_indexes(basal_rows, ['USUBJID','FADTC'], 'FAORRES')
-        basal_rows = basal_rows.drop(i_drop)
+        basal_rows = self._deduplicate(basal_rows, 'facm', [DuplicatePolicy(['USUBJID', 'FADTC'], 'max', 'FAORRES')])
 
         #fill NaN basal rates with zeros (in some cases, these are suspends, in others we don't know)
         #print(f'Dropping {basal_rows.FAORRES.isna().sum()} rows with NaN basal rates')
@@ -177,7 +215,7 @@ class T1DEXI(StudyDataset):
         return basal_rows
 
     def _extract_cgm_history(self):
-        lb = self.lb.drop_duplicates(subset=['USUBJID','LBDTC'],keep='first')
+        lb = self._deduplicate(self.lb, 'lb', [DuplicatePolicy(['USUBJID', 'LBDTC'])])
         return lb.rename(columns={
             'USUBJID': self.COL_NAME_PATIENT_ID,
             'LBDTC': self.COL_NAME_DATETIME,
@@ -185,8 +223,8 @@ class T1DEXI(StudyDataset):
         })
         
 class T1DEXIP(T1DEXI):
-    def __init__(self, study_path, drop_mdi=False):
-        super().__init__(study_path)
+    def __init__(self, study_path, drop_mdi=False, **kwargs):
+        super().__init__(study_path, **kwargs)
         self.study_name = 'T1DEXIP'
         self.drop_mdi = drop_mdi
     
@@ -0,0 +1,40 @@
+import os
+import sys
+import pandas as pd
+import pytest
+
+#the benchmark scripts are not a package (an installed `benchmarks` package would shadow it)
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'benchmarks')))
+import suite
+
+def test_benchmarks_run_at_tiny_scale(tmp_path):
+    results = suite.run(['tiny'], repeat=1, data_path=str(tmp_path))
+    assert list(results.benchmark) == list(suite.BENCHMARKS)
+    assert results.error.isna().all(), results.loc[results.error.notna(), ['benchmark', 'error']].to_string()
+    assert (results.status == 'ok').all()
+    assert (results.seconds >= 0).all() and (results.memory_mb >= 0).all()
+
+def test_benchmarks_cover_all_studies():
+    names = set(suite.BENCHMARKS)
+    for study in suite.STUDY_FOLDERS:
+        assert f"load.{study}" in names
+        assert {f"extract.{study}.{stream}" for stream in suite.StudyDataset.HISTORIES}.issubset(names)
+
+def test_check_thresholds():
+    results = pd.DataFrame({'benchmark': ['load.DCLP3', 'load.Flair', 'tdd.calculate_tdd', 'extract.Loop.cgm_history'],
+                            'scale': ['small', 'small', 'medium', 'small'],
+                            'seconds': [1.0, 3.0, 1.0, None],
+                            'memory_mb': [10.0, 50.0, 500.0, None],
+                            'error': [None, None, None, 'ValueError: x']})
+    thresholds = {'load.*': {'small': {'seconds': 2, 'memory_mb': 20}},
+                  '*': {'*': {'memory_mb': 100}}}
+    checked = suite.check_thresholds(results, thresholds)
+    assert list(checked.status) == ['ok', 'slow+memory', 'memory', 'error']
+    assert list(checked.max_seconds.fillna(-1)) == [2, 2, -1, -1]
+    #the first pattern matching both the benchmark and the scale
+    assert suite.find_threshold(thresholds, 'load.DCLP3', 'large') == {'memory_mb': 100}
+    assert suite.find_threshold({'load.*': {'small': {}}}, 'tdd.calculate_tdd', 'small') is None
+
+def test_unknown_scale():
+    with pytest.raises(ValueError, match='Unknown scales'):
+        suite.run(['huge'])
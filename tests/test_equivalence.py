@@ -0,0 +1,46 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from src import equivalence
+from src.postprocessing import bolus_transform
+
+@pytest.mark.parametrize('function', list(equivalence.FUNCTIONS))
+def test_implementations_match_reference(function):
+    result = equivalence.assert_equivalent(function, patients=2, days=2, seed=1)
+    assert result.cases > 0
+
+def test_compare_frames():
+    expected = pd.DataFrame({'datetime': pd.date_range('2020-01-01', periods=4, freq='5min'), 'bolus': [0.0, 1.0, np.nan, 2.0]})
+    assert equivalence.compare_frames(expected, expected.assign(bolus=expected.bolus + 1e-13), 'datetime') is None
+    difference = equivalence.compare_frames(expected, expected.assign(bolus=[0.0, 1.0, np.nan, 2.1]), 'datetime')
+    assert (difference.row, difference.key, difference.column) == (3, pd.Timestamp('2020-01-01 00:15'), 'bolus')
+    assert (difference.expected, difference.actual) == (2.0, 2.1)
+    #the first differing row over all columns
+    difference = equivalence.compare_frames(expected, pd.DataFrame({'datetime': expected.datetime.shift(-1, fill_value=pd.Timestamp(0)),
+                                                                    'bolus': [0.0, 1.5, np.nan, 2.0]}), 'datetime')
+    assert (difference.row, difference.column) == (0, 'datetime')
+    difference = equivalence.compare_frames(expected, expected.iloc[:3], 'datetime')
+    assert difference.row == 3 and 'row counts differ' in difference.message
+    assert 'columns differ' in equivalence.compare_frames(expected, expected[['bolus']]).message
+
+def test_differing_candidate_reports_patient_and_timestamp():
+    def candidate(df):
+        result = bolus_transform(df)
+        result.loc[result.bolus > 2.5, 'bolus'] += 0.01
+        return result
+    with pytest.raises(AssertionError, match=r"patient standard_and_extended, row 96 at 2020-01-01 08:00:00, column 'bolus'"):
+        equivalence.assert_equivalent('bolus_transform', candidate, sources=['fixtures'])
+
+def test_candidate_exceptions():
+    def failing(df):
+        raise KeyError('bolus')
+    result, = equivalence.check(['bolus_transform'], {'bolus_transform': failing}, sources=['fixtures'])
+    assert "candidate raised KeyError('bolus')" in result.difference.message
+    #both implementations reject empty frames
+    case = equivalence.Case('calculate_daily_basal_dose', 'fixtures', 'empty', (pd.DataFrame({'datetime': pd.to_datetime([]), 'basal_rate': []}),), {})
+    assert equivalence.compare_case(case) is None
+
+def test_unknown_function():
+    with pytest.raises(ValueError, match='Unknown functions'):
+        equivalence.check(['tdd'])
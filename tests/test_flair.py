@@ -188,6 +188,15 @@ def test_load_data_basal_only(sample_data_dir_basal_simple):
     pd.testing.assert_frame_equal(tdd_basal, expected_basal)
     print("Assertion passed: tdd_basal and expected_basal are equal")
 
+def test_extract_cgm_only_loads_cgm_table(sample_data_closed_loop):
+    flair = Flair(study_path=str(sample_data_closed_loop))
+    cgm = flair.extract_cgm_history()
+    assert len(cgm) > 0
+    assert flair.df_pump is None and not flair.data_loaded
+
+    flair.extract_basal_event_history()
+    assert flair.df_pump is not None and flair.data_loaded
+
 if __name__ == "__main__":
     # Create a temporary directory using pathlib for debugging purposes
     temp_folder = os.path.join(os.getcwd(), 'temp_folder')
@@ -196,4 +205,4 @@ if __name__ == "__main__":
     sample_data_closed_loop(temp_folder)
     test_sample_data_closed_loop(temp_folder)
     
-    shutil.rmtree(temp_folder)
\ No newline at end of file
+    shutil.rmtree(temp_folder)
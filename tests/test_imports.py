@@ -0,0 +1,25 @@
+import os
+import sys
+import subprocess
+import pytest
+
+import studies
+
+def loaded_modules(statement, modules):
+    """Returns the modules loaded by an import statement in a fresh interpreter."""
+    code = f"import sys\n{statement}\nprint(','.join(m for m in {modules!r} if m in sys.modules))"
+    return subprocess.run([sys.executable, '-c', code], cwd=os.path.join(os.path.dirname(__file__), '..'),
+                          capture_output=True, text=True, check=True).stdout.strip()
+
+@pytest.mark.parametrize('statement', ['import studies', 'from studies import DCLP3, Loop, T1DEXI', 'import run_functions',
+                                       'import src.drawing, src.cdf'])
+def test_heavy_dependencies_are_imported_lazily(statement):
+    assert loaded_modules(statement, ['dask', 'isodate', 'matplotlib']) == ''
+
+def test_studies_are_imported_on_access():
+    assert loaded_modules('import studies', ['studies.dclp', 'studies.loop', 'studies.studydataset']) == ''
+    assert loaded_modules('from studies import DCLP3', ['studies.dclp', 'studies.loop']) == 'studies.dclp'
+    assert studies.Loop.__module__ == 'studies.loop'
+    assert 'T1DEXIP' in dir(studies)
+    with pytest.raises(AttributeError):
+        studies.DCLP4
@@ -0,0 +1,49 @@
+import gzip
+import pandas as pd
+import pytest
+from src.indexed_csv import save_indexed_csv, IndexedCsvReader, read_patient, index_path, compress_blocks
+
+def make_history():
+    return pd.DataFrame({'patient_id': ['2', '1', '2', '1', '3'],
+                         'datetime': [1000, 900, 1100, 950, 500],
+                         'cgm': [100, 110, 120, 130, 140]})
+
+@pytest.mark.parametrize('threads', [1, 2])
+def test_indexed_csv_is_regular_gzip(tmp_path, threads):
+    file_path = str(tmp_path / 'cgm.csv.gz')
+    save_indexed_csv(make_history(), file_path, level=6, threads=threads)
+    expected = make_history().sort_values('patient_id', kind='stable')
+    with gzip.open(file_path, 'rt') as f:
+        assert f.read() == expected.to_csv(index=False)
+
+def test_indexed_csv_index(tmp_path):
+    file_path = str(tmp_path / 'cgm.csv.gz')
+    save_indexed_csv(make_history(), file_path)
+    index = pd.read_csv(index_path(file_path), dtype={'patient_id': str})
+    assert index.patient_id.tolist() == ['1', '2', '3']
+    assert index.rows.tolist() == [2, 2, 1]
+    assert index.first_datetime.tolist() == [900, 1000, 500]
+    assert index.last_datetime.tolist() == [950, 1100, 500]
+    assert (index.offset + index['size']).iloc[-1] == (tmp_path / 'cgm.csv.gz').stat().st_size
+
+def test_indexed_csv_reader(tmp_path):
+    file_path = str(tmp_path / 'cgm.csv.gz')
+    save_indexed_csv(make_history(), file_path)
+    reader = IndexedCsvReader(file_path)
+    assert reader.patients.tolist() == ['1', '2', '3']
+    full = pd.read_csv(file_path, dtype={'patient_id': str})
+    for patient_id in reader.patients:
+        pd.testing.assert_frame_equal(reader.read(patient_id), full[full.patient_id == patient_id].reset_index(drop=True))
+    assert reader.read('4').empty
+    assert list(reader.read('4').columns) == ['patient_id', 'datetime', 'cgm']
+    assert read_patient(file_path, '3').cgm.tolist() == [140]
+
+def test_indexed_csv_empty(tmp_path):
+    file_path = str(tmp_path / 'cgm.csv.gz')
+    save_indexed_csv(make_history().iloc[:0], file_path)
+    reader = IndexedCsvReader(file_path)
+    assert len(reader.patients) == 0 and reader.read('1').empty
+
+def test_compress_blocks_keeps_order():
+    blocks = [str(i).encode() * 100 for i in range(10)]
+    assert [gzip.decompress(member) for member in compress_blocks(blocks, threads=3)] == blocks
@@ -0,0 +1,85 @@
+import json
+import numpy as np
+import pandas as pd
+import pytest
+from src import instrumentation
+from tests.test_studydataset import MockHistoryStudy
+
+@pytest.fixture
+def recording():
+    yield
+    instrumentation.disable()
+
+def test_stage_disabled_records_nothing():
+    with instrumentation.stage('load', study='mock') as record:
+        record['rows'] = 1
+    assert not instrumentation.is_enabled()
+    assert instrumentation.get_records() == []
+
+def test_stage_records(recording):
+    instrumentation.enable()
+    with instrumentation.stage('outer', study='mock'):
+        with instrumentation.stage('inner', study='mock') as record:
+            record['rows'] = 10
+    inner, outer = instrumentation.get_records()
+    assert (inner['stage'], inner['rows'], outer['stage']) == ('inner', 10, 'outer')
+    assert outer['wall_seconds'] >= inner['wall_seconds'] >= 0
+    assert {'cpu_seconds', 'process_max_rss_mb', 'pid'} <= set(inner)
+
+def test_stage_traced_peak_includes_nested_stages(recording):
+    instrumentation.enable(trace_memory=True)
+    with instrumentation.stage('outer'):
+        with instrumentation.stage('inner'):
+            data = np.ones(2**20)  # 8 MB
+            del data
+    inner, outer = instrumentation.get_records()
+    assert inner['traced_peak_mb'] >= 8
+    assert outer['traced_peak_mb'] >= inner['traced_peak_mb']
+
+def test_study_stages_and_report(recording, tmp_path):
+    instrumentation.enable()
+    study = MockHistoryStudy('path', 'mock')
+    study.save_cgm_to_file(str(tmp_path))
+    stages = instrumentation.disable()
+    assert [(stage['stage'], stage['stream']) for stage in stages] == [('load', 'cgm_history'), ('extract', 'cgm_history'), 
+                                                                      ('validate', 'cgm_history'), ('save', 'cgm_history')]
+    assert all(stage['rows'] == 2 for stage in stages[1:])
+
+    df = instrumentation.write_report(str(tmp_path / 'reports' / 'run'), stages, workers=1)
+    assert pd.read_csv(tmp_path / 'reports' / 'run.csv').stage.tolist() == df.stage.tolist()
+    with open(tmp_path / 'reports' / 'run.json') as f:
+        report = json.load(f)
+    assert report['workers'] == 1 and len(report['stages']) == 4
+
+@pytest.fixture
+def profiling(tmp_path):
+    yield tmp_path
+    instrumentation.disable_profiling()
+
+def test_profiling_writes_stats_and_allocations(profiling):
+    import pstats
+    import tracemalloc
+    instrumentation.enable_profiling(str(profiling), studies=['mock'], stages=['extract', 'save'], top=5)
+    MockHistoryStudy('path', 'mock').save_cgm_to_file(str(profiling))
+    MockHistoryStudy('path', 'other').save_cgm_to_file(str(profiling))
+    assert sorted(path.name for path in profiling.iterdir() if 'mock_cgm_history_' in path.name and path.suffix != '.csv') == [
+        'mock_cgm_history_extract.allocations.txt', 'mock_cgm_history_extract.pstats', 
+        'mock_cgm_history_save.allocations.txt', 'mock_cgm_history_save.pstats']
+    assert not any(path.name.startswith('other_') and path.suffix == '.pstats' for path in profiling.iterdir())
+    stats = pstats.Stats(str(profiling / 'mock_cgm_history_extract.pstats'))
+    assert any(function == '_extract_cgm_history' for _, _, function in stats.stats)
+    assert len((profiling / 'mock_cgm_history_save.allocations.txt').read_text().splitlines()) <= 6
+    assert not tracemalloc.is_tracing()
+
+def test_profiling_nested_stages(profiling):
+    instrumentation.enable_profiling(str(profiling))
+    with instrumentation.stage('study', study='mock'):
+        with instrumentation.stage('load', study='mock'):
+            pass
+    assert sorted(path.name for path in profiling.iterdir()) == ['mock_study.allocations.txt', 'mock_study.pstats']
+
+def test_profiling_disabled(tmp_path):
+    import tracemalloc
+    with instrumentation.stage('load', study='mock'):
+        assert not tracemalloc.is_tracing()
+    assert list(tmp_path.iterdir()) == []
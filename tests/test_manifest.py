@@ -0,0 +1,71 @@
+import os
+import json
+from src.manifest import Manifest, fingerprint_files, code_version, write_json_atomic
+
+def make_output(out_path, stream='cgm_history', content=b'data'):
+    file_path = os.path.join(out_path, f'study_{stream}.csv.gz')
+    with open(file_path, 'wb') as f:
+        f.write(content)
+    return file_path
+
+def test_fingerprint_changes_with_files(tmp_path):
+    raw = tmp_path / 'raw'
+    raw.mkdir()
+    (raw / 'a.txt').write_text('a')
+    fingerprint = fingerprint_files(str(raw))
+    assert fingerprint_files(str(raw)) == fingerprint
+    (raw / 'a.txt').write_text('ab')
+    assert fingerprint_files(str(raw)) != fingerprint
+    fingerprint = fingerprint_files(str(raw))
+    (raw / 'b.txt').write_text('b')
+    assert fingerprint_files(str(raw)) != fingerprint
+
+def test_code_version_changes_with_code(tmp_path):
+    (tmp_path / 'module.py').write_text('x = 1')
+    (tmp_path / 'notes.txt').write_text('ignored')
+    version = code_version([str(tmp_path)])
+    (tmp_path / 'notes.txt').write_text('still ignored')
+    assert code_version([str(tmp_path)]) == version
+    (tmp_path / 'module.py').write_text('x = 2')
+    assert code_version([str(tmp_path)]) != version
+
+def test_manifest_keeps_completed_streams(tmp_path):
+    manifest = Manifest.load(str(tmp_path), 'Study', 'source', 'code', {'load_subset': False})
+    assert manifest.pending_streams(['bolus_event_history', 'cgm_history']) == ['bolus_event_history', 'cgm_history']
+    manifest.complete_stream('cgm_history', make_output(str(tmp_path)), rows=10, seconds=1.5)
+
+    manifest = Manifest.load(str(tmp_path), 'Study', 'source', 'code', {'load_subset': False})
+    assert manifest.pending_streams(['bolus_event_history', 'cgm_history']) == ['bolus_event_history']
+    assert manifest.data['streams']['cgm_history']['rows'] == 10
+    assert manifest.data['streams']['cgm_history']['file'] == 'study_cgm_history.csv.gz'
+
+def test_manifest_discards_streams_if_inputs_changed(tmp_path):
+    manifest = Manifest.load(str(tmp_path), 'Study', 'source', 'code', {'load_subset': False})
+    manifest.complete_stream('cgm_history', make_output(str(tmp_path)), rows=10, seconds=1.5)
+    for changed in [dict(source='other'), dict(code='other'), dict(options={'load_subset': True})]:
+        arguments = dict(out_path=str(tmp_path), study='Study', source='source', code='code', options={'load_subset': False})
+        arguments.update(changed)
+        assert Manifest.load(**arguments).pending_streams(['cgm_history']) == ['cgm_history']
+
+def test_manifest_detects_missing_or_truncated_files(tmp_path):
+    manifest = Manifest.load(str(tmp_path), 'Study', 'source', 'code', {})
+    file_path = make_output(str(tmp_path))
+    manifest.complete_stream('cgm_history', file_path, rows=10, seconds=1.5)
+    assert manifest.is_complete('cgm_history')
+    make_output(str(tmp_path), content=b'dat')
+    assert not manifest.is_complete('cgm_history')
+    os.remove(file_path)
+    assert not manifest.is_complete('cgm_history')
+
+def test_manifest_ignores_corrupt_file(tmp_path):
+    (tmp_path / Manifest.FILE_NAME).write_text('{"study": ')
+    manifest = Manifest.load(str(tmp_path), 'Study', 'source', 'code', {})
+    assert manifest.data['streams'] == {}
+
+def test_write_json_atomic(tmp_path):
+    file_path = str(tmp_path / 'data.json')
+    write_json_atomic({'a': 1}, file_path)
+    write_json_atomic({'a': 2}, file_path)
+    with open(file_path) as f:
+        assert json.load(f) == {'a': 2}
+    assert os.listdir(tmp_path) == ['data.json']
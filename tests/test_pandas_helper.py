@@ -34,4 +34,90 @@ def test_split_groups():
 def test_split_sequences():
     df = pd.DataFrame({'label': ['A', 'A', 'B', 'B', 'B', 'A', 'A', 'C', 'C', 'A']})
     actual_sequences = pandas_helper.split_sequences(df, 'label')
-    pd.testing.assert_series_equal(actual_sequences, pd.Series([1, 1, 2, 2, 2, 3, 3, 4, 4, 5], name='label'))
\ No newline at end of file
+    pd.testing.assert_series_equal(actual_sequences, pd.Series([1, 1, 2, 2, 2, 3, 3, 4, 4, 5], name='label'))
+
+def test_filter_shared_patients():
+    df_bolus = pd.DataFrame({'PtID': [1, 1, 2, 3], 'value': [1, 2, 3, 4]})
+    df_basal = pd.DataFrame({'PtID': [2, 1, 4], 'value': [5, 6, 7]}, index=[10, 11, 12])
+    df_cgm = pd.DataFrame({'PtID': [1, 2, 2, 3, 4], 'value': [8, 9, 10, 11, 12]})
+
+    bolus, basal, cgm = pandas_helper.filter_shared_patients([df_bolus, df_basal, df_cgm], 'PtID')
+
+    pd.testing.assert_frame_equal(bolus, df_bolus.loc[[0, 1, 2]])
+    pd.testing.assert_frame_equal(basal, df_basal.loc[[10, 11]])
+    pd.testing.assert_frame_equal(cgm, df_cgm.loc[[0, 1, 2]])
+
+@pytest.mark.parametrize('keep', ['first', 'last'])
+def test_deduplicate_first_last(keep):
+    df = pd.DataFrame({'PtID': ['1', '2', '1', '1', '2', np.nan, np.nan],
+                       'datetime': pd.to_datetime(['2020-01-01', '2020-01-01', '2020-01-02', '2020-01-01', '2020-01-01', '2020-01-01', '2020-01-01']),
+                       'value': [1, 2, 3, 4, 5, 6, 7]}, index=[10, 11, 12, 13, 14, 15, 16])
+    actual, dropped = pandas_helper.deduplicate(df, [pandas_helper.DuplicatePolicy(['PtID', 'datetime'], keep)])
+    pd.testing.assert_frame_equal(actual, df.drop_duplicates(['PtID', 'datetime'], keep=keep))
+    assert dropped.to_dict() == {f'{keep} per PtID, datetime': 3}
+
+def test_deduplicate_max_min():
+    df = pd.DataFrame({'PtID': [1, 1, 1, 2, 2, 2, 3, 3, 3, 1],
+                       'DataDtTm': [1, 2, 3, 1, 2, 2, 1, 1, 1, 2],
+                       'CGMValue': [1, 2, 3, 1, np.nan, 3, 4, 2, 4, 1]})
+    actual, _ = pandas_helper.deduplicate(df, [('DataDtTm', 'max', 'CGMValue')])
+    #the first of the maximum values is kept
+    assert actual.index.tolist() == [2, 5, 6]
+    actual, _ = pandas_helper.deduplicate(df, [(['PtID', 'DataDtTm'], 'max', 'CGMValue')])
+    assert actual.index.tolist() == [0, 1, 2, 3, 5, 6]
+    actual, _ = pandas_helper.deduplicate(df, [(['PtID', 'DataDtTm'], 'min', 'CGMValue')])
+    assert actual.index.tolist() == [0, 2, 3, 5, 7, 9]
+    #missing values are only kept if all values of a group are missing
+    df = pd.DataFrame({'PtID': [1, 1, 2, 2], 'DataDtTm': [1, 1, 1, 1], 'value': [np.nan, np.nan, np.nan, 1.0]})
+    actual, _ = pandas_helper.deduplicate(df, [(['PtID', 'DataDtTm'], 'min', 'value')])
+    assert actual.index.tolist() == [0, 3]
+
+def test_deduplicate_policies_in_order():
+    df = pd.DataFrame({'PtID': ['a', 'a', 'a', 'b'], 'datetime': [1, 1, 1, 1], 'Rate': [1.0, 1.0, 2.0, 1.0], 'RecID': [3, 1, 2, 4]})
+    actual, dropped = pandas_helper.deduplicate(df, [pandas_helper.DuplicatePolicy(['PtID', 'datetime', 'Rate']),
+                                                     pandas_helper.DuplicatePolicy(['PtID', 'datetime'], 'max', 'RecID')])
+    assert actual.index.tolist() == [0, 3]
+    assert dropped.tolist() == [1, 1]
+    assert dropped.index.tolist() == ['first per PtID, datetime, Rate', 'max RecID per PtID, datetime']
+    assert pandas_helper.deduplicate(df.iloc[:0], [(['PtID'], 'last')])[1].tolist() == [0]
+    with pytest.raises(ValueError, match='requires a `by` column'):
+        pandas_helper.deduplicate(df, [(['PtID'], 'max')])
+    with pytest.raises(ValueError, match='Unknown policy'):
+        pandas_helper.deduplicate(df, [(['PtID'], 'largest', 'RecID')])
+
+def make_duplicates():
+    return pd.DataFrame({'PtID': [1, 1, 1, 2, 2, 3, np.nan, np.nan],
+                         'DataDtTm': [1, 1, 2, 1, 1, 1, 1, 1],
+                         'Rate': [1.0, 2.0, 0.0, np.nan, np.nan, 5.0, 1.0, 2.0],
+                         'Type': ['a', 'a', 'b', 'a', None, 'b', 'a', 'b'],
+                         'Time': pd.Timestamp('2020-01-01') + pd.to_timedelta([0, 10, 0, 0, 60, 0, 0, 0], unit='min')})
+
+def test_count_differences_in_duplicates():
+    actual = pandas_helper.count_differences_in_duplicates(make_duplicates(), ['PtID', 'DataDtTm'])
+    #groups with missing PtID are ignored, missing values count as a value
+    assert actual.to_dict() == {'PtID': 0, 'DataDtTm': 0, 'Rate': 1, 'Type': 1, 'Time': 2}
+    assert pandas_helper.count_differences_in_duplicates(make_duplicates(), ['Rate', 'Type']).tolist() == [1, 0, 0, 0, 0]
+
+def test_get_min_max_duplicates():
+    actual = pandas_helper.get_min_max_duplicates(make_duplicates(), ['PtID', 'DataDtTm'], 'Rate')
+    expected = pd.DataFrame({'min': [1.0, np.nan], 'max': [2.0, np.nan]},
+                            index=pd.MultiIndex.from_tuples([(1.0, 1), (2.0, 1)], names=['PtID', 'DataDtTm']))
+    pd.testing.assert_frame_equal(actual, expected)
+
+def test_grouped_value_counts():
+    actual = pandas_helper.grouped_value_counts(make_duplicates(), 'Type', ['Rate', 'DataDtTm'])
+    expected = pd.DataFrame({'Type': ['a', 'b'], 'NaN Count': [1, 0], 'Non-NaN Count': [7, 6], 'Zero Count': [0, 1]})
+    pd.testing.assert_frame_equal(actual, expected)
+
+def test_duplicate_report():
+    report = pandas_helper.duplicate_report(make_duplicates(), ['PtID', 'DataDtTm'])
+    assert report.index.tolist() == ['Rate', 'Type', 'Time']
+    assert report.groups.tolist() == [2, 2, 2]
+    assert report.differing_groups.tolist() == [1, 1, 2]
+    assert report.differing_rows.tolist() == [2, 2, 4]
+    assert report.missing.tolist() == [2, 1, 0]
+    assert report.zeros.tolist() == [0, 0, 0]
+    assert report.max_spread['Rate'] == 1.0 and np.isnan(report.max_spread['Type'])
+    assert report.max_spread['Time'] == pd.Timedelta('1h')
+    empty = pandas_helper.duplicate_report(make_duplicates().iloc[:3], ['PtID', 'DataDtTm'])
+    assert empty.groups.tolist() == [1, 1, 1] and empty.differing_groups.tolist() == [1, 0, 1]
@@ -0,0 +1,51 @@
+import pandas as pd
+import numpy as np
+from src.patient_index import PatientIndex
+
+def make_history():
+    return pd.DataFrame({'patient_id': ['2', '1', '2', '1', '3'],
+                         'datetime': pd.to_datetime(['2023-01-01 10:00', '2023-01-01 09:00', '2023-01-01 08:00', '2023-01-01 07:00', '2023-01-01 06:00']),
+                         'cgm': [100.0, 110.0, 120.0, 130.0, 140.0]})
+
+def test_patient_index_slices():
+    index = PatientIndex(make_history())
+    assert list(index.patients) == ['1', '2', '3']
+    assert index.offsets.tolist() == [0, 2, 4, 5]
+    assert index.get('1').cgm.tolist() == [130.0, 110.0]
+    assert index.get('2').cgm.tolist() == [120.0, 100.0]
+    assert index.get('2').index.tolist() == [2, 0]
+    assert index.get('4').empty
+    assert '3' in index and len(index) == 3
+
+def test_patient_index_iter_matches_groupby():
+    df = make_history()
+    index = PatientIndex(df)
+    expected = {patient_id: group.sort_values('datetime') for patient_id, group in df.groupby('patient_id')}
+    for patient_id, rows in index:
+        pd.testing.assert_frame_equal(rows, expected[patient_id])
+
+def test_patient_index_does_not_copy():
+    df = make_history().sort_values(['patient_id', 'datetime'])
+    index = PatientIndex(df)
+    assert index.data is df
+    assert np.shares_memory(index.get('2').cgm.to_numpy(), df.cgm.to_numpy())
+
+def test_patient_index_window():
+    index = PatientIndex(make_history())
+    assert index.window('1', '2023-01-01 07:00', '2023-01-01 09:00').cgm.tolist() == [130.0]
+    assert index.window('1', '2023-01-01 07:00:01').cgm.tolist() == [110.0]
+    assert index.window('1', end='2023-01-01 09:00:00.001').cgm.tolist() == [130.0, 110.0]
+    assert index.window('2', '2023-01-02').empty
+    assert index.window('2', '2023-01-01 10:00', '2023-01-01 08:00').empty
+    assert index.window('4', '2023-01-01').empty
+
+def test_patient_index_window_matches_mask():
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame({'patient_id': rng.choice(['a', 'b', 'c'], 500),
+                       'datetime': pd.Timestamp('2023-01-01') + pd.to_timedelta(rng.integers(0, 86400 * 5, 500), unit='s'),
+                       'cgm': rng.random(500)}).astype({'datetime': 'datetime64[s]'})
+    index = PatientIndex(df)
+    start, end = pd.Timestamp('2023-01-02 03:00:00.5'), pd.Timestamp('2023-01-03 12:00')
+    for patient_id in ['a', 'b', 'c']:
+        expected = df[(df.patient_id == patient_id) & (df.datetime >= start) & (df.datetime < end)].sort_values('datetime', kind='stable')
+        assert sorted(index.window(patient_id, start, end).index) == sorted(expected.index)
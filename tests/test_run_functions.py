@@ -0,0 +1,34 @@
+import threading
+import time
+import pytest
+from concurrent.futures import ThreadPoolExecutor
+from run_functions import schedule
+
+def test_schedule_never_runs_two_large_tasks():
+    lock = threading.Lock()
+    running = {'large': 0, 'all': 0, 'max_large': 0, 'max_all': 0}
+    def run(task):
+        with lock:
+            running['large'] += task.startswith('large')
+            running['all'] += 1
+            running['max_large'] = max(running['max_large'], running['large'])
+            running['max_all'] = max(running['max_all'], running['all'])
+        time.sleep(0.02)
+        with lock:
+            running['large'] -= task.startswith('large')
+            running['all'] -= 1
+        return task.upper()
+
+    tasks = ['small1', 'large1', 'small2', 'large2', 'small3', 'small4']
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        results = dict(schedule(tasks, executor, run, 3, lambda task: task.startswith('large'), poll_interval=0.01))
+    assert results == {task: task.upper() for task in tasks}
+    assert running['max_large'] == 1
+    assert running['max_all'] == 3
+
+def test_schedule_raises_task_errors():
+    def run(task):
+        raise ValueError(task)
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        with pytest.raises(ValueError, match='a'):
+            list(schedule(['a'], executor, run, 2, lambda task: False))
@@ -1,7 +1,12 @@
 import pytest
 import pandas as pd
+import threading
+import functools
+import time
 from datetime import datetime, timedelta
 from studies.studydataset import validate_bolus_output_dataframe, validate_basal_output_dataframe, validate_cgm_output_dataframe
+from studies.studydataset import run_load_tasks, set_validation_mode, is_string_series, StudyDataset, BackgroundWriter
+from studies import studydataset
 
 
 # Mock functions to be decorated
@@ -112,5 +117,335 @@ def test_validate_cgm_output_dataframe_additional_column():
     with pytest.raises(ValueError, match="DataFrame should have columns 'patient_id', 'datetime' and 'cgm' but has"):
         mock_extract_cgm_history(df)
 
+# Validation mode tests
+@pytest.fixture
+def validation_mode():
+    yield set_validation_mode
+    set_validation_mode('strict')
+
+def test_validate_accepts_string_and_categorical_patient_ids():
+    for dtype in ['string', 'category']:
+        df = pd.DataFrame({'patient_id': pd.Series(['1', '2'], dtype=dtype), 'datetime': [datetime.now()]*2, 'cgm': [100.0, 110.0]})
+        assert mock_extract_cgm_history(df).equals(df)
+
+def test_validate_rejects_mixed_patient_ids():
+    df = pd.DataFrame({'patient_id': ['1', 2], 'datetime': [datetime.now()]*2, 'basal_rate': [1.0, 1.0]})
+    with pytest.raises(ValueError, match="DataFrame should have a 'patient_id' column of type string"):
+        mock_extract_basal_event_history(df)
+    df['patient_id'] = pd.Categorical(['1', 2])
+    with pytest.raises(ValueError, match="DataFrame should have a 'patient_id' column of type string"):
+        mock_extract_basal_event_history(df)
+
+def test_is_string_series_sampled(validation_mode):
+    validation_mode('sampled')
+    assert is_string_series(pd.Series([str(i) for i in range(studydataset.VALIDATION_SAMPLE_SIZE * 3)]))
+    assert not is_string_series(pd.Series(range(studydataset.VALIDATION_SAMPLE_SIZE * 3)))
+    assert not is_string_series(pd.Series([1.5] * (studydataset.VALIDATION_SAMPLE_SIZE * 3), dtype=object))
+
+def test_validation_mode_off(validation_mode):
+    validation_mode('off')
+    df = pd.DataFrame({'patient_id': [1], 'datetime': ['2023-01-01'], 'cgm': ['100.0']})
+    assert mock_extract_cgm_history(df).equals(df)
+    with pytest.raises(ValueError, match="Validation mode must be one of"):
+        validation_mode('sometimes')
+
+def test_extract_validates_once_per_cached_result(monkeypatch):
+    class MockStudy(StudyDataset):
+        def _load_data(self, subset):
+            pass
+        def _extract_cgm_history(self):
+            return pd.DataFrame({'patient_id': ['1'], 'datetime': [datetime.now()], 'cgm': [100.0]})
+    calls = []
+    check = studydataset.check_cgm_output_dataframe
+    monkeypatch.setattr(studydataset, 'check_cgm_output_dataframe', lambda df: calls.append(1) or check(df))
+    study = MockStudy('path', 'mock')
+    first = study.extract_cgm_history()
+    assert study.extract_cgm_history() is first
+    assert len(calls) == 1
+
+# Compact dtype tests
+class MockHistoryStudy(StudyDataset):
+    def _load_data(self, subset):
+        pass
+    def _extract_bolus_event_history(self):
+        return pd.DataFrame({'patient_id': ['1', '1', '2'], 'datetime': pd.to_datetime(['2023-01-01 10:00:00.700', '2023-01-01 12:00:00.000', '2023-01-02 08:00:00.000']),
+                             'bolus': [1.0, 2.125, 0.1], 'delivery_duration': pd.to_timedelta([0, 3600, 0], unit='s')})
+    def _extract_basal_event_history(self):
+        return pd.DataFrame({'patient_id': ['1', '2'], 'datetime': pd.to_datetime(['2023-01-01 00:00', '2023-01-01 00:00']), 'basal_rate': [0.5, 1.25]})
+    def _extract_cgm_history(self):
+        return pd.DataFrame({'patient_id': ['1', '2'], 'datetime': pd.to_datetime(['2023-01-01 00:00', '2023-01-01 00:05']), 'cgm': [100.9, 40.0]})
+
+@pytest.mark.parametrize('compact, patient_dtype', [('category', 'category'), ('pyarrow', 'string')])
+def test_compact_dtypes(compact, patient_dtype):
+    if compact == 'pyarrow':
+        pytest.importorskip('pyarrow')
+    study = MockHistoryStudy('path', 'mock', compact=compact)
+    bolus = study.extract_bolus_event_history()
+    cgm = study.extract_cgm_history()
+    assert bolus.patient_id.dtype == patient_dtype
+    assert bolus.datetime.dtype == 'datetime64[s]'
+    assert bolus.delivery_duration.dtype == 'timedelta64[s]'
+    assert bolus.bolus.dtype == 'float32'
+    assert cgm.cgm.dtype == 'int16'
+    assert cgm.cgm.tolist() == [100, 40]
+    assert study.extract_basal_event_history().basal_rate.dtype == 'float32'
+    assert set(study.memory_usage().index) == {'bolus_event_history', 'basal_event_history', 'cgm_history'}
+
+def test_compact_dtypes_write_identical_files(tmp_path):
+    for compact in [None, 'category']:
+        study = MockHistoryStudy('path', f'mock_{compact}', compact=compact)
+        study.save_bolus_event_history_to_file(str(tmp_path))
+        study.save_basal_event_history_to_file(str(tmp_path))
+        study.save_cgm_to_file(str(tmp_path))
+    for stream in ['bolus_event_history', 'basal_event_history', 'cgm_history']:
+        assert (tmp_path / f'mock_None_{stream}.csv').read_text() == (tmp_path / f'mock_category_{stream}.csv').read_text()
+
+def test_compact_invalid_option():
+    with pytest.raises(ValueError, match="compact must be None or one of"):
+        MockHistoryStudy('path', 'mock', compact='int8')
+
+# Lifecycle tests
+class MockRawStudy(MockHistoryStudy):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.loads = 0
+    def _load_data(self, subset):
+        self.loads += 1
+        self.df_raw = pd.DataFrame({'x': range(10)})
+
+def test_release():
+    study = MockRawStudy('path', 'mock')
+    cgm = study.extract_cgm_history()
+    study.release()
+    assert study.df_raw is None and not study.data_loaded
+    assert study.extract_cgm_history() is cgm
+    study.extract_bolus_event_history()
+    assert study.loads == 2 and study.df_raw is not None
+    study.release(histories=True)
+    assert study.df_raw is None and study.cgm_history is None and study.bolus_event_history is None
+
+def test_auto_release():
+    study = MockRawStudy('path', 'mock', auto_release=True)
+    study.extract_bolus_event_history()
+    study.extract_basal_event_history()
+    assert study.df_raw is not None
+    study.extract_cgm_history()
+    assert study.df_raw is None and study.loads == 1
+    assert all(getattr(study, name) is not None for name in StudyDataset.HISTORIES)
+
+def test_save_does_not_modify_history(tmp_path):
+    study = MockHistoryStudy('path', 'mock')
+    bolus = study.extract_bolus_event_history()
+    expected = bolus.copy()
+    study.save_bolus_event_history_to_file(str(tmp_path))
+    assert study.extract_bolus_event_history().equals(expected)
+    assert (tmp_path / 'mock_bolus_event_history.csv').read_text().splitlines()[2] == '1,1672574400,2.125,3600'
+
+@pytest.mark.parametrize('output_format', ['parquet', 'feather'])
+def test_save_output_formats_match_csv(tmp_path, output_format):
+    pytest.importorskip('pyarrow')
+    study = MockHistoryStudy('path', 'mock')
+    for save in [study.save_bolus_event_history_to_file, study.save_basal_event_history_to_file, study.save_cgm_to_file]:
+        csv_file = save(str(tmp_path))
+        file_path = save(str(tmp_path), output_format=output_format)
+        assert file_path.endswith(f'.{output_format}')
+        expected = pd.read_csv(csv_file, dtype={'patient_id': str})
+        actual = getattr(pd, f'read_{output_format}')(file_path)
+        pd.testing.assert_frame_equal(actual, expected, check_dtype=False)
+
+def test_save_parquet_row_groups_by_patient(tmp_path):
+    pq = pytest.importorskip('pyarrow.parquet')
+    df = pd.DataFrame({'patient_id': ['2', '1', '3', '1', '2', '3'], 'datetime': [6, 1, 3, 2, 7, 4], 'cgm': [60, 10, 30, 20, 70, 40]})
+    studydataset.save_to_parquet(df, str(tmp_path / 'cgm.parquet'), row_group_size=3)
+    file = pq.ParquetFile(tmp_path / 'cgm.parquet')
+    groups = [file.read_row_group(i).to_pandas() for i in range(file.num_row_groups)]
+    assert [group.patient_id.tolist() for group in groups] == [['1', '1'], ['2', '2'], ['3', '3']]
+    assert pd.read_parquet(tmp_path / 'cgm.parquet').datetime.tolist() == [1, 2, 6, 7, 3, 4]
+
+@pytest.mark.parametrize('output_format, compression', [('csv.gz', {'level': 1}), ('csv.gz', {'level': 6, 'threads': 3}), 
+                                                         ('csv.zst', None), ('csv.zst', {'level': 10, 'threads': 2})])
+def test_save_csv_compression(tmp_path, output_format, compression):
+    if output_format == 'csv.zst':
+        pytest.importorskip('zstandard')
+    study = MockHistoryStudy('path', 'mock')
+    expected = study.save_bolus_event_history_to_file(str(tmp_path))
+    file_path = study.save_bolus_event_history_to_file(str(tmp_path), output_format=output_format, compression=compression)
+    assert file_path.endswith(output_format)
+    with open(expected) as f:
+        assert pd.read_csv(file_path).to_csv(index=False) == f.read()
+
+def test_save_to_block_gzip(tmp_path):
+    import gzip
+    df = pd.DataFrame({'patient_id': ['1', '2', '3', '4', '5'], 'cgm': [1, 2, 3, 4, 5]})
+    studydataset.save_to_block_gzip(df, str(tmp_path / 'blocks.csv.gz'), level=1, threads=2, block_rows=2)
+    with gzip.open(tmp_path / 'blocks.csv.gz', 'rt') as f:
+        assert f.read() == df.to_csv(index=False)
+    studydataset.save_to_block_gzip(df.iloc[:0], str(tmp_path / 'empty.csv.gz'))
+    with gzip.open(tmp_path / 'empty.csv.gz', 'rt') as f:
+        assert f.read() == 'patient_id,cgm\n'
+
+def test_save_indexed_output(tmp_path):
+    from src.indexed_csv import read_patient
+    study = MockHistoryStudy('path', 'mock')
+    file_path = study.save_cgm_to_file(str(tmp_path), output_format='csv.gz', compression={'index': True})
+    assert read_patient(file_path, '2').cgm.tolist() == [40]
+    #rewriting without index removes the stale index
+    study.save_cgm_to_file(str(tmp_path), True)
+    assert not (tmp_path / 'mock_cgm_history.csv.gz.index.csv').exists()
+    with pytest.raises(ValueError, match="Indexed outputs require the csv.gz format"):
+        study.save_cgm_to_file(str(tmp_path), output_format='csv', compression={'index': True})
+
+@pytest.mark.parametrize('output_format', ['csv', 'csv.gz'])
+def test_save_chunked_writes_identical_files(tmp_path, monkeypatch, output_format):
+    study = MockHistoryStudy('path', 'mock')
+    bolus = study.extract_bolus_event_history()
+    expected = tmp_path / f'expected.{output_format}'
+    study._bolus_output(bolus).to_csv(expected, index=False, compression='gzip' if output_format == 'csv.gz' else None)
+    monkeypatch.setattr(studydataset, 'CSV_CHUNK_ROWS', 2)
+    file_path = study.save_bolus_event_history_to_file(str(tmp_path), output_format=output_format)
+    with open(expected, 'rb') as f, open(file_path, 'rb') as g:
+        expected_bytes, actual_bytes = f.read(), g.read()
+    if output_format == 'csv.gz':
+        #the gzip header contains the modification time and the file name
+        expected_bytes, actual_bytes = expected_bytes[10:], actual_bytes[10 + len(b'mock_bolus_event_history.csv') + 1:]
+        expected_bytes = expected_bytes[len(b'expected.csv') + 1:]
+    assert actual_bytes == expected_bytes
+
+def test_save_invalid_compression(tmp_path):
+    with pytest.raises(ValueError, match="Unknown compression options"):
+        MockHistoryStudy('path', 'mock').save_cgm_to_file(str(tmp_path), output_format='csv.gz', compression={'speed': 1})
+
+def test_save_invalid_output_format(tmp_path):
+    with pytest.raises(ValueError, match="output_format must be one of"):
+        MockHistoryStudy('path', 'mock').save_cgm_to_file(str(tmp_path), output_format='xlsx')
+
+# Stream selective loading tests
+class MockStreamStudy(MockHistoryStudy):
+    STREAM_TABLES = {'bolus_event_history': 'pump', 'basal_event_history': 'pump', 'cgm_history': 'cgm'}
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.df_pump = None
+        self.df_cgm = None
+        self.reads = []
+    def _read(self, name, patients_only=False):
+        self.reads.append(f'{name}_patients' if patients_only else name)
+        df = pd.DataFrame({'PtID': {'pump': ['1', '2'], 'cgm': ['2', '3']}[name], 'value': [1, 2]})
+        return df.PtID if patients_only else df
+    def _load_streams(self, streams, subset):
+        names = self._missing_tables(streams)
+        readers = {name: functools.partial(self._read, name) for name in ['pump', 'cgm']}
+        patient_readers = {name: functools.partial(self._read, name, True) for name in ['pump', 'cgm']}
+        for name, df in self._load_patient_tables(names, readers, patient_readers).items():
+            setattr(self, f'df_{name}', df)
+        return streams
+
+def test_load_streams_only_loads_required_tables():
+    study = MockStreamStudy('path', 'mock', max_load_workers=1)
+    study.extract_cgm_history()
+    assert study.df_pump is None and study.loaded_streams == {'cgm_history'} and not study.data_loaded
+    assert study.df_cgm.PtID.tolist() == ['2']
+    study.extract_bolus_event_history()
+    study.extract_basal_event_history()
+    assert study.df_pump.PtID.tolist() == ['2'] and study.data_loaded
+    # the pump table was read once for its patient ids and once when needed, the cgm table only once
+    assert study.reads.count('pump_patients') == 1 and study.reads.count('cgm') == 1
+
+def test_load_data_unknown_stream():
+    with pytest.raises(ValueError, match="Unknown streams"):
+        MockStreamStudy('path', 'mock').load_data(streams=['insulin'])
+
+# Per patient iteration tests
+def test_iter_patients():
+    study = MockHistoryStudy('path', 'mock')
+    patients = dict(study.iter_patients())
+    assert list(patients) == ['1', '2']
+    assert patients['1']['bolus_event_history'].bolus.tolist() == [1.0, 2.125]
+    assert patients['2']['cgm_history'].cgm.tolist() == [40.0]
+    assert study.patient_index('cgm_history') is study.patient_index('cgm_history')
+
+def test_iter_patients_streams():
+    study = MockHistoryStudy('path', 'mock')
+    patients = dict(study.iter_patients(['cgm_history']))
+    assert list(patients['1']) == ['cgm_history']
+    assert study.bolus_event_history is None
+    with pytest.raises(ValueError, match="Unknown streams"):
+        next(study.iter_patients(['insulin']))
+    study.release(histories=True)
+    assert study.patient_indexes == {}
+
+def test_get_window():
+    study = MockHistoryStudy('path', 'mock')
+    window = study.get_window('1', '2023-01-01 11:00', '2023-01-02')
+    assert window['bolus_event_history'].bolus.tolist() == [2.125]
+    assert window['basal_event_history'].empty and window['cgm_history'].empty
+    assert list(study.get_window('2', streams=['cgm_history'])) == ['cgm_history']
+
+# Load scheduler tests
+def test_run_load_tasks_dependencies():
+    tasks = {'bolus': lambda: pd.DataFrame({'PtID': [1, 2], 'upload': [10, 20]}),
+             'uploads': lambda: pd.DataFrame({'upload': [10, 20], 'source': ['a', 'b']}),
+             'merged': (lambda bolus, uploads: bolus.merge(uploads, on='upload'), ['bolus', 'uploads']),
+             'count': (lambda merged: len(merged), ['merged'])}
+    for max_workers in [1, 2, None]:
+        results = run_load_tasks(tasks, max_workers=max_workers)
+        assert results['merged'].source.tolist() == ['a', 'b']
+        assert results['count'] == 2
+
+def test_run_load_tasks_respects_max_workers():
+    lock = threading.Lock()
+    state = {'running': 0, 'max_running': 0}
+    def read():
+        with lock:
+            state['running'] += 1
+            state['max_running'] = max(state['max_running'], state['running'])
+        time.sleep(0.05)
+        with lock:
+            state['running'] -= 1
+    run_load_tasks({f'table_{i}': read for i in range(6)}, max_workers=2)
+    assert state['max_running'] == 2
+
+def test_run_load_tasks_propagates_errors():
+    def fail():
+        raise FileNotFoundError('missing table')
+    with pytest.raises(FileNotFoundError, match='missing table'):
+        run_load_tasks({'ok': lambda: 1, 'fail': fail}, max_workers=2)
+
+def test_run_load_tasks_unknown_dependency():
+    with pytest.raises(ValueError, match="depends on unknown tasks"):
+        run_load_tasks({'merged': (lambda x: x, ['missing'])})
+
+def test_background_writer_writes_identical_files(tmp_path):
+    study = MockHistoryStudy('path', 'sync')
+    study.save_bolus_event_history_to_file(str(tmp_path), True)
+    study.save_cgm_to_file(str(tmp_path), True)
+    study = MockHistoryStudy('path', 'background')
+    with BackgroundWriter() as writer:
+        study.save_bolus_event_history_to_file(str(tmp_path), True, writer=writer)
+        study.save_cgm_to_file(str(tmp_path), True, writer=writer)
+    for stream in ['bolus_event_history', 'cgm_history']:
+        assert pd.read_csv(tmp_path / f'sync_{stream}.csv.gz').equals(pd.read_csv(tmp_path / f'background_{stream}.csv.gz'))
+
+def test_background_writer_bounded_queue():
+    release = threading.Event()
+    done = []
+    with BackgroundWriter(max_pending=1) as writer:
+        writer.submit(release.wait)
+        writer.submit(done.append, 1)
+        blocked = threading.Thread(target=writer.submit, args=(done.append, 2))
+        blocked.start()
+        blocked.join(0.1)
+        # the queue is full (one job running, one pending), the third submit waits
+        assert blocked.is_alive()
+        release.set()
+        blocked.join()
+    assert done == [1, 2]
+
+def test_background_writer_raises_errors():
+    def fail():
+        raise IOError('disk full')
+    with pytest.raises(IOError, match='disk full'):
+        with BackgroundWriter() as writer:
+            writer.submit(fail)
+
 if __name__ == "__main__":
-    pytest.main()
\ No newline at end of file
+    pytest.main()
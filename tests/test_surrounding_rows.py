@@ -0,0 +1,39 @@
+import pandas as pd
+import numpy as np
+import pytest
+from src.surrounding_rows import SurroundingRows
+from src import pandas_helper
+
+def make_table():
+    return pd.DataFrame({'PtID': [2, 1, 2, 1, 1, 2, 1],
+                         'DataDtTm': [3, 2, 1, 1, 3, 2, 4],
+                         'value': [10, 20, 30, 40, 50, 60, 70]}, index=[10, 11, 12, 13, 14, 15, 16])
+
+def test_get_matches_sorting_per_call():
+    df = make_table()
+    rows = SurroundingRows(df, ['PtID', 'DataDtTm'])
+    assert rows.data.index.tolist() == [13, 11, 14, 16, 12, 15, 10]
+    for index in df.index:
+        for n in [0, 1, 3, 10]:
+            expected = df.sort_values(['PtID', 'DataDtTm'])
+            position = expected.index.get_loc(index)
+            pd.testing.assert_frame_equal(rows.get(index, n), expected.iloc[max(position - n, 0):position + n + 1])
+            pd.testing.assert_frame_equal(pandas_helper.extract_surrounding_rows(df, index, n, ['PtID', 'DataDtTm']), rows.get(index, n))
+
+def test_get_many():
+    df = make_table()
+    rows = SurroundingRows(df, ['PtID', 'DataDtTm'])
+    indexes = [13, 10, 16]
+    expected = pd.concat({index: rows.get(index, 1) for index in indexes}, names=['center'])
+    pd.testing.assert_frame_equal(rows.get_many(indexes, 1), expected)
+    assert rows.get_many(np.array([16, 14]), 0).index.tolist() == [(16, 16), (14, 14)]
+    assert rows.get_many([], 2).empty
+
+def test_missing_and_duplicated_indexes():
+    rows = SurroundingRows(make_table(), 'DataDtTm')
+    with pytest.raises(ValueError, match=r'\[99\] are not in the DataFrame'):
+        rows.get_many([10, 99], 1)
+    with pytest.raises(ValueError, match='The provided index is not in the DataFrame'):
+        pandas_helper.extract_surrounding_rows(make_table(), 99, 1, 'DataDtTm')
+    with pytest.raises(ValueError, match='must be unique'):
+        SurroundingRows(make_table().reset_index(drop=True).rename(index={1: 0}), 'DataDtTm')
@@ -0,0 +1,91 @@
+import os
+import filecmp
+import numpy as np
+import pandas as pd
+import pytest
+
+import studies
+from src.synthetic import generate, flair_dates, iso_dates, STUDY_FOLDERS
+from src.xport import write_xport
+
+@pytest.fixture(scope='module')
+def raw_path(tmp_path_factory):
+    #loop converts its tables to data/temp next to the raw folder
+    raw_path = tmp_path_factory.mktemp('synthetic') / 'data' / 'raw'
+    generate(str(raw_path), patients=3, days=2, seed=1)
+    return str(raw_path)
+
+def test_write_xport_roundtrip(tmp_path):
+    df = pd.DataFrame({'USUBJID': ['1', '22', None], 'FADTC': [1.9e9 + 0.5, np.nan, -3.25], 'FAORRES': [0.1, 1e-30, 123456.789],
+                       'FADUR': ['PT1H', '', 'PT30M']})
+    write_xport(df, str(tmp_path / 'FACM.xpt'), 'FACM')
+    read = pd.read_sas(str(tmp_path / 'FACM.xpt'), encoding='latin-1')
+    assert list(read.columns) == list(df.columns)
+    assert read.USUBJID.tolist() == ['1', '22', '']
+    assert read.FADUR.tolist() == ['PT1H', '', 'PT30M']
+    np.testing.assert_array_equal(read.FADTC.values, df.FADTC.values)
+    np.testing.assert_array_equal(read.FAORRES.values, df.FAORRES.values)
+
+def test_date_formats():
+    times = pd.DatetimeIndex(['2020-01-01 00:00:00', '2020-01-01 00:05:03', '2020-12-31 12:00:00', '2021-02-03 13:07:01'])
+    assert list(iso_dates(times)) == list(times.strftime('%Y-%m-%d %H:%M:%S'))
+    assert list(flair_dates(times)) == ['01/01/2020'] + list(times[1:].strftime('%m/%d/%Y %I:%M:%S %p'))
+
+@pytest.mark.parametrize('study', list(STUDY_FOLDERS))
+def test_studies_extract_synthetic_data(raw_path, study):
+    dataset = getattr(studies, study)(study_path=os.path.join(raw_path, STUDY_FOLDERS[study]))
+    cgm = dataset.extract_cgm_history()
+    bolus = dataset.extract_bolus_event_history()
+    basal = dataset.extract_basal_event_history()
+    assert cgm.patient_id.nunique() == 3
+    assert len(bolus) > 0
+    #the iLet reports basal deliveries as boluses
+    assert len(basal) > 0 or study == 'IOBP2'
+
+@pytest.mark.parametrize('study, read', [('T1DEXI', 'read_sas'), ('ReplaceBG', 'read_csv')])
+def test_raw_tables_are_read_once(raw_path, study, read, monkeypatch):
+    #tables are only read in full once, tables of other streams are read for their ids with only the id columns (csv) or 
+    #in chunks (xpt)
+    reads = []
+    original = getattr(pd, read)
+    def counted(path, *args, **kwargs):
+        if (kwargs.get('usecols') is None and kwargs.get('chunksize') is None) or os.path.basename(path) == 'HDeviceUploads.txt':
+            reads.append(os.path.basename(path))
+        return original(path, *args, **kwargs)
+    monkeypatch.setattr(pd, read, counted)
+    dataset = getattr(studies, study)(study_path=os.path.join(raw_path, STUDY_FOLDERS[study]))
+    for extract in [dataset.extract_bolus_event_history, dataset.extract_basal_event_history, dataset.extract_cgm_history]:
+        extract()
+    assert sorted(reads) == {'T1DEXI': ['DX.xpt', 'FACM.xpt', 'LB.xpt'],
+                             'ReplaceBG': ['HDeviceBasal.txt', 'HDeviceBolus.txt', 'HDeviceCGM.txt', 'HDeviceUploads.txt']}[study]
+
+def test_t1dexi_cgm_only_keeps_no_facm(raw_path):
+    dataset = studies.T1DEXI(study_path=os.path.join(raw_path, STUDY_FOLDERS['T1DEXI']))
+    full = studies.T1DEXI(study_path=os.path.join(raw_path, STUDY_FOLDERS['T1DEXI']))
+    full.load_data()
+    pd.testing.assert_frame_equal(dataset.extract_cgm_history(), full.extract_cgm_history())
+    #the FACM table is only read for its patient ids
+    assert dataset.facm is None
+    assert {name for name, value in vars(dataset).items() if isinstance(value, pd.DataFrame)} == {'dx', 'lb', 'cgm_history'}
+    #and read when the bolus stream is requested later
+    pd.testing.assert_frame_equal(dataset.extract_bolus_event_history(), full.extract_bolus_event_history())
+
+def test_raw_data_has_special_cases(raw_path):
+    pump = pd.read_csv(os.path.join(raw_path, STUDY_FOLDERS['Flair'], 'Data Tables', 'FLAIRDevicePump.txt'), sep='|')
+    assert pump.TempBasalType.notna().any()
+    assert (pump.Suspend == 'NORMAL_PUMPING').any() and pump.ExtendBolusDuration.notna().any()
+    assert pump.duplicated(['PtID', 'DataDtTm', 'BasalRt', 'BolusDeliv', 'TDD']).any()
+    bolus = pd.read_csv(os.path.join(raw_path, STUDY_FOLDERS['DCLP3'], 'Data Files', 'Pump_BolusDelivered.txt'), sep='|')
+    assert set(bolus.BolusType) == {'Standard', 'Extended'}
+    assert len(os.listdir(os.path.join(raw_path, STUDY_FOLDERS['Loop'], 'Data Tables'))) == 8
+
+def test_generate_is_reproducible(tmp_path):
+    generate(str(tmp_path / 'a'), ['DCLP3', 'T1DEXI'], patients=2, days=1, seed=3)
+    generate(str(tmp_path / 'b'), ['T1DEXI'], patients=2, days=1, seed=3)
+    assert filecmp.cmp(tmp_path / 'a' / 'T1DEXI' / 'FACM.xpt', tmp_path / 'b' / 'T1DEXI' / 'FACM.xpt', shallow=False)
+    generate(str(tmp_path / 'c'), ['T1DEXI'], patients=2, days=1, seed=4)
+    assert not filecmp.cmp(tmp_path / 'a' / 'T1DEXI' / 'FACM.xpt', tmp_path / 'c' / 'T1DEXI' / 'FACM.xpt', shallow=False)
+
+def test_generate_unknown_study(tmp_path):
+    with pytest.raises(ValueError, match='Unknown study'):
+        generate(str(tmp_path), ['DCLP4'])
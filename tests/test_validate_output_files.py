@@ -0,0 +1,82 @@
+import json
+import os
+import pandas as pd
+import pytest
+
+import validate_output_files as validator
+from studies.studydataset import save_output, OUTPUT_FORMATS
+
+def make_histories():
+    return {'cgm_history': pd.DataFrame({'patient_id': ['1', '1', '1', '2', '2'],
+                                         'datetime': [1600000000, 1600000300, 1600000600, 1600000000, 1600000300],
+                                         'cgm': [100, 110, 120, 40, 400]}),
+            'bolus_event_history': pd.DataFrame({'patient_id': ['1', '2', '2'],
+                                                 'datetime': [1600000000, 1600000000, 1600003600],
+                                                 'bolus': [1.5, 0.0, 2.25],
+                                                 'delivery_duration': [0, 3600, 0]}),
+            'basal_event_history': pd.DataFrame({'patient_id': ['1', '1', '2'],
+                                                 'datetime': [1600000000, 1600001800, 1600000000],
+                                                 'basal_rate': [0.8, 0.0, 1.25]})}
+
+def write_outputs(folder, study='DCLP3', output_format='csv', histories=None, compression=None):
+    os.makedirs(folder, exist_ok=True)
+    for stream, df in (histories or make_histories()).items():
+        save_output(df, os.path.join(folder, f'{study}_{stream}'), output_format, compression)
+
+def issues(result):
+    return {(issue.level, issue.check, issue.column) for issue in result['issues']}
+
+@pytest.mark.parametrize('output_format', OUTPUT_FORMATS)
+def test_valid_outputs(tmp_path, output_format):
+    write_outputs(str(tmp_path / 'DCLP3'), output_format=output_format)
+    results = validator.validate_outputs(str(tmp_path), workers=1)
+    for result in results:
+        assert result['issues'] == [], result['issues']
+        assert result['format'] == output_format and result['study'] == 'DCLP3'
+    assert {result['stream']: (result['rows'], result['patients']) for result in results} == \
+        {'cgm_history': (5, 2), 'bolus_event_history': (3, 2), 'basal_event_history': (3, 2)}
+
+def test_other_files_are_ignored(tmp_path):
+    write_outputs(str(tmp_path / 'DCLP3'), output_format='csv.gz', compression={'index': True})
+    (tmp_path / 'DCLP3' / 'manifest.json').write_text(json.dumps({}))
+    (tmp_path / 'logs').mkdir()
+    (tmp_path / 'logs' / 'DCLP3_cgm_history.csv').write_text('not a history')
+    files = validator.find_output_files(str(tmp_path))
+    assert [os.path.basename(f) for f in files] == ['DCLP3_basal_event_history.csv.gz', 'DCLP3_bolus_event_history.csv.gz', 'DCLP3_cgm_history.csv.gz']
+
+def test_order_and_duplicates_across_chunks(tmp_path):
+    cgm = pd.DataFrame({'patient_id': ['1', '2', '1', '2', '1', '1'],
+                        'datetime': [1600000600, 1600000000, 1600000300, 1600000000, 1600000900, 1600000900],
+                        'cgm': [100, 110, 120, 130, 140, 150]})
+    write_outputs(str(tmp_path / 'IOBP2'), 'IOBP2', histories={'cgm_history': cgm})
+    #one row per chunk, every comparison crosses a chunk boundary
+    for chunk_rows in [1, 2, 100]:
+        result, = validator.validate_outputs(str(tmp_path), workers=1, chunk_rows=chunk_rows)
+        assert issues(result) == {('warning', 'order', 'datetime'), ('warning', 'duplicates', 'datetime')}
+        counts = {issue.check: issue.count for issue in result['issues']}
+        assert counts == {'order': 1, 'duplicates': 2}
+        message = next(issue.message for issue in result['issues'] if issue.check == 'order')
+        assert 'first at patient 1, datetime 1600000300' in message
+
+def test_errors(tmp_path):
+    histories = make_histories()
+    histories['cgm_history'].loc[2, 'cgm'] = None
+    histories['bolus_event_history'] = histories['bolus_event_history'].rename(columns={'delivery_duration': 'duration'})
+    histories['basal_event_history'] = histories['basal_event_history'].iloc[:0]
+    write_outputs(str(tmp_path / 'DCLP3'), histories=histories)
+    (tmp_path / 'DCLP3' / 'Flair_cgm_history.parquet').write_bytes(b'not parquet')
+    results = {os.path.basename(result['file']): result for result in validator.validate_outputs(str(tmp_path), workers=2)}
+    assert issues(results['DCLP3_cgm_history.csv']) == {('error', 'missing', 'cgm'), ('error', 'type', 'cgm')}
+    assert issues(results['DCLP3_bolus_event_history.csv']) == {('error', 'columns', None)}
+    assert issues(results['DCLP3_basal_event_history.csv']) == {('error', 'empty', None)}
+    assert issues(results['Flair_cgm_history.parquet']) == {('error', 'read', None)}
+
+def test_implausible_values(tmp_path):
+    histories = make_histories()
+    histories['basal_event_history'].loc[1, 'basal_rate'] = 50.0
+    histories['cgm_history'].loc[0, 'cgm'] = 5
+    write_outputs(str(tmp_path / 'DCLP3'), output_format='parquet', histories=histories)
+    results = {result['stream']: result for result in validator.validate_outputs(str(tmp_path), workers=1)}
+    assert issues(results['basal_event_history']) == {('warning', 'range', 'basal_rate')}
+    assert issues(results['cgm_history']) == {('warning', 'range', 'cgm')}
+    assert issues(results['bolus_event_history']) == set()
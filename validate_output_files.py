@@ -1,63 +1,238 @@
+"""
+validate_output_files.py
+
+Validates the history files written by `run_functions.py` (`data/out/<study folder>/<study>_<history>.<format>`, any of the
+output formats csv, csv.gz, csv.zst, parquet and feather).
+
+Execution:
+    python validate_output_files.py [--out data/out] [--workers 4] [--strict] [--report issues.csv]
+
+Only the header of a file is read to check its columns, the rows are streamed in chunks (`--chunk-rows`) and files are
+validated in parallel worker processes. For each file, the following is checked:
+
+- Errors: missing or unexpected columns, empty files, column types (integer timestamps and durations, numeric values)
+  and missing values.
+- Warnings: timestamps that are not sorted within a patient, duplicated timestamps of a patient (consecutive rows of a
+  patient with the same timestamp) and values outside of plausible ranges (see `RANGES`).
+
+Other files (manifest.json, patient indexes `*.index.csv`, logs, reports and profiles) are ignored. The exit code is 1 if
+any file has errors (or warnings with `--strict`).
+"""
 import os
+import re
+import time
+import argparse
+from collections import namedtuple, Counter
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 import pandas as pd
-from src.logger import LoggerFactory
-
-logger = LoggerFactory.get_logger(__name__)
-
-# Define expected columns for each type of CSV
-EXPECTED_COLUMNS = {
-    'bolus_history.csv': ['patient_id', 'datetime', 'bolus', 'delivery_duration'],
-    'bolus_history-transformed.csv': ['patient_id', 'datetime', 'bolus'],
-    'basal_history.csv': ['patient_id', 'datetime', 'basal_rate'],
-    'basal_history-transformed.csv': ['patient_id', 'datetime', 'basal_delivery'],
-    'cgm_history.csv': ['patient_id', 'datetime', 'cgm'],
-    'cgm_history-transformed.csv': ['patient_id', 'datetime', 'cgm']
-}
-
-def validate_csv(file_path, expected_columns):
-    """Validate a CSV file by checking if it exists, if the column names are correct, and if the DataFrame is not empty."""
-    if not os.path.exists(file_path):
-        logger.error(f"[!] ERROR: File not found: {os.path.basename(file_path)}")
-        return False
-
-    df = pd.read_csv(file_path)
-    if df.empty:
-        logger.error(f"[!] ERROR: DataFrame is empty: {os.path.basename(file_path)}")
-        return False
-
-    if set(df.columns) != set(expected_columns):
-        logger.error(f"[!] ERROR: incorrect columns in {os.path.basename(file_path)}. Expected: {expected_columns}, Found: {df.columns}")
-        return False
-
-    logger.info(f"[x] PASSED {os.path.basename(file_path)}")
-    return True
-
-def validate_output(output_path):
-    """Validate all output CSV files in the given output path."""
-    for file_name, expected_columns in EXPECTED_COLUMNS.items():
-        file_path = os.path.join(output_path, file_name)
-        validate_csv(file_path, expected_columns)
+
+from src.logger import Logger
+
+logger = Logger.get_logger(__name__)
+
+#the columns of each history file and their types (see the save methods of `StudyDataset`)
+COLUMNS = {'cgm_history': {'patient_id': 'string', 'datetime': 'integer', 'cgm': 'integer'},
+           'bolus_event_history': {'patient_id': 'string', 'datetime': 'integer', 'bolus': 'number', 'delivery_duration': 'integer'},
+           'basal_event_history': {'patient_id': 'string', 'datetime': 'integer', 'basal_rate': 'number'}}
+
+#plausible value ranges (inclusive), values outside are reported as warnings
+RANGES = {'datetime': (pd.Timestamp('1990-01-01').timestamp(), pd.Timestamp('2040-01-01').timestamp()),
+          'cgm': (20, 600),
+          'bolus': (0, 50),
+          'delivery_duration': (0, 24 * 3600),
+          'basal_rate': (0, 35)}
+
+FILE_PATTERN = re.compile(r'^(?P<study>.+)_(?P<stream>cgm_history|bolus_event_history|basal_event_history)\.(?P<format>csv|csv\.gz|csv\.zst|parquet|feather)$')
+#folders next to the study outputs that never contain histories
+IGNORED_FOLDERS = {'logs', 'reports', 'profiles', 'temp'}
+CHUNK_ROWS = 1_000_000
+
+Issue = namedtuple('Issue', ['file', 'level', 'check', 'column', 'count', 'message'])
+
+def find_output_files(out_path):
+    """Returns the history files below `out_path` (sorted), other files are ignored."""
+    files = []
+    for root, dirs, names in os.walk(out_path):
+        dirs[:] = sorted(d for d in dirs if d not in IGNORED_FOLDERS)
+        files += [os.path.join(root, name) for name in sorted(names) if FILE_PATTERN.match(name)]
+    return files
+
+def read_columns(file_path, output_format):
+    """Returns the column names of a history file without reading its rows."""
+    if output_format == 'parquet':
+        import pyarrow.parquet as pq
+        return pq.read_schema(file_path).names
+    if output_format == 'feather':
+        import pyarrow as pa
+        return pa.ipc.open_file(pa.memory_map(file_path)).schema.names
+    return list(pd.read_csv(file_path, nrows=0).columns)
+
+def read_chunks(file_path, output_format, chunk_rows=CHUNK_ROWS):
+    """Yields the rows of a history file as dataframes of at most (csv, parquet) `chunk_rows` rows."""
+    if output_format == 'parquet':
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(file_path).iter_batches(batch_size=chunk_rows):
+            yield batch.to_pandas()
+    elif output_format == 'feather':
+        import pyarrow as pa
+        reader = pa.ipc.open_file(pa.memory_map(file_path))
+        for i in range(reader.num_record_batches):
+            yield reader.get_batch(i).to_pandas()
+    else:
+        #the compression (gzip, zstd) is inferred from the file extension
+        with pd.read_csv(file_path, dtype={'patient_id': str}, chunksize=chunk_rows) as reader:
+            yield from reader
+
+def _has_type(series, expected):
+    if expected == 'integer':
+        return pd.api.types.is_integer_dtype(series.dtype)
+    if expected == 'number':
+        return pd.api.types.is_numeric_dtype(series.dtype) and not pd.api.types.is_bool_dtype(series.dtype)
+    return not pd.api.types.is_numeric_dtype(series.dtype)
+
+class HistoryCheck:
+    """Checks the chunks of a history file, keeping only the last timestamp of each patient between chunks."""
+    def __init__(self, stream):
+        self.columns = COLUMNS[stream]
+        self.rows = 0
+        self.last_datetimes = {}
+        self.counts = Counter()
+        self.examples = {}
+        self.types = {}
+
+    def _count(self, check, column, count, example=None):
+        if count:
+            self.counts[(check, column)] += int(count)
+            if example is not None:
+                self.examples.setdefault((check, column), example)
+
+    def add(self, chunk):
+        """Checks a chunk of rows (in file order)."""
+        self.rows += len(chunk)
+        #the types of an empty csv can not be inferred
+        if chunk.empty:
+            return
+        for column, expected in self.columns.items():
+            values = chunk[column]
+            missing = values.isna().to_numpy()
+            self._count('missing', column, missing.sum(), self._example(chunk, np.argmax(missing)) if missing.any() else None)
+            if not _has_type(values, expected):
+                self.types.setdefault(column, str(values.dtype))
+            elif column in RANGES:
+                low, high = RANGES[column]
+                outside = ((values < low) | (values > high)).to_numpy()
+                self._count('range', column, outside.sum(), self._example(chunk, np.argmax(outside)) if outside.any() else None)
+        if 'datetime' not in self.types and not chunk.patient_id.isna().any():
+            self._check_order(chunk.patient_id.to_numpy(), chunk.datetime.to_numpy())
+
+    def _example(self, chunk, row):
+        return (chunk.patient_id.iloc[row], chunk.datetime.iloc[row])
+
+    def _check_order(self, patient_ids, datetimes):
+        #group the rows by patient (keeping the file order within a patient) and compare consecutive timestamps
+        codes, patients = pd.factorize(patient_ids)
+        order = np.argsort(codes, kind='stable')
+        codes, datetimes = codes[order], datetimes[order]
+        starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]])
+        ends = np.r_[starts[1:] - 1, len(codes) - 1]
+        previous = np.r_[np.nan, datetimes[:-1].astype(float)]
+        #the first row of a patient continues the previous chunks
+        previous[starts] = pd.Series(patients[codes[starts]]).map(self.last_datetimes).to_numpy(dtype=float)
+        for check, mask in [('order', datetimes < previous), ('duplicates', datetimes == previous)]:
+            if mask.any():
+                first = np.argmax(mask)
+                self._count(check, 'datetime', mask.sum(), (patients[codes[first]], datetimes[first]))
+        self.last_datetimes.update(zip(patients[codes[ends]], datetimes[ends]))
+
+    def issues(self, file_path, columns):
+        """Returns the issues found in the chunks (and the column names of the file)."""
+        issues = []
+        expected = list(self.columns)
+        if set(columns) != set(expected):
+            issues.append(Issue(file_path, 'error', 'columns', None, None, f"expected columns {expected} but found {list(columns)}"))
+            return issues
+        if self.rows == 0:
+            issues.append(Issue(file_path, 'error', 'empty', None, 0, "the file has no rows"))
+        for column, dtype in self.types.items():
+            issues.append(Issue(file_path, 'error', 'type', column, None, f"'{column}' should be {self.columns[column]} but is {dtype}"))
+        messages = {'missing': ('error', "missing values in '{column}'"),
+                    'range': ('warning', "values of '{column}' outside of {range}"),
+                    'order': ('warning', "timestamps not sorted within a patient"),
+                    'duplicates': ('warning', "duplicated timestamps of a patient")}
+        for (check, column), count in self.counts.items():
+            level, message = messages[check]
+            message = f"{count} {message.format(column=column, range=RANGES.get(column))}"
+            if (check, column) in self.examples:
+                patient_id, datetime = self.examples[(check, column)]
+                message += f", first at patient {patient_id}, datetime {datetime}"
+            issues.append(Issue(file_path, level, check, column, count, message))
+        return issues
+
+def validate_file(file_path, chunk_rows=CHUNK_ROWS):
+    """
+    Validates a history file written by `StudyDataset` (see the module documentation).
+
+    Args:
+        file_path (str): The file, named `<study>_<history>.<format>`.
+        chunk_rows (int): Number of rows read at a time (csv and parquet).
+
+    Returns:
+        result (dict): `file`, `study`, `stream`, `format`, `rows`, `patients`, `seconds` and `issues` (list of `Issue`).
+    """
+    start = time.perf_counter()
+    match = FILE_PATTERN.match(os.path.basename(file_path))
+    result = {'file': file_path, 'study': match['study'], 'stream': match['stream'], 'format': match['format'], 'rows': 0, 'patients': 0}
+    try:
+        columns = read_columns(file_path, match['format'])
+        check = HistoryCheck(match['stream'])
+        if set(columns) == set(check.columns):
+            for chunk in read_chunks(file_path, match['format'], chunk_rows):
+                check.add(chunk)
+        result.update(rows=check.rows, patients=len(check.last_datetimes), issues=check.issues(file_path, columns))
+    except Exception as e:
+        result['issues'] = [Issue(file_path, 'error', 'read', None, None, f"could not be read: {type(e).__name__}: {e}")]
+    result['seconds'] = time.perf_counter() - start
+    return result
+
+def validate_outputs(out_path, workers=None, chunk_rows=CHUNK_ROWS):
+    """Validates all history files below `out_path` using `workers` processes (defaults to the number of cpus)."""
+    files = find_output_files(out_path)
+    workers = min(workers or os.cpu_count(), len(files))
+    if workers <= 1:
+        return [validate_file(file_path, chunk_rows) for file_path in files]
+    with ProcessPoolExecutor(workers) as executor:
+        return list(executor.map(validate_file, files, [chunk_rows] * len(files)))
 
 def main():
-    current_dir = os.getcwd()
-    out_path = os.path.join(current_dir, 'data/out')
-
-    potential_folders = ['DCLP3 Public Dataset - Release 3 - 2022-08-04',
-                          'FLAIRPublicDataSet',
-                          'DCLP5_Dataset_2022-01-20-5e0f3b16-c890-4ace-9e3b-531f3687cf53', 
-                          'PEDAP Public Dataset - Release 3 - 2024-09-25', 
-                          'IOBP2 RCT Public Dataset']
-    
-    # Get all study folders in the output path
-    actual_folders = [f for f in os.listdir(out_path) if os.path.isdir(os.path.join(out_path, f))]
-    available_folders = [f for f in actual_folders if f in potential_folders]
-    print(available_folders)
-
-    # Validate each study folder
-    for folder in available_folders:
-       folder_full_path = os.path.join(out_path, folder)
-       logger.debug(f"Validating study folder: {folder_full_path}")
-       validate_output(folder_full_path)
+    parser = argparse.ArgumentParser(description="Validate the history files written by run_functions.py.")
+    parser.add_argument('--out', default=os.path.join(os.getcwd(), 'data', 'out'), help="Output folder of run_functions.py.")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help="Number of files validated in parallel.")
+    parser.add_argument('--chunk-rows', type=int, default=CHUNK_ROWS, help="Number of rows read at a time.")
+    parser.add_argument('--strict', action='store_true', help="Fail on warnings (unsorted or duplicated timestamps, implausible values).")
+    parser.add_argument('--report', help="Optional csv file to save the issues to.")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    results = validate_outputs(args.out, args.workers, args.chunk_rows)
+    issues = [issue for result in results for issue in result['issues']]
+    for result in results:
+        name = os.path.relpath(result['file'], args.out)
+        levels = {issue.level for issue in result['issues']}
+        summary = f"{name} ({result['rows']} rows, {result['patients']} patients, {result['seconds']:.1f}s)"
+        if 'error' in levels:
+            logger.error(f"[!] ERROR {summary}")
+        elif levels:
+            logger.warning(f"[?] WARNING {summary}")
+        else:
+            logger.info(f"[x] PASSED {summary}")
+        for issue in result['issues']:
+            (logger.error if issue.level == 'error' else logger.warning)(f"    {issue.message}")
+    logger.info(f"Validated {len(results)} files in {time.perf_counter() - start:.1f}s")
+    if args.report:
+        pd.DataFrame(issues, columns=Issue._fields).to_csv(args.report, index=False)
+    failed = [issue for issue in issues if issue.level == 'error' or args.strict]
+    return 1 if failed else 0
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    raise SystemExit(main())